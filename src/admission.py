@@ -0,0 +1,108 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from metrics import METRICS, MetricsRegistry
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Auth queue is full, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController():
+    """
+    Bounds how many websocket clients run the auth phase at the same time.
+
+    Clients over the concurrency limit wait in a FIFO queue and are admitted
+    strictly in arrival order. Once the queue holds ``max_queue`` waiters new
+    arrivals are turned away with a jittered retry-after hint, so a reconnect
+    storm is spread out instead of piling onto SQLite all at once.
+    """
+    def __init__(self,
+                 max_concurrent: int = 16,
+                 max_queue: int = 512,
+                 base_retry: float = 1.0,
+                 max_retry: float = 30.0,
+                 metrics: MetricsRegistry = METRICS):
+        self._max_concurrent = max(1, max_concurrent)
+        self._max_queue = max(0, max_queue)
+        self._base_retry = base_retry
+        self._max_retry = max_retry
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+        self._queue_depth = metrics.gauge("admission_queue_depth", lambda: len(self._waiters))
+        self._in_flight_gauge = metrics.gauge("admission_in_flight", lambda: self._in_flight)
+        self._peak_depth = metrics.gauge("admission_queue_depth_peak")
+        self._admitted = metrics.counter("admission_admitted_total")
+        self._rejected = metrics.counter("admission_rejected_total")
+        self._wait = metrics.histogram("admission_wait_seconds")
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def retry_after(self, attempt: int = 0) -> float:
+        """
+        Backoff hint for a rejected client: grows with the queue backlog and the
+        number of attempts the client already made, with full jitter on top.
+        """
+        backlog = 1 + len(self._waiters) / self._max_concurrent
+        ceiling = min(self._max_retry, self._base_retry * backlog * (2 ** max(0, min(attempt, 8))))
+        return round(random.uniform(self._base_retry / 2, max(self._base_retry, ceiling)), 3)
+
+    async def acquire(self, attempt: int = 0) -> None:
+        if self._in_flight < self._max_concurrent and not self._waiters:
+            self._in_flight += 1
+            self._admitted.inc()
+            self._wait.observe(0.0)
+            return
+
+        if len(self._waiters) >= self._max_queue:
+            self._rejected.inc()
+            raise AdmissionRejected(self.retry_after(attempt))
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        if len(self._waiters) > self._peak_depth.value:
+            self._peak_depth.set(len(self._waiters))
+        start = time.perf_counter()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the slot was already handed to us, pass it on
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+        self._admitted.inc()
+        self._wait.observe(time.perf_counter() - start)
+
+    def release(self) -> None:
+        # hand the slot straight to the next waiter so nobody can jump the queue
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, attempt: int = 0):
+        await self.acquire(attempt)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.responses import FileResponse
+
+from etags import if_none_match
+from metrics import METRICS, MetricsRegistry
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is in requirements.txt, a bare install only goes without thumbnails
+    Image = None
+
+
+ATTACHMENT_ID = re.compile(r"^[0-9a-f]{64}$")
+THUMBNAIL_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp")
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+
+def _make_thumbnail(src: Path, dst: Path, size: tuple[int, int]) -> None:
+    # runs in the thumbnail pool, Pillow releases the GIL while decoding and resizing
+    with Image.open(src) as img:
+        img.thumbnail(size)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        tmp = dst.with_name(dst.name + ".tmp")
+        img.save(tmp, "JPEG", quality=80)
+    os.replace(tmp, dst)
+
+
+class AttachmentStore():
+    """
+    Content-addressed files on local disk. An attachment is stored once under
+    the sha256 of its bytes, at ``root/ab/cd/<sha256>``, with a small JSON
+    sidecar holding media type, size and the name it was first uploaded with.
+    Messages only carry the id.
+
+    Uploads are written to ``root/tmp`` as they arrive, in ``chunk_size``
+    pieces hashed and written off the event loop, so memory stays at one chunk
+    no matter the file size. Thumbnails of images are made in a small thread
+    pool after the upload has been answered.
+    """
+    def __init__(self,
+                 root: Path,
+                 max_size: int = 256 * 1024 * 1024,
+                 chunk_size: int = 1024 * 1024,
+                 thumbnail_size: tuple[int, int] = (320, 320),
+                 thumbnail_workers: int = 2,
+                 metrics: MetricsRegistry = METRICS):
+        self._root = Path(root)
+        self._max_size = max_size
+        self._chunk_size = chunk_size
+        self._thumbnail_size = thumbnail_size
+        self._pool = ThreadPoolExecutor(thumbnail_workers, thread_name_prefix="thumbnail") if Image is not None else None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+        self._uploads = metrics.counter("attachment_uploads_total")
+        self._deduplicated = metrics.counter("attachment_deduplicated_total")
+        self._bytes = metrics.counter("attachment_bytes_stored_total")
+        self._thumbnail_failures = metrics.counter("attachment_thumbnail_failures_total")
+        self._upload_time = metrics.histogram("attachment_upload_seconds")
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def path(self, attachment_id: str) -> Path:
+        return self._root / attachment_id[:2] / attachment_id[2:4] / attachment_id
+
+    def thumbnail_path(self, attachment_id: str) -> Path:
+        return self._root / attachment_id[:2] / attachment_id[2:4] / f"{attachment_id}.thumb.jpg"
+
+    def meta(self, attachment_id: str) -> Optional[dict]:
+        if not ATTACHMENT_ID.match(attachment_id):
+            return None
+        try:
+            return json.loads(self.path(attachment_id).with_suffix(".json").read_text())
+        except FileNotFoundError:
+            return None
+
+    def matches(self, attachment_id: str, size: int, media_type: str) -> bool:
+        """True when ``attachment_id`` is stored with the size and media type a message claims for it."""
+        meta = self.meta(attachment_id)
+        return meta is not None and meta["size"] == size and meta["media_type"] == media_type
+
+    # -------------------------------------------------
+    # Upload
+    # -------------------------------------------------
+    @staticmethod
+    def _write(f, digest, data: bytes) -> None:
+        digest.update(data)
+        f.write(data)
+
+    async def save(self, chunks: AsyncIterator[bytes], media_type: str, name: str = "") -> dict:
+        """
+        Store the stream ``chunks`` and return the reference a message carries.
+        Raises 413 beyond ``max_size`` and 400 for an empty body.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tmp_dir = self._root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        tmp = tmp_dir / uuid.uuid4().hex
+
+        digest = hashlib.sha256()
+        size = 0
+        buffer = bytearray()
+        f = await asyncio.to_thread(open, tmp, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self._max_size:
+                    raise HTTPException(status_code=413, detail=f"Attachments are limited to {self._max_size} bytes")
+                buffer += chunk
+                if len(buffer) >= self._chunk_size:
+                    data = bytes(buffer)
+                    buffer.clear()
+                    await asyncio.to_thread(self._write, f, digest, data)
+            if buffer:
+                await asyncio.to_thread(self._write, f, digest, bytes(buffer))
+            await asyncio.to_thread(f.close)
+            if size == 0:
+                raise HTTPException(status_code=400, detail="Empty attachment")
+        except BaseException:
+            f.close()
+            tmp.unlink(missing_ok=True)
+            raise
+
+        attachment_id = digest.hexdigest()
+        final = self.path(attachment_id)
+        deduplicated = final.exists()
+        if deduplicated:
+            tmp.unlink()
+            self._deduplicated.inc()
+        else:
+            final.parent.mkdir(parents=True, exist_ok=True)
+            meta = {"media_type": media_type, "size": size, "name": name}
+            final.with_suffix(".json").write_text(json.dumps(meta))
+            os.replace(tmp, final)
+            self._bytes.inc(size)
+        self._uploads.inc()
+        self._upload_time.observe(loop.time() - start)
+
+        meta = self.meta(attachment_id)
+        thumbnail = self._schedule_thumbnail(attachment_id, meta["media_type"])
+        return {
+            "id": attachment_id,
+            "name": name or meta["name"],
+            "media_type": meta["media_type"],
+            "size": meta["size"],
+            "thumbnail": thumbnail,
+            "deduplicated": deduplicated,
+        }
+
+    def _schedule_thumbnail(self, attachment_id: str, media_type: str) -> bool:
+        if self._pool is None or media_type not in THUMBNAIL_TYPES:
+            return False
+        if attachment_id in self._pending or self.thumbnail_path(attachment_id).exists():
+            return True
+        future = asyncio.get_running_loop().run_in_executor(
+            self._pool, _make_thumbnail, self.path(attachment_id), self.thumbnail_path(attachment_id), self._thumbnail_size
+        )
+        self._pending[attachment_id] = future
+        future.add_done_callback(lambda f: self._thumbnail_done(attachment_id, f))
+        return True
+
+    def _thumbnail_done(self, attachment_id: str, future: asyncio.Future) -> None:
+        self._pending.pop(attachment_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            self._thumbnail_failures.inc()
+            logging.warning(f"Thumbnail of {attachment_id} failed: {future.exception()}")
+
+    # -------------------------------------------------
+    # Download
+    # -------------------------------------------------
+    def response(self, attachment_id: str, headers, thumbnail: bool = False) -> Optional[Response]:
+        """
+        FileResponse for an attachment or its thumbnail, None when there is none.
+        Range requests are answered by FileResponse itself; ids never change
+        content, so responses are cacheable forever and revalidate on the id.
+        """
+        meta = self.meta(attachment_id)
+        if meta is None:
+            return None
+        if thumbnail:
+            path, media_type, etag = self.thumbnail_path(attachment_id), "image/jpeg", f'"{attachment_id}-thumb"'
+            if not path.exists():
+                return None
+        else:
+            path, media_type, etag = self.path(attachment_id), meta["media_type"], f'"{attachment_id}"'
+
+        response_headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+        if if_none_match(headers, etag):
+            return Response(status_code=304, headers=response_headers)
+
+        response = FileResponse(path, media_type=media_type, headers=response_headers,
+                                filename=meta["name"] or None, content_disposition_type="inline")
+        response.chunk_size = self._chunk_size
+        return response
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,23 +1,45 @@
 import os
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, APIRouter, status, Depends
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse, Response
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, APIRouter, status, Depends, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 import logging
+import sqlite3
 from db_consts import ConversationType
-from database_wrapper import DBWrapper
-from db_objects import User
+from storage import Storage, open_storage, ConversationNotFound, HISTORY_PAGE_SIZE
+from user_registry import UserRegistry, UserRecord
+from admission import AdmissionController, AdmissionRejected
+from ratelimit import RateLimiter, DROP, DISCONNECT
+from heartbeat import HeartbeatMonitor
+from inbox import InboxCache
+from recent import RecentMessages
+from etags import ResponseCache, if_none_match
+from attachments import AttachmentStore
+from maintenance import MaintenanceScheduler
+from profiler import LoopLagMonitor, PROFILE_MAX_SECONDS, profile
+from recorder import TrafficRecorder, RecordingMiddleware
+from memory import MemoryAccounting, AllocationTracker, resident_bytes, task_counts
+from metrics import METRICS
+from static_assets import StaticAssetCache
+from wire import WireProtocols, receive_frame, send_encoded
+from frames import AUTH_FRAME, CHAT_FRAME, BatchFrame, ChatMessage, InvalidFrame, PingFrame, PongFrame
+from user_registry import Connection
+from export import export_conversation, export_filename, EXPORT_FORMATS, MEDIA_TYPES
 from datetime import datetime
 import json
 from envwrap import EnvParam
 from pathlib import Path
 import asyncio
+import time
 from pydantic import BaseModel
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 import requests
 
+# messages of one batch frame that are persisted in a single transaction
+MAX_BATCH = 500
+
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -30,6 +52,11 @@ class GetOldMsgRequest(BaseModel):
     room_id: Optional[int] = None
     oldest_message: Optional[str] = None
 
+class SyncRequest(BaseModel):
+    user_id: int
+    cursor: Optional[int] = None
+    high_water: Optional[dict[int, int]] = None
+
 class GroupChatRequest(BaseModel):
     user_a: str
     user_b: str
@@ -42,6 +69,13 @@ class RemoveParticipantReq(BaseModel):
     group_id: int
     user: str
 
+class BulkUsersRequest(BaseModel):
+    usernames: list[str]
+
+class BulkParticipantsReq(BaseModel):
+    group_id: int
+    users: list[str]
+
 class CreateGrpReq(BaseModel):
     creator: int
     group_name: str
@@ -52,67 +86,149 @@ class Backend():
     def __init__(self, app : FastAPI, env_params : EnvParam, is_dedicated : bool = False):
         self._env = env_params
         self._app = app
-        self._db = DBWrapper(db_path=self._env.ALL_PATHS.db_file)
+        self._db: Storage = open_storage(self._env.STORAGE_ENGINE, self._env.ALL_PATHS.db_file)
         self._db.event_handler.add_listener(self._db.add_user_event, self.update_user_array)
-        self._active_connections: list[str] = []
-        self._registered_users: dict[str, User] = dict()
+        self._db.event_handler.add_listener(self._db.participants_event, self.invalidate_inbox)
+        self._users = UserRegistry()
         self._users_to_disconnect: list[str] = []
+        self._admission = AdmissionController(max_concurrent=self._env.AUTH_CONCURRENCY,
+                                              max_queue=self._env.AUTH_QUEUE_LIMIT)
+        self._static = StaticAssetCache(self._env.ALL_PATHS.build)
+        self._wire = WireProtocols(deflate_threshold=self._env.WS_DEFLATE_THRESHOLD)
+        self._invalid_frames = METRICS.counter("ws_invalid_frames_total")
+        # chat messages per user, counted per message so batch frames pay their full size
+        self._frame_limiter = RateLimiter("ws_frames", rate=self._env.WS_RATE_LIMIT,
+                                          burst=self._env.WS_RATE_BURST, mode=self._env.WS_RATE_MODE)
+        # login attempts per client address, over the limit is always turned away
+        self._auth_limiter = RateLimiter("auth", rate=self._env.AUTH_RATE_LIMIT,
+                                         burst=self._env.AUTH_RATE_BURST, mode=DROP)
+        self._inbox = InboxCache()
+        # serialized get_groups / get_participants answers by ETag
+        self._responses = ResponseCache()
+        self._recent = RecentMessages(per_conversation=self._env.RECENT_MESSAGES_PER_CONVERSATION,
+                                      max_bytes=self._env.RECENT_MESSAGES_MAX_BYTES)
+        self._attachments = AttachmentStore(self._env.ALL_PATHS.attachments, max_size=self._env.ATTACHMENT_MAX_SIZE)
+        self._heartbeat = HeartbeatMonitor(interval=self._env.WS_HEARTBEAT_INTERVAL,
+                                           timeout=self._env.WS_HEARTBEAT_TIMEOUT)
+        # the memory engine has nothing to maintain
+        sqlite = self._env.STORAGE_ENGINE == "sqlite"
+        self._maintenance = MaintenanceScheduler(self._env.ALL_PATHS.db_file,
+                                                 interval=self._env.MAINTENANCE_INTERVAL if sqlite else 0,
+                                                 quiet=self._env.MAINTENANCE_QUIET,
+                                                 backup_dir=self._env.ALL_PATHS.backups,
+                                                 backup_interval=self._env.DB_BACKUP_INTERVAL if sqlite else 0,
+                                                 backup_keep=self._env.DB_BACKUP_KEEP)
+        self._loop_lag = LoopLagMonitor(interval=self._env.LOOP_LAG_INTERVAL,
+                                        threshold=self._env.LOOP_STALL_THRESHOLD)
+        # one profile at a time, two samplers would only measure each other
+        self._profiling = asyncio.Lock()
+        # anonymized API calls and websocket frames for bench.py replay, off unless a path is set
+        self._recorder: Optional[TrafficRecorder] = None
+        if self._env.TRAFFIC_RECORD_PATH:
+            self._recorder = TrafficRecorder(self._env.TRAFFIC_RECORD_PATH, secret=self._env.TRAFFIC_RECORD_SECRET)
+            self._app.add_middleware(RecordingMiddleware, recorder=self._recorder)
+        # what grows with traffic, in this order: an object reachable from two counts in the first
+        self._memory = MemoryAccounting(interval=self._env.MEMORY_ACCOUNTING_INTERVAL)
+        self._memory.track("connections", lambda: [list(self._users.online())])
+        self._memory.track("user_registry", lambda: [self._users])
+        self._memory.track("inbox_cache", lambda: [self._inbox])
+        self._memory.track("recent_messages", lambda: [self._recent])
+        self._memory.track("response_cache", lambda: [self._responses])
+        self._memory.track("static_assets", lambda: [self._static])
+        self._memory.track("rate_limiters", lambda: [self._frame_limiter, self._auth_limiter])
+        self._memory.track("event_queues", lambda: [self._db.event_handler])
+        self._memory.track("membership_versions", lambda: [self._db.versions])
+        # the memory engine holds every row, the SQLite one a path
+        self._memory.track("storage", lambda: [self._db])
+        if self._recorder is not None:
+            self._memory.track("recorder", lambda: [self._recorder])
+        self._allocations = AllocationTracker()
         
         router = APIRouter()
 
         @router.websocket("/ws/chat")
         async def chat(ws: WebSocket):
             try:
-                await ws.accept()
-                auth_data = await ws.receive_json()
-            except RuntimeError as e:
+                codec = await self._wire.accept(ws)
+                auth_data = await receive_frame(ws, codec, AUTH_FRAME)
+            except (RuntimeError, ValueError, WebSocketDisconnect) as e:
+                # InvalidFrame is a ValueError, a malformed login never reaches the database
                 print(e)
                 return
 
-            username   = auth_data.get("username", "")
-            password   = auth_data.get("password", "")
-            session_id = auth_data.get("session_id", "")
+            username   = auth_data.username
+            password   = auth_data.password
+            session_id = auth_data.session_id
+            attempt    = auth_data.attempt
 
-            incoming_user = User(username, password, session_id)
-            await incoming_user.set_id(self._db)
-            if username in self._active_connections:
-                payload = {
-                    "type": "cmd",
-                    "data": "rejected"
-                }
-                print(f"Sending Logout Command to {username}")
-                await self._registered_users[username]._active_connection.send_text(json.dumps(payload))
-                await self._registered_users[username]._active_connection.close()
+            client_ip = ws.client.host if ws.client else ""
+            wait = self._auth_limiter.consume(client_ip)
+            if wait:
+                await send_encoded(ws, codec.encode({"type": "response",
+                                                     "session_id": "0",
+                                                     "state": "RETRY_LATER",
+                                                     "retry_after": round(wait, 2)}))
+                await ws.close(code=status.WS_1013_TRY_AGAIN_LATER)
                 return
 
-
             try:
-                result = await self._db.login(incoming_user)
-            except HTTPException:
-                await ws.send_json({"type": "response",
-                                    "session_id": "0",
-                                    "state": "AUTH_FAILED"})
-                logging.error(f"Client: {ws.client} not authenticated\nUsername: {username}\nPassword:{password}")
-                await ws.close()
+                async with self._admission.admit(attempt):
+                    existing = self._users.connection(username)
+                    if existing is not None:
+                        payload = {
+                            "type": "cmd",
+                            "data": "rejected"
+                        }
+                        print(f"Sending Logout Command to {username}")
+                        await self.send_frame(existing, payload)
+                        await existing.ws.close()
+                        return
+
+
+                    try:
+                        # credentials, session and unread summary in one storage round trip
+                        auth = await self._db.authenticate(username, password, session_id, datetime.now())
+                    except HTTPException:
+                        await send_encoded(ws, codec.encode({"type": "response",
+                                                             "session_id": "0",
+                                                             "state": "AUTH_FAILED"}))
+                        logging.error(f"Client: {ws.client} not authenticated\nUsername: {username}\nPassword:{password}")
+                        await ws.close()
+                        return
+
+                    current_user = self._users.get(username)
+                    if current_user is None:
+                        # registered behind our back, e.g. through cli_admin
+                        current_user = self._users.put(*auth["user"])
+                    # a second login of the same user can get past the check above while we
+                    # authenticated, the older socket then falls out of the registry and
+                    # nothing would ever reap it
+                    displaced = self._users.connection(username)
+                    conn = self._users.connect(current_user, ws, codec)
+                    if displaced is not None:
+                        try:
+                            await self.send_frame(displaced, {"type": "cmd", "data": "rejected"})
+                            await displaced.ws.close()
+                        except Exception:
+                            pass
+                    sessionid = auth["session_id"]
+                    is_admin = False
+                    if current_user.username == "Blackcan":
+                        is_admin = True
+
+                    unread_convos = auth["unread"]
+            except AdmissionRejected as e:
+                await send_encoded(ws, codec.encode({"type": "response",
+                                                     "session_id": "0",
+                                                     "state": "RETRY_LATER",
+                                                     "retry_after": e.retry_after}))
+                await ws.close(code=status.WS_1013_TRY_AGAIN_LATER)
                 return
-            
-            current_user = self._registered_users[auth_data["username"]]
-            current_user._active_connection = ws
-            self._active_connections.append(current_user._credentials.username) 
-            current_user._isConnected = True
-            await current_user.set_id(self._db)
-            sessionid = await self._db.create_session_id(current_user, datetime.now())
-            is_admin = False
-            if current_user._credentials.username == "Blackcan":
-                is_admin = True
-
-            unread_convos = await self._db.find_unread_messages(current_user)
-            # Print unread conversations for debugging
 
             payload = {
                 "type": "response",
                 "session_id": sessionid,
-                "id": current_user._id,
+                "id": current_user.id,
                 "state": "AUTH_SUCCESS",
                 "role": is_admin,
                 "unread" : unread_convos
@@ -120,20 +236,17 @@ class Backend():
 
 
 
-            await ws.send_text(json.dumps(payload))
-            logging.info(f"Client {ws.client} authenticated as {current_user._credentials.username}")
-            a : list[User] = await self.retrieve_active_users()
-            for i in a:
-                print(f"{i._credentials.username} is Online")
+            await send_encoded(ws, codec.encode(payload))
+            logging.info(f"Client {ws.client} authenticated as {current_user.username}")
+            print(f"{self._users.online_count} users online")
 
             while True:
                 if len(self._users_to_disconnect) > 0:
                     for u in self._users_to_disconnect:
-                        if u in self._active_connections:
+                        dropped = self._users.disconnect(u)
+                        if dropped is not None:
                             print(f"Disconnecting {u}")
-                            await self._registered_users[u]._active_connection.close()
-                            self._active_connections.remove(u)
-                            self._registered_users[u]._isConnected = False
+                            await dropped.ws.close()
                     self._users_to_disconnect.clear()
                     
                 try:
@@ -142,51 +255,103 @@ class Backend():
                     message_data = {
                         "type": "message",
                         "data": {
-                            "msg": "Hello, how are you?"
+                            "msg": "Hello, how are you?",
+                            "attachment": {...}    # optional, what POST /api/attachments returned
                         },
-                        "from": "alice",           # sender's username
+                        "from": "alice",           # ignored, the authenticated user is the sender
                         "room_id": 1,               # recipient's username or group id
                         "room_name": "Name"         # name of room or friend
                         "chat_type": "direct"      # or "group"
                     }
-                    
-                    """
-                    msg = await ws.receive_json()
-                    await self._db.add_message_to_history(msg, current_user)
-                    relevant_users = await self._db.get_participants_from_convo(msg["room_id"])
-                    await self.update_last_read_field(user=self._registered_users[msg["from"]], conversation_id=msg["room_id"])
 
-                    for u in relevant_users:
-                        try:
-                            if self._registered_users[u["username"]]._active_connection is not None:
-                                await self._registered_users[u["username"]]._active_connection.send_json(msg)
-                        except (WebSocketDisconnect, RuntimeError):
-                            self._active_connections.remove(u)
-                            current_user._isConnected = False
-                            current_user._active_connection = None
-                            print(f"User: {current_user._credentials.username} left")
+                    clients with bursts send many of them in one frame:
+                    batch_data = {
+                        "type": "batch",
+                        "messages": [message_data, message_data, ...]
+                    }
+
+                    the server pings quiet connections with {"type": "ping"}, any
+                    frame counts as an answer, {"type": "pong"} is the cheapest one
+
+                    frames are validated against frames.CHAT_FRAME while they are decoded,
+                    one that doesn't match is answered with {"type": "error", "data": "invalid_frame"}
+                    before anything is stored or sent, so are messages to a room that doesn't
+                    exist or that the sender isn't in
+                    """
+                    try:
+                        frame, invalid = await receive_frame(ws, codec, CHAT_FRAME), None
+                    except InvalidFrame as e:
+                        frame, invalid = None, e
+                    conn.last_seen = time.monotonic()
+                    if isinstance(frame, PongFrame):
+                        continue
+                    if isinstance(frame, PingFrame):
+                        await send_encoded(ws, codec.encode({"type": "pong"}))
+                        continue
+                    if isinstance(frame, BatchFrame):
+                        chat_messages = frame.messages
+                    elif frame is not None:
+                        chat_messages = [frame]
+                    else:
+                        chat_messages = []
+                    if invalid is None:
+                        invalid = self.check_attachments(chat_messages)
+                    messages = [] if invalid else [m.envelope(current_user.username) for m in chat_messages]
+                    # rejected frames count against the limit too, flooding with garbage isn't free
+                    if not await self._frame_limiter.admit(current_user.id, len(messages) or 1):
+                        if self._frame_limiter.mode == DISCONNECT:
+                            self._users.disconnect(current_user.username, ws)
+                            await send_encoded(ws, codec.encode({"type": "cmd", "data": "rate_limited"}))
+                            await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+                            print(f"User: {current_user.username} disconnected for flooding")
                             return
+                        continue
+                    if invalid is not None:
+                        self._invalid_frames.inc()
+                        await send_encoded(ws, codec.encode({"type": "error", "data": "invalid_frame",
+                                                             "detail": invalid.detail}))
+                        continue
+                    refused = []
+                    for i in range(0, len(messages), MAX_BATCH):
+                        try:
+                            refused += await self.handle_messages(messages[i:i + MAX_BATCH], current_user)
+                        except ConversationNotFound as e:
+                            # deleted between the participant lookup and the write
+                            refused.append(e.conversation_id)
+                        except (HTTPException, sqlite3.Error):
+                            # a chunk storage refused costs that chunk, not the connection
+                            logging.exception(f"Storing messages from {current_user.username} failed")
+                            await send_encoded(ws, codec.encode({"type": "error", "data": "not_stored"}))
+                    if refused:
+                        self._invalid_frames.inc()
+                        await send_encoded(ws, codec.encode({"type": "error", "data": "invalid_frame",
+                                                             "detail": f"no such room or not a participant: {refused}"}))
                 except (WebSocketDisconnect, RuntimeError):
-                    for u in self._active_connections:
-                        if self._registered_users[u]._active_connection == ws:
-                            self._active_connections.remove(u)
-                            current_user._isConnected = False
-                            current_user._active_connection = None
-                            print(f"User: {current_user._credentials.username} left")
-                            return
+                    self._users.disconnect(current_user.username, ws)
+                    print(f"User: {current_user.username} left")
+                    return
+                except Exception:
+                    # whatever else goes wrong, don't leave a ghost online in the registry
+                    logging.exception(f"Chat handler of {current_user.username} failed")
+                    self._users.disconnect(current_user.username, ws)
+                    try:
+                        await ws.close(code=status.WS_1011_INTERNAL_ERROR)
+                    except RuntimeError:
+                        pass
+                    return
 
         @router.get("/", include_in_schema=False)
-        async def serve_index():
-            return FileResponse(str(self._env.ALL_PATHS.build / "index.html"))
+        async def serve_index(request: Request):
+            return self.serve_static("index.html", request)
           
         @router.get("/api/users")
         async def get_users():
             return [
                 {
-                    "username": username,
-                    "is_online": user._isConnected
+                    "username": user.username,
+                    "is_online": self._users.is_online(user.username)
                 }
-                for username, user in self._registered_users.items() if user._credentials.approved
+                for user in self._users.approved()
             ]
         
         @router.get("/api/all_users")
@@ -202,17 +367,17 @@ class Backend():
             
             return [
             {
-                "username": username,
-                "is_online": user._isConnected,
-                "is_approved":user._credentials.approved
+                "username": user.username,
+                "is_online": self._users.is_online(user.username),
+                "is_approved": user.approved
             }
-            for username, user in self._registered_users.items()
+            for user in self._users.records()
             ]
         
         @router.post("/add_user", status_code=status.HTTP_201_CREATED)
         async def handle_add_user_request(User : UserCreate):
             print("we Start getting a new user")
-            if User.username in self._registered_users:
+            if User.username in self._users:
                 raise HTTPException(status_code=409, detail="UserName is Taken")
             try:
                 await self._db.add_user(User.username, User.password)
@@ -233,7 +398,8 @@ class Backend():
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-            await self._db.approve_user(request.username)
+            if await self._db.approve_user(request.username) is None:
+                raise HTTPException(status_code=404, detail="User not found")
             return {"detail": "User approved successfully"}
         
 
@@ -250,7 +416,8 @@ class Backend():
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-            await self._db.reject_user(request.username)
+            if await self._db.reject_user(request.username) is None:
+                raise HTTPException(status_code=404, detail="User not found")
             return {"detail": "User rejected successfully"}
         
 
@@ -272,13 +439,118 @@ class Backend():
             await self._db.event_handler.call_event(self._db.add_user_event, payload)
             return {"detail": "User logged out successfully"}
         
+        @router.get("/api/metrics")
+        async def get_metrics(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            return METRICS.snapshot()
+
+        @router.get("/debug/profile")
+        async def get_profile(seconds: float = 10.0,
+                              interval_ms: float = 5.0,
+                              idle: bool = False,
+                              clock: str = "cpu",
+                              credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            """
+            Sample every thread for ``seconds`` and answer with collapsed stacks,
+            one ``frame;frame;...;frame count`` line per stack, ready for
+            flamegraph.pl or speedscope. Threads waiting in a selector or on a lock
+            are left out unless ``idle`` is set. The ``cpu`` clock shows where time
+            is computed, ``wall`` also where the loop sits in a blocking call.
+            """
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            if not 0 < seconds <= PROFILE_MAX_SECONDS or not 1 <= interval_ms <= 1000:
+                raise HTTPException(status_code=400,
+                                    detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}], interval_ms in [1, 1000]")
+            if self._profiling.locked():
+                raise HTTPException(status_code=409, detail="A profile is already running")
+            async with self._profiling:
+                try:
+                    sampler = await profile(seconds, interval_ms / 1000, idle, clock)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                except RuntimeError as e:
+                    raise HTTPException(status_code=503, detail=str(e))
+            return PlainTextResponse(sampler.collapsed(), headers={"X-Profile-Samples": str(sampler.taken)})
+
+        @router.get("/debug/stalls")
+        async def get_stalls(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            return list(self._loop_lag.stalls)
+
+        @router.get("/debug/memory")
+        async def get_memory(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            """Estimated bytes per subsystem right now, the process RSS and the live tasks by coroutine."""
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            return {
+                "resident_bytes": resident_bytes(),
+                "subsystems": self._memory.measure(),
+                "online": self._users.online_count,
+                "users": len(self._users),
+                "tasks": task_counts(),
+            }
+
+        @router.post("/debug/tracemalloc/start")
+        async def start_tracemalloc(frames: int = 1, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            if not 1 <= frames <= 64:
+                raise HTTPException(status_code=400, detail="frames must be in [1, 64]")
+            return await self._allocations.start(frames)
+
+        @router.get("/debug/tracemalloc/diff")
+        async def diff_tracemalloc(top: int = 25, key: str = "lineno", credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            """
+            Allocation sites that grew most since the previous snapshot (the one
+            ``start`` or the last ``diff`` took); this snapshot becomes the next baseline.
+            """
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            if key not in ("lineno", "filename", "traceback"):
+                raise HTTPException(status_code=400, detail="key must be lineno, filename or traceback")
+            try:
+                return await self._allocations.diff(top, key)
+            except RuntimeError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+
+        @router.post("/debug/tracemalloc/stop")
+        async def stop_tracemalloc(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            self._allocations.stop()
+            return {"tracing": self._allocations.tracing}
+
         @router.get("/login")
-        async def serve_login():
-            return FileResponse(str(self._env.ALL_PATHS.build / "index.html"))
+        async def serve_login(request: Request):
+            return self.serve_static("index.html", request)
 
         @router.get("/chat")
-        async def serve_chat():
-            return FileResponse(str(self._env.ALL_PATHS.build / "index.html"))
+        async def serve_chat(request: Request):
+            return self.serve_static("index.html", request)
             
         @router.post("/api/get_old_msg")
         async def get_old_msg(request: GetOldMsgRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
@@ -287,23 +559,42 @@ class Backend():
             except HTTPException as e:
                 raise e
 
-            messages = []
-            if request.oldest_message:
-                messages = await self._db.get_messages_from(request.room_id, request.oldest_message)
-            else:
-                messages = await self._db.get_messages_from(request.room_id)
+            messages = await self.history_page(request.room_id, request.oldest_message or None)
 
             # Update last_message_read like in get_room
             if request.requestor is not None and messages and messages[len(messages)-1] is not None:
                 # Find participant_id for this user in this room
-                user_row = await self._db.get_user_by_id(request.requestor)
-                user = self._registered_users[user_row["username"]]
+                user = self._users.get_by_id(request.requestor)
+                if user is None:
+                    raise HTTPException(status_code=404, detail="User not found")
                 await self.update_last_read_field(user=user, conversation_id=request.room_id)
             else:
                 print("couldn't find requestor or messages")
 
             return [msg["content"] for msg in messages]
             
+        @router.post("/api/sync")
+        async def sync(request: SyncRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            if self._users.get_by_id(request.user_id) is None:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            async def stream():
+                count = 0
+                last_id = request.cursor
+                async for msg in self._db.iter_missed_messages(request.user_id, request.high_water, request.cursor):
+                    count += 1
+                    last_id = msg["id"]
+                    yield json.dumps(msg) + "\n"
+                # lets the client store a global cursor for the next sync
+                yield json.dumps({"type": "sync_end", "cursor": last_id, "count": count}) + "\n"
+
+            return StreamingResponse(stream(), media_type="application/x-ndjson")
+
         @router.post("/api/get_room")
         async def get_room(request: GroupChatRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
             try:
@@ -311,22 +602,18 @@ class Backend():
             except HTTPException as e:
                 raise e
             
-            try:
-                userA = self._registered_users[request.user_a]
-                userB = self._registered_users[request.user_b]
-                if userA == userB:
-                    formated_response = {
-                        "room_id": None,
-                        "old_messages": []
-                    }
-                    return formated_response
-            except KeyError:
+            userA = self._users.get(request.user_a)
+            userB = self._users.get(request.user_b)
+            if userA is None or userB is None:
                 raise HTTPException(status_code=404, detail="User not found")
+            if userA == userB:
+                formated_response = {
+                    "room_id": None,
+                    "old_messages": []
+                }
+                return formated_response
             
-            response = await self._db.retrieve_direct_convo(userA, userB)
-
-            if response is None:
-                response = await self._db.create_direct_chat(userA, userB)
+            response = await self._db.create_direct_chat(userA, userB)
 
             formated_response = {
                 "room_id": response,
@@ -334,15 +621,72 @@ class Backend():
             return formated_response
         
         @router.get("/api/get_groups{username}")
-        async def get_groups(username : str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        async def get_groups(username : str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
             try:
                 self.check_token(credentials)
             except HTTPException as e:
                 raise e
             
-            groups = await self._db.get_user_groups(username)
-            return groups
+            user = self._users.get(username)
+            if user is None:
+                return await self._db.get_user_groups(username)
+            return await self.conditional_json(request, lambda: self._db.versions.user_etag(user.id),
+                                               lambda: self._db.get_user_groups(username))
         
+        @router.get("/api/inbox")
+        async def get_inbox(username: str, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            """
+            Every conversation of ``username`` with display name, type, last message
+            preview and unread count, newest activity first. Everything the sidebar
+            needs in one request.
+            """
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+            user = self._users.get(username)
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            return await self._inbox.get(user.id, self._db.get_inbox)
+
+        @router.post("/api/attachments")
+        async def upload_attachment(request: Request, name: str = "", credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            """
+            Raw request body, streamed to the attachment store. The response is the
+            reference to put into a message: {"type": "message", "data": {"msg": ..., "attachment": {...}}}
+            """
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+            declared = request.headers.get("content-length")
+            if declared is not None and declared.isdigit() and int(declared) > self._attachments.max_size:
+                raise HTTPException(status_code=413, detail=f"Attachments are limited to {self._attachments.max_size} bytes")
+            media_type = request.headers.get("content-type", "application/octet-stream").split(";")[0].strip()
+            return await self._attachments.save(request.stream(), media_type, name)
+
+        @router.get("/api/attachments/{attachment_id}")
+        async def download_attachment(attachment_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+            response = self._attachments.response(attachment_id, request.headers)
+            if response is None:
+                raise HTTPException(status_code=404, detail="Attachment not found")
+            return response
+
+        @router.get("/api/attachments/{attachment_id}/thumbnail")
+        async def download_thumbnail(attachment_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+            response = self._attachments.response(attachment_id, request.headers, thumbnail=True)
+            if response is None:
+                raise HTTPException(status_code=404, detail="Thumbnail not found")
+            return response
+
         @router.get("/api/get_room_msg{group_id}")
         async def get_room_msg(group_id : int, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
             try:
@@ -350,18 +694,39 @@ class Backend():
             except HTTPException as e:
                 raise e
             
-            msg = await self._db.get_messages_from(group_id)
-            return msg
+            return await self.history_page(group_id)
         
+        @router.get("/api/export{conversation_id}")
+        async def export_history(
+            conversation_id: int,
+            format: str = "ndjson",
+            gzip: bool = False,
+            after: int = 0,
+            credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())
+        ):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            if format not in EXPORT_FORMATS:
+                raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+            return StreamingResponse(
+                export_conversation(self._db, conversation_id, format, gzip, after),
+                media_type="application/gzip" if gzip else MEDIA_TYPES[format],
+                headers={"Content-Disposition": f'attachment; filename="{export_filename(conversation_id, format, gzip)}"'},
+            )
+
         @router.get("/api/get_participants{group_id}")
-        async def get_room_msg(group_id : int, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        async def get_participants(group_id : int, request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
             try:
                 self.check_token(credentials)
             except HTTPException as e:
                 raise e
             
-            msg = await self._db.get_participants_from_convo(group_id)
-            return msg
+            return await self.conditional_json(request, lambda: self._db.versions.conversation_etag(group_id),
+                                               lambda: self._db.get_participants_from_convo(group_id))
 
         @router.get("/api/search_gifs{search_term}")
         async def search_gifs(
@@ -449,16 +814,61 @@ class Backend():
             user_id = user_row["id"]
 
             # Check if user is a participant in the group
-            participants = await self._db.get_participants_from_convo(request.group_id)
-            print(participants)
-            print(user_id)
-            if not any(p.get("user_id") == user_id for p in participants):
+            if not await self._db.is_participant(request.group_id, user_id):
                 raise HTTPException(status_code=404, detail="User is not a participant in this group")
 
             # Remove participant from the group (conversation)
             await self._db.remove_participant(request.group_id, user_id)
             return {"detail": f"User {request.user} removed from group {request.group_id}"}
         
+        @router.post("/api/approve_users")
+        async def approve_users(request: BulkUsersRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            ids = await self._db.set_approved_bulk(request.usernames, True)
+            return {"results": [
+                {"username": name, "status": "approved" if user_id is not None else "user_not_found"}
+                for name, user_id in ids.items()
+            ]}
+
+        @router.post("/api/reject_users")
+        async def reject_users(request: BulkUsersRequest, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            ids = await self._db.set_approved_bulk(request.usernames, False)
+            return {"results": [
+                {"username": name, "status": "rejected" if user_id is not None else "user_not_found"}
+                for name, user_id in ids.items()
+            ]}
+
+        @router.post("/api/add_participants")
+        async def add_participants_to_grp(request: BulkParticipantsReq, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            results = await self._db.add_participants_bulk(request.group_id, request.users)
+            return {"group_id": request.group_id,
+                    "results": [{"username": name, "status": state} for name, state in results.items()]}
+
+        @router.post("/api/remove_participants")
+        async def remove_participants_from_grp(request: BulkParticipantsReq, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+            try:
+                self.check_token(credentials)
+            except HTTPException as e:
+                raise e
+
+            results = await self._db.remove_participants_bulk(request.group_id, request.users)
+            return {"group_id": request.group_id,
+                    "results": [{"username": name, "status": state} for name, state in results.items()]}
+
         @router.post("/api/create_group")
         async def remove_participant_from_grp(request: CreateGrpReq, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
             await self._db.create_conversation(request.group_name, ConversationType.Group, request.creator)
@@ -472,36 +882,134 @@ class Backend():
             
         # catch other urls
         @router.get("/{full_path:path}", include_in_schema=False)
-        async def serve_catch_all(full_path: str):
-            print(full_path)
-            file_path = self._env.ALL_PATHS.build / full_path
-            if file_path.exists() and file_path.is_file():
-                print("exist")
-                return FileResponse(str(file_path))
-            else:
-                print("does not exist")
-                raise HTTPException(status_code=404, detail="File not found")
-
-        if is_dedicated:
-            self._app.mount(
-                "/static",
-                StaticFiles(directory=self._env.ALL_PATHS.static, html=True),
-                name="/static",
-            )
+        async def serve_catch_all(full_path: str, request: Request):
+            # build/static is served from here too, hashed files get immutable caching
+            return self.serve_static(full_path, request)
 
         self._app.include_router(router)
         self._app.add_event_handler("startup", self.create_tables_at_startup)
+        self._app.add_event_handler("shutdown", self.shutdown)
+
+    def check_attachments(self, messages: list[ChatMessage]) -> Optional[InvalidFrame]:
+        """
+        Messages only carry references: every attachment has to be in the
+        attachment store with the size and media type the reference claims.
+        """
+        unknown = [m.data.attachment.id for m in messages
+                   if m.data.attachment is not None
+                   and not self._attachments.matches(m.data.attachment.id, m.data.attachment.size,
+                                                     m.data.attachment.media_type)]
+        if unknown:
+            return InvalidFrame(f"unknown attachment: {', '.join(unknown)}")
+        return None
+
+    async def handle_messages(self, messages: list[dict], sender: UserRecord) -> list[int]:
+        """
+        Persist messages from one sender in a single transaction, then fan them out
+        room by room: one participant lookup per room and every recipient gets the
+        room's messages in the order they were sent.
 
-    async def update_last_read_field(self, participant_id=None, user: User = None, conversation_id: int = None):
+        The lookup happens before anything is written: messages to a room that
+        doesn't exist or that the sender isn't in are dropped, their room ids are
+        returned so the caller can tell the client.
+        """
+        rooms: dict[int, list[dict]] = {}
+        for m in messages:
+            if m["room_id"] is not None:
+                rooms.setdefault(m["room_id"], []).append(m)
+        members: dict[int, list] = {}
+        refused = []
+        for room_id in rooms:
+            relevant_users = await self._db.get_participants_from_convo(room_id)
+            if any(u["user_id"] == sender.id for u in relevant_users):
+                members[room_id] = relevant_users
+            else:
+                refused.append(room_id)
+        accepted = [m for m in messages if m["room_id"] in members]
+        if not accepted:
+            return refused
+
+        ids = await self._db.add_messages_to_history(accepted, sender)
+        self._maintenance.touch()
+
+        persisted: dict[int, list[tuple[int, str]]] = {}
+        for m, message_id in zip(accepted, ids):
+            # the same content the storage engine just wrote
+            persisted.setdefault(m["room_id"], []).append((message_id, json.dumps(m)))
+        for room_id, recent in persisted.items():
+            self._recent.append(room_id, recent)
+
+        for room_id, relevant_users in members.items():
+            room_messages = rooms[room_id]
+            self._inbox.invalidate(u["user_id"] for u in relevant_users)
+            # encode once per wire format, not once per recipient
+            frames = {}
+            for u in relevant_users:
+                conn = self._users.connection(u["username"])
+                if conn is None:
+                    continue
+                encoded = frames.get(conn.codec)
+                if encoded is None:
+                    encoded = frames[conn.codec] = [conn.codec.encode(m) for m in room_messages]
+                try:
+                    for frame in encoded:
+                        await send_encoded(conn.ws, frame)
+                except (WebSocketDisconnect, RuntimeError):
+                    # the recipient is gone, drop its connection but keep serving the sender
+                    self._users.disconnect(u["username"], conn.ws)
+                    print(f"User: {u['username']} left")
+        return refused
+
+    async def conditional_json(self, request: Request, etag_of: Callable[[], str], load: Callable[[], Awaitable]) -> Response:
+        """
+        JSON answer tagged with the ETag ``etag_of`` gives: 304 when the client
+        already has it, else the cached body of that tag or a fresh ``load``.
+        A body is only tagged and cached when the version didn't move while it
+        was loading.
+        """
+        etag = etag_of()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match(request.headers, etag):
+            self._responses.not_modified.inc()
+            return Response(status_code=304, headers=headers)
+        body = self._responses.get(etag)
+        if body is None:
+            body = JSONResponse(jsonable_encoder(await load())).body
+            if etag_of() != etag:
+                return Response(body, media_type="application/json")
+            self._responses.put(etag, body)
+        return Response(body, media_type="application/json", headers=headers)
+
+    async def history_page(self, room_id: Optional[int], before: Optional[str] = None) -> list[dict]:
+        """A page of ``get_messages_from``, from the recent messages ring when it can answer."""
+        if room_id is None:
+            return []
+        page = self._recent.page(room_id, before)
+        if page is not None:
+            return page
+        page = await self._db.get_messages_from(room_id, before)
+        if before is None:
+            self._recent.warm(room_id, page, complete=len(page) < HISTORY_PAGE_SIZE)
+        return page
+
+    async def newest_message_id(self, conversation_id: int) -> Optional[int]:
+        newest_id = self._recent.newest_id(conversation_id)
+        if newest_id is not None:
+            return newest_id
+        newest_message = await self._db.get_newest_message_in_conversation(conversation_id)
+        return newest_message["id"] if newest_message else None
+
+    async def update_last_read_field(self, participant_id=None, user: UserRecord = None, conversation_id: int = None):
         # If user and conversation_id are provided, update last_read for that participant in the conversation
         if user is not None and conversation_id is not None:
             # Get participant record for this user in the given conversation
             participant = await self._db.get_participant_by_user_and_convo(user, conversation_id)
             if not participant:
                 raise HTTPException(status_code=404, detail="Participant record not found for user in conversation")
-            newest_message = await self._db.get_newest_message_in_conversation(conversation_id)
-            if newest_message:
-                await self._db.update_last_message(participant_id=participant["id"], message_id=newest_message["id"])
+            newest_id = await self.newest_message_id(conversation_id)
+            if newest_id is not None:
+                await self._db.update_last_message(participant_id=participant["id"], message_id=newest_id)
+                self._inbox.invalidate([user.id])
             return
 
         # If participant_id is provided, update for that participant
@@ -510,15 +1018,28 @@ class Backend():
             if not participant:
                 raise HTTPException(status_code=404, detail="Participant not found")
             convo_id = participant["conversation_id"]
-            newest_message = await self._db.get_newest_message_in_conversation(convo_id)
-            if not newest_message:
+            newest_id = await self.newest_message_id(convo_id)
+            if newest_id is None:
                 return
-            await self._db.update_last_message(participant_id=participant_id, message_id=newest_message["id"])
+            await self._db.update_last_message(participant_id=participant_id, message_id=newest_id)
+            self._inbox.invalidate([participant["user_id"]])
             return
 
         # If neither is provided, raise error
         raise HTTPException(status_code=400, detail="Must provide either participant_id or user (with conversation_id)")
 
+    def serve_static(self, rel_path: str, request: Request):
+        response = self._static.response(rel_path, request.headers)
+        if response is not None:
+            return response
+
+        # not indexed at startup, e.g. a build deployed while running
+        build = self._env.ALL_PATHS.build.resolve()
+        file_path = (build / rel_path).resolve()
+        if file_path.is_relative_to(build) and file_path.is_file():
+            return FileResponse(str(file_path))
+        raise HTTPException(status_code=404, detail="File not found")
+
     def check_token(self, payload):
         token = payload.credentials
         if token != self._env.BEARER_TOKEN:
@@ -532,60 +1053,95 @@ class Backend():
     async def create_tables_at_startup(self):
         print("Starting DB Init")
         await self._db.init_db()
-        users = await self._db.get_all_users()
-        self._registered_users = {u._credentials.username: u for u in users}
-
-    async def retrieve_active_users(self) -> list[User]:
-        iterable_user = self._registered_users
-        online_users = []
-        for u in iterable_user:
-            if iterable_user[u]._isConnected:
-                online_users.append(iterable_user[u])
-        return online_users
+        await asyncio.to_thread(self._static.load)
+        users = UserRegistry()
+        async for rows in self._db.iter_user_records():
+            users.load(rows)
+        self._users = users
+        print(f"Loaded {len(users)} users")
+        self._heartbeat.start(self._users)
+        self._maintenance.start()
+        self._loop_lag.start()
+        if self._recorder is not None:
+            self._recorder.start()
+        self._memory.start()
+
+    async def shutdown(self):
+        await self._heartbeat.stop()
+        await self._maintenance.stop()
+        await self._loop_lag.stop()
+        if self._recorder is not None:
+            await self._recorder.stop()
+        await self._memory.stop()
+        self._allocations.stop()
+        self._attachments.shutdown()
+        # let queued user events (approve/reject/logout) reach the registry before we exit
+        await self._db.event_handler.shutdown()
+
+    async def retrieve_active_users(self) -> list[UserRecord]:
+        return [conn.user for conn in self._users.online()]
     
     async def update_user_array(self, _, payload):
-        users = await self._db.get_all_users()
-        if not hasattr(self, "_user_lock"):
-            self._user_lock = asyncio.Lock()
-        async with self._user_lock:
-            for u in users:
-                if payload is not None and payload.get("reject") == u._credentials.username:
-                    print(f"Removing {u._credentials.username} from active users")
-                    self._registered_users[u._credentials.username] = u
-                    self._registered_users[u._credentials.username]._credentials.approved = False
-                    if u._credentials.username in self._active_connections:
-                        payload = {
-                            "type": "cmd",
-                            "data": "rejected"
-                        }
-                        print(f"Sending Logout Command to {u._credentials.username}")
-                        await self._registered_users[u._credentials.username]._active_connection.send_text(json.dumps(payload))
-                    return
-                
-                if payload is not None and payload.get("approve") == u._credentials.username:
-                    print(f"approved {u._credentials.username} from active users")
-                    self._registered_users[u._credentials.username] = u
-                    self._registered_users[u._credentials.username]._credentials.approved = True
-                    return
+        """
+        Patch the registry entry of the one user named in a user event. The event
+        carries the user's id and approved flag, the DB is only asked when an
+        event arrives without them.
+        """
+        if not payload:
+            return
 
-                if payload is not None and payload.get("adding") == u._credentials.username:
-                    if u._credentials.username not in self._registered_users:
-                        print(f"Adding {u._credentials.username} to active users")
-                        self._registered_users[u._credentials.username] = u
-                        print("Updated Array")
-                        return
-                    
-                if payload is not None and payload.get("logout") == u._credentials.username:
-                    if u._credentials.username in self._registered_users:
-                        if u._credentials.username in self._active_connections:
-                            payload = {
-                                "type": "cmd",
-                                "data": "rejected"
-                            }
-                            print(f"Sending Logout Command to {u._credentials.username}")
-                            await self._registered_users[u._credentials.username]._active_connection.send_text(json.dumps(payload))
+        if "bulk" in payload:
+            for entry in payload["bulk"]:
+                self._users.put(entry["user_id"], entry["username"], entry["approved"])
+            print(f"{payload['action']}: updated {len(payload['bulk'])} users")
+            if payload["action"] == "reject":
+                for entry in payload["bulk"]:
+                    await self.send_logout(entry["username"])
+            return
 
-        
-        return
+        if "logout" in payload:
+            await self.send_logout(payload["logout"])
+            return
+
+        for action in ("adding", "approve", "reject"):
+            if action in payload:
+                username = payload[action]
+                break
+        else:
+            return
+
+        user_id = payload.get("user_id")
+        approved = payload.get("approved")
+        if user_id is None or approved is None:
+            row = await self._db.get_user_record(username)
+            if row is None:
+                return
+            user_id, _, approved = row
 
+        if action == "adding":
+            if username not in self._users:
+                print(f"Adding {username} to active users")
+                self._users.put(user_id, username, approved)
+            return
+
+        self._users.put(user_id, username, approved)
+        print(f"{'approved' if approved else 'rejected'} {username}")
+        if action == "reject":
+            await self.send_logout(username)
+
+    async def invalidate_inbox(self, _, payload):
+        self._inbox.invalidate(payload.get("added", []) + payload.get("removed", []))
+
+    async def send_logout(self, username: str) -> None:
+        conn = self._users.connection(username)
+        if conn is None:
+            return
+        payload = {
+            "type": "cmd",
+            "data": "rejected"
+        }
+        print(f"Sending Logout Command to {username}")
+        await self.send_frame(conn, payload)
 
+    async def send_frame(self, conn: Connection, obj) -> None:
+        await send_encoded(conn.ws, conn.codec.encode(obj))
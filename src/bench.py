@@ -0,0 +1,1580 @@
+"""
+Micro and load benchmarks for the backend. Every command builds its own
+throw-away database in a temp directory, so nothing here touches database.db.
+
+    python bench.py <command> --help
+"""
+import asyncio, time, tempfile, random, typer, io, contextlib, gc, tracemalloc, json, sys
+from pathlib import Path
+from typing import Iterator
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse
+from database_wrapper import DBWrapper
+from db_objects import User
+from admission import AdmissionController, AdmissionRejected
+from metrics import MetricsRegistry, METRICS
+from static_assets import StaticAssetCache
+from user_registry import UserRegistry, UserRecord
+from backend import Backend
+from envwrap import EnvParam
+from paths import PathWrap
+from wire import JSON_CODEC, DeflateJsonCodec, MsgPackCodec, msgpack, SUBPROTOCOL_JSON_DEFLATE, SUBPROTOCOL_MSGPACK
+from ratelimit import RateLimiter, MODES, DROP, DISCONNECT
+from heartbeat import HeartbeatMonitor
+from storage import Storage, STORAGE_ENGINES
+from storage_conformance import run_conformance
+from db_consts import ConversationType
+from bulk import seed as seed_dataset, import_ndjson
+from recorder import read_recording, recorded_world
+from memory import resident_bytes, task_counts
+from frames import CHAT_FRAME, BatchFrame, InvalidFrame
+from pydantic import ValidationError
+from maintenance import backup as backup_db
+import zlib, string, sqlite3, itertools
+from datetime import datetime
+app = typer.Typer()
+
+
+@app.callback()
+def main():
+    """Backend benchmarks."""
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(title: str, latencies: list[float], elapsed: float, **extra):
+    typer.echo(f"--- {title}")
+    typer.echo(f"  done: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed if elapsed else 0:.0f}/s)")
+    typer.echo(f"  p50: {percentile(latencies, 0.5) * 1000:.1f}ms  "
+               f"p99: {percentile(latencies, 0.99) * 1000:.1f}ms  "
+               f"max: {max(latencies, default=0) * 1000:.1f}ms")
+    for k, v in extra.items():
+        typer.echo(f"  {k}: {v}")
+
+
+async def seed_users(db: Storage, count: int, prefix: str = "bench", approved: bool = True) -> list[str]:
+    names = [f"{prefix}{i}" for i in range(count)]
+    if not isinstance(db, DBWrapper):
+        for n in names:
+            await db.add_user(n, "pw", approved)
+        return names
+    async with db.get_connection() as conn:
+        await conn.executemany(
+            "INSERT INTO users (username, password, approved) VALUES (?, ?, ?)",
+            ((n, "pw", int(approved)) for n in names),
+        )
+        await conn.commit()
+    return names
+
+
+async def fresh_db(tmp: str) -> DBWrapper:
+    db = DBWrapper(db_path=str(Path(tmp) / "bench.db"))
+    await db.init_db()
+    return db
+
+
+def make_backend(tmp: str, **env) -> Backend:
+    paths = PathWrap()
+    paths.db_file = Path(tmp) / "bench.db"
+    paths.build = Path(tmp) / "build"
+    paths.attachments = Path(tmp) / "attachments"
+    params = EnvParam(HOST="127.0.0.1", PORT="0", ALLOWED_ORIGINS="", ALL_PATHS=paths,
+                      BEARER_TOKEN="bench", TENOR_API="", GIPHY_API="", **env)
+    return Backend(FastAPI(), params)
+
+
+class FakeSocket():
+    """Just enough of a starlette WebSocket for the fan-out path."""
+    def __init__(self, name: str = "client"):
+        self.client = (name, 0)
+        self.scope = {"subprotocols": []}
+        self.sent = 0
+        self.sent_bytes = 0
+        self.closed = False
+
+    async def send_text(self, data: str):
+        self.sent += 1
+        self.sent_bytes += len(data)
+
+    async def send_bytes(self, data: bytes):
+        self.sent += 1
+        self.sent_bytes += len(data)
+
+    async def close(self, code: int = 1000, reason: str | None = None):
+        self.closed = True
+
+
+async def asgi_request(app, method: str, path: str, headers: dict | None = None, body: bytes | Iterator[bytes] = b"",
+                       query: str = "", keep_body: bool = True) -> tuple[int, dict, bytes | int]:
+    """
+    Drive an ASGI app in-process, no sockets involved. ``body`` may be an iterator
+    of chunks, sent as a streamed request. Without ``keep_body`` only the length
+    of the response body is returned.
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "", "server": ("bench", 80), "client": ("bench", 1),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    parts = iter([body]) if isinstance(body, bytes) else iter(body)
+    pending = next(parts, b"")
+    done = False
+    status, response_headers, chunks, length = 0, {}, [], 0
+
+    async def receive():
+        nonlocal pending, done
+        if not done:
+            chunk, pending = pending, next(parts, None)
+            done = pending is None
+            return {"type": "http.request", "body": chunk, "more_body": not done}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status, response_headers, length
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            response_headers = {k.decode(): v.decode() for k, v in message["headers"]}
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            length += len(chunk)
+            if keep_body:
+                chunks.append(chunk)
+
+    await app(scope, receive, send)
+    return status, response_headers, b"".join(chunks) if keep_body else length
+
+
+class AsgiWebSocket():
+    """The websocket counterpart of ``asgi_request``, a client session against an ASGI app in-process."""
+    def __init__(self, app, path: str, subprotocols: list[str] | None = None, client: tuple[str, int] = ("bench", 1)):
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self.subprotocol = None
+        scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "ws",
+            "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+            "server": ("bench", 80), "client": client, "headers": [],
+            "subprotocols": subprotocols or [],
+        }
+        self._to_app.put_nowait({"type": "websocket.connect"})
+        self._task = asyncio.create_task(app(scope, self._to_app.get, self._send))
+        # a handler that returns without closing still ends the connection, as under uvicorn
+        self._task.add_done_callback(lambda _: self._from_app.put_nowait({"type": "websocket.close"}))
+
+    async def _send(self, message: dict) -> None:
+        if message["type"] == "websocket.close":
+            # like a server, answer the close so the handler's pending receive ends
+            self._to_app.put_nowait({"type": "websocket.disconnect", "code": message.get("code", 1000)})
+        await self._from_app.put(message)
+
+    async def connect(self) -> bool:
+        message = await self._from_app.get()
+        self.subprotocol = message.get("subprotocol")
+        return message["type"] == "websocket.accept"
+
+    def send(self, data: str | bytes) -> None:
+        key = "text" if isinstance(data, str) else "bytes"
+        self._to_app.put_nowait({"type": "websocket.receive", key: data})
+
+    async def receive(self) -> dict | None:
+        """The next frame as a ``websocket.send`` message, None once the server closed."""
+        message = await self._from_app.get()
+        return message if message["type"] == "websocket.send" else None
+
+    async def close(self) -> None:
+        self._to_app.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+# -------------------------------------------------
+# Reconnect storm / admission control
+# -------------------------------------------------
+async def _auth_phase(db: Storage, username: str):
+    # what the /ws/chat handler does before AUTH_SUCCESS
+    await db.authenticate(username, "pw", "", datetime.now())
+
+
+async def _legacy_auth_phase(db: DBWrapper, username: str):
+    # the chain of calls the handler made before authenticate() existed
+    incoming_user = User(username, "pw", "")
+    await incoming_user.set_id(db)
+    await db.login(incoming_user)
+    row = await db.get_user(username)
+    current_user = UserRecord(row["id"], row["username"], row["approved"])
+    await db.create_session_id(current_user)
+    await db.find_unread_messages(current_user)
+
+
+async def _storm(db: DBWrapper, names: list[str], controller: AdmissionController | None, time_scale: float):
+    latencies, auth_times = [], []
+    failures = retries = 0
+
+    async def client(name: str):
+        nonlocal failures, retries
+        await asyncio.sleep(random.uniform(0, 0.05))
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                if controller is None:
+                    t0 = time.perf_counter()
+                    await _auth_phase(db, name)
+                    auth_times.append(time.perf_counter() - t0)
+                else:
+                    async with controller.admit(attempt):
+                        t0 = time.perf_counter()
+                        await _auth_phase(db, name)
+                        auth_times.append(time.perf_counter() - t0)
+                latencies.append(time.perf_counter() - start)
+                return
+            except AdmissionRejected as e:
+                retries += 1
+                attempt += 1
+                await asyncio.sleep(e.retry_after * time_scale)
+            except Exception:
+                failures += 1
+                return
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in names))
+    return latencies, auth_times, failures, retries, time.perf_counter() - start
+
+
+@app.command("admission")
+def admission(clients: int = 5000,
+              concurrency: int = 16,
+              queue_limit: int = 512,
+              time_scale: float = 0.1,
+              unbounded: bool = typer.Option(True, help="also run the storm without admission control")):
+    """
+    Simulated reconnect storm: every client runs the full auth phase at once.
+    Retry-after hints are multiplied by --time-scale to keep the run short.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = await fresh_db(tmp)
+            names = await seed_users(db, clients)
+
+            if unbounded:
+                lat, auth, failures, _, elapsed = await _storm(db, names, None, time_scale)
+                report("unbounded", lat, elapsed, auth_p99_ms=f"{percentile(auth, 0.99) * 1000:.1f}", failures=failures)
+
+            registry = MetricsRegistry()
+            controller = AdmissionController(concurrency, queue_limit, metrics=registry)
+            lat, auth, failures, retries, elapsed = await _storm(db, names, controller, time_scale)
+            snap = registry.snapshot()
+            report(f"admission (concurrency={concurrency}, queue={queue_limit})", lat, elapsed,
+                   auth_p99_ms=f"{percentile(auth, 0.99) * 1000:.1f}",
+                   failures=failures,
+                   retries=retries,
+                   peak_queue_depth=snap["admission_queue_depth_peak"],
+                   wait_p99_s=snap["admission_wait_seconds"]["p99"])
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Static assets
+# -------------------------------------------------
+def _fake_build(root: Path):
+    static = root / "static"
+    (static / "js").mkdir(parents=True)
+    (static / "css").mkdir(parents=True)
+    (root / "index.html").write_text("<!doctype html><html><head><script src=\"/static/js/main.1a2b3c4d.js\"></script></head>"
+                                     "<body><div id=\"root\"></div></body></html>")
+    js = "".join(f"function component{i}(props){{return React.createElement('div',{{key:{i}}},props.children)}}\n" for i in range(4000))
+    (static / "js" / "main.1a2b3c4d.js").write_text(js)
+    css = "".join(f".class-{i}{{margin:{i % 16}px;padding:{i % 8}px;color:#{i % 4096:03x}}}\n" for i in range(3000))
+    (static / "css" / "main.5e6f7a8b.css").write_text(css)
+
+
+def _current_static_app(build: Path) -> FastAPI:
+    # the handlers as they were before the asset cache
+    app = FastAPI()
+
+    @app.get("/")
+    async def serve_index():
+        return FileResponse(str(build / "index.html"))
+
+    @app.get("/{full_path:path}")
+    async def serve_catch_all(full_path: str):
+        print(full_path)
+        file_path = build / full_path
+        if file_path.exists() and file_path.is_file():
+            print("exist")
+            return FileResponse(str(file_path))
+        else:
+            print("does not exist")
+            raise HTTPException(status_code=404, detail="File not found")
+    return app
+
+
+def _cached_static_app(build: Path) -> FastAPI:
+    app = FastAPI()
+    cache = StaticAssetCache(build)
+    cache.load()
+
+    @app.get("/")
+    async def serve_index(request: Request):
+        return cache.response("index.html", request.headers)
+
+    @app.get("/{full_path:path}")
+    async def serve_catch_all(full_path: str, request: Request):
+        response = cache.response(full_path, request.headers)
+        if response is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        return response
+    return app
+
+
+@app.command("static")
+def static(requests: int = 3000, revalidate: float = typer.Option(0.5, help="share of requests sent with If-None-Match")):
+    """
+    Page loads (index + js + css) against the current FileResponse handlers and the asset cache.
+    """
+    paths = ["/", "/static/js/main.1a2b3c4d.js", "/static/css/main.5e6f7a8b.css"]
+
+    async def drive(app, title):
+        etags, latencies, transferred = {}, [], 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(requests):
+                path = paths[i % len(paths)]
+                headers = {"accept-encoding": "gzip, deflate, br"}
+                if path in etags and random.random() < revalidate:
+                    headers["if-none-match"] = etags[path]
+                t0 = time.perf_counter()
+                status, response_headers, body = await asgi_request(app, "GET", path, headers)
+                latencies.append(time.perf_counter() - t0)
+                transferred += len(body)
+                if "etag" in response_headers:
+                    etags[path] = response_headers["etag"]
+        report(title, latencies, time.perf_counter() - start, bytes_sent=f"{transferred / 1024:.0f} KiB")
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            build = Path(tmp)
+            _fake_build(build)
+            await drive(_current_static_app(build), "current handlers")
+            await drive(_cached_static_app(build), "asset cache")
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# User registry
+# -------------------------------------------------
+async def _load_legacy(db: DBWrapper):
+    users = await db.get_all_users()
+    return {u._credentials.username: u for u in users}
+
+
+async def _load_registry(db: DBWrapper):
+    users = UserRegistry()
+    async for rows in db.iter_user_records():
+        users.load(rows)
+    return users
+
+
+async def _measure(loader, db: DBWrapper) -> tuple[float, float]:
+    gc.collect()
+    start = time.perf_counter()
+    result = await loader(db)
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+
+    tracemalloc.start()
+    result = await loader(db)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return elapsed, retained
+
+
+@app.command("registry")
+def registry(sizes: str = "10000,100000,1000000",
+             legacy_max: int = typer.Option(1000000, help="skip the User-object loader above this many users")):
+    """
+    Startup time and retained memory of the user registry versus dict[str, User].
+    """
+    async def run():
+        for size in (int(x) for x in sizes.split(",")):
+            with tempfile.TemporaryDirectory() as tmp:
+                db = await fresh_db(tmp)
+                await seed_users(db, size, prefix="registry_user_")
+                typer.echo(f"--- {size} users")
+                if size <= legacy_max:
+                    elapsed, retained = await _measure(_load_legacy, db)
+                    typer.echo(f"  dict[str, User]: {elapsed:.2f}s  {retained / 2**20:.1f} MiB  ({retained / size:.0f} B/user)")
+                elapsed, retained = await _measure(_load_registry, db)
+                typer.echo(f"  UserRegistry:    {elapsed:.2f}s  {retained / 2**20:.1f} MiB  ({retained / size:.0f} B/user)")
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Admin operations against a large registry
+# -------------------------------------------------
+async def _reload_and_scan(backend: Backend, payload: dict):
+    # what update_user_array did before events carried the user: reload everything, then scan
+    users = await backend._db.get_all_users()
+    for u in users:
+        if payload.get("approve") == u._credentials.username:
+            backend._users.put(0, u._credentials.username, True)
+            return
+
+
+@app.command("admin")
+def admin(users: int = 100000, operations: int = 50):
+    """
+    Approve/reject cycles on a big user table, full reload per event versus in-place patching.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, users, prefix="admin_user_", approved=False)
+            await backend.create_tables_at_startup()
+            targets = random.sample(names, operations)
+            # the listener is driven by hand so its cost is measured with the request
+            db.event_handler.remove_listener(db.add_user_event, backend.update_user_array)
+
+            latencies = []
+            start = time.perf_counter()
+            for name in targets:
+                t0 = time.perf_counter()
+                await db.approve_user(name)
+                await _reload_and_scan(backend, {"approve": name})
+                latencies.append(time.perf_counter() - t0)
+            report(f"full reload per event ({users} users)", latencies, time.perf_counter() - start)
+
+            latencies = []
+            start = time.perf_counter()
+            for name in targets:
+                t0 = time.perf_counter()
+                user_id = await db.reject_user(name)
+                await backend.update_user_array(db.add_user_event, {"reject": name, "user_id": user_id, "approved": False})
+                latencies.append(time.perf_counter() - t0)
+            report(f"incremental patch ({users} users)", latencies, time.perf_counter() - start)
+            await db.event_handler.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Bulk membership
+# -------------------------------------------------
+@app.command("bulk_members")
+def bulk_members(members: int = 1000):
+    """
+    Add members to a group one /api/add_participant call at a time versus one bulk call.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = await fresh_db(tmp)
+            names = await seed_users(db, members * 2, prefix="member_")
+            async with db.get_connection() as conn:
+                for name in ("single", "bulk"):
+                    await conn.execute("INSERT INTO conversations (name, type) VALUES (?, 'group')", (name,))
+                await conn.commit()
+
+            latencies = []
+            start = time.perf_counter()
+            for name in names[:members]:
+                t0 = time.perf_counter()
+                # what add_participant_to_grp does per request
+                user_row = await db.get_user(name)
+                await db.create_participants(1, user_row["id"])
+                latencies.append(time.perf_counter() - t0)
+            report(f"{members} x add_participant", latencies, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            results = await db.add_participants_bulk(2, names[members:])
+            elapsed = time.perf_counter() - start
+            report("1 x add_participants", [elapsed], elapsed,
+                   added=sum(1 for state in results.values() if state == "added"))
+            await db.event_handler.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Wire formats
+# -------------------------------------------------
+def chat_messages(count: int, seed: int = 7) -> list[dict]:
+    """A chat-like mix: mostly short lines, some paragraphs, a few pastes and GIF links."""
+    rnd = random.Random(seed)
+    words = ["hey", "ok", "lol", "the", "deploy", "is", "done", "see", "you", "tomorrow", "what", "about",
+             "this", "bug", "in", "prod", "thanks", "nice", "meeting", "at", "three", "can", "you", "check"]
+    messages = []
+    for i in range(count):
+        roll = rnd.random()
+        if roll < 0.75:
+            text = " ".join(rnd.choices(words, k=rnd.randint(1, 12)))
+        elif roll < 0.92:
+            text = " ".join(rnd.choices(words, k=rnd.randint(40, 120)))
+        elif roll < 0.97:
+            text = "\n".join("".join(rnd.choices(string.ascii_letters + "(){};= ", k=60)) for _ in range(rnd.randint(20, 80)))
+        else:
+            text = f"https://media.giphy.com/media/{''.join(rnd.choices(string.ascii_letters, k=18))}/giphy.gif"
+        room = rnd.randint(1, 50)
+        messages.append({
+            "type": "message",
+            "data": {"msg": text},
+            "from": f"user{rnd.randint(1, 200)}",
+            "room_id": room,
+            "room_name": f"room {room}",
+            "chat_type": "group" if room % 3 else "direct",
+        })
+    return messages
+
+
+class PerMessageDeflate():
+    """Transport compression like permessage-deflate with context takeover on one connection."""
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+    def compress(self, frame: bytes) -> bytes:
+        return (self._compressor.compress(frame) + self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress(self, frame: bytes) -> bytes:
+        return self._decompressor.decompress(frame + b"\x00\x00\xff\xff")
+
+
+@app.command("wire")
+def wire(messages: int = 20000, deflate_threshold: int = 1024):
+    """
+    Bytes on the wire and encode/decode CPU per message for each /ws/chat mode.
+    """
+    stream = chat_messages(messages)
+    modes = [("json", JSON_CODEC, False), ("json + permessage-deflate", JSON_CODEC, True),
+             (f"s3chat.json.deflate (threshold {deflate_threshold})", DeflateJsonCodec(deflate_threshold), False)]
+    if msgpack is not None:
+        modes += [("s3chat.msgpack", MsgPackCodec(), False), ("s3chat.msgpack + permessage-deflate", MsgPackCodec(), True)]
+    else:
+        typer.echo("msgpack is not installed, skipping the msgpack modes")
+
+    for title, codec, transport_deflate in modes:
+        pmd = PerMessageDeflate() if transport_deflate else None
+        total = 0
+        encode_time = decode_time = 0.0
+        for msg in stream:
+            t0 = time.perf_counter()
+            frame = codec.encode(msg)
+            raw = frame.encode() if isinstance(frame, str) else frame
+            if pmd is not None:
+                raw = pmd.compress(raw)
+            t1 = time.perf_counter()
+            total += len(raw)
+            if pmd is not None:
+                raw = pmd.decompress(raw)
+            codec.decode({"bytes": raw} if isinstance(frame, bytes) else {"text": raw.decode()})
+            t2 = time.perf_counter()
+            encode_time += t1 - t0
+            decode_time += t2 - t1
+        typer.echo(f"--- {title}")
+        typer.echo(f"  bytes/msg: {total / messages:.0f}  "
+                   f"encode: {encode_time / messages * 1e6:.1f}us  decode: {decode_time / messages * 1e6:.1f}us")
+
+    # a deflate bomb has to be refused at the limit, not inflated
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    chunk = b"0" * (1 << 20)
+    bomb = compressor.compress(b'{"type": "ping", "pad": "') + b"".join(compressor.compress(chunk) for _ in range(64))
+    bomb += compressor.flush()
+    t0 = time.perf_counter()
+    try:
+        DeflateJsonCodec().decode({"bytes": bomb}, CHAT_FRAME)
+        refused = None
+    except InvalidFrame as e:
+        refused = e.detail
+    typer.echo(f"--- deflate bomb: {len(bomb)} bytes inflating to 64MB, "
+               f"{f'refused in {(time.perf_counter() - t0) * 1000:.1f}ms ({refused})' if refused else 'ACCEPTED'}")
+    if refused is None:
+        raise typer.Exit(1)
+
+
+# -------------------------------------------------
+# Batched inbound frames
+# -------------------------------------------------
+@app.command("batch")
+def batch(messages: int = 5000, batch_size: int = 50, rooms: int = 10, members: int = 20,
+          engine: str = typer.Option("sqlite", help=f"storage engine, one of {STORAGE_ENGINES}")):
+    """
+    Messages per second through Backend.handle_messages, one frame per message versus batch frames.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, STORAGE_ENGINE=engine)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, members)
+            await backend.create_tables_at_startup()
+            for i in range(rooms):
+                await db.create_conversation(f"room{i}", ConversationType.Group, 1)
+                await db.add_participants_bulk(i + 1, names)
+            for name in names:
+                backend._users.connect(backend._users.get(name), FakeSocket(name))
+            sender = backend._users.get(names[0])
+            stream = chat_messages(messages)
+            for m in stream:
+                m["room_id"] = random.randint(1, rooms)
+                m["from"] = sender.username
+
+            start = time.perf_counter()
+            for m in stream:
+                await backend.handle_messages([m], sender)
+            elapsed = time.perf_counter() - start
+            typer.echo(f"--- single frames: {messages / elapsed:.0f} msg/s ({elapsed:.2f}s)")
+
+            start = time.perf_counter()
+            for i in range(0, messages, batch_size):
+                await backend.handle_messages(stream[i:i + batch_size], sender)
+            elapsed = time.perf_counter() - start
+            typer.echo(f"--- batch frames of {batch_size}: {messages / elapsed:.0f} msg/s ({elapsed:.2f}s)")
+            await db.event_handler.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Rate limiting
+# -------------------------------------------------
+@app.command("ratelimit")
+def ratelimit(checks: int = 1_000_000,
+              keys: str = "100,10000,100000",
+              flood_seconds: float = 2.0,
+              rate: float = 20.0,
+              burst: float = 40.0):
+    """
+    Cost of one bucket check for growing key counts, then a client flooding at
+    full speed under every over-limit mode.
+    """
+    for key_count in (int(k) for k in keys.split(",")):
+        limiter = RateLimiter(f"bench{key_count}", rate=1e9, burst=1e9, max_keys=key_count * 2,
+                              metrics=MetricsRegistry())
+        ids = [random.randrange(key_count) for _ in range(checks)]
+        start = time.perf_counter()
+        for key in ids:
+            limiter.consume(key)
+        elapsed = time.perf_counter() - start
+        typer.echo(f"--- {key_count} keys: {elapsed / checks * 1e9:.0f} ns/check")
+
+    async def flood(mode: str):
+        limiter = RateLimiter(f"flood_{mode}", rate=rate, burst=burst, mode=mode, metrics=MetricsRegistry())
+        passed = rejected = 0
+        deadline = time.monotonic() + flood_seconds
+        while time.monotonic() < deadline:
+            if await limiter.admit("flooder"):
+                passed += 1
+            else:
+                rejected += 1
+                await asyncio.sleep(0)
+        typer.echo(f"--- flood, {mode}: {passed / flood_seconds:.1f} frames/s let through, "
+                   f"{rejected} turned away (limit {rate}/s, burst {burst})")
+
+    for mode in MODES:
+        asyncio.run(flood(mode))
+
+    async def oversized(mode: str) -> bool:
+        # one batch frame with more messages than the burst, then the bucket's debt
+        limiter = RateLimiter(f"oversized_{mode}", rate=rate, burst=burst, mode=mode, metrics=MetricsRegistry())
+        size = int(burst) * 3
+        first = await limiter.admit("batcher", size)
+        second = limiter.consume("batcher", 1)
+        typer.echo(f"--- batch of {size} > burst {burst:g}, {mode}: {'admitted' if first else 'REFUSED'}, "
+                   f"next frame waits {second:.2f}s")
+        return first and second > 0
+
+    if not all([asyncio.run(oversized(mode)) for mode in (DROP, DISCONNECT)]):
+        raise typer.Exit(1)
+
+
+# -------------------------------------------------
+# Heartbeats
+# -------------------------------------------------
+class DeadSocket(FakeSocket):
+    """A peer that went away without a close frame, every send fails."""
+    async def send_text(self, data: str):
+        raise ConnectionResetError("peer is gone")
+
+    async def send_bytes(self, data: bytes):
+        raise ConnectionResetError("peer is gone")
+
+
+@app.command("heartbeat")
+def heartbeat(clients: int = 10000,
+              dead: float = typer.Option(0.2, help="share of clients whose socket is gone"),
+              silent: float = typer.Option(0.3, help="share of clients that never answer a ping"),
+              interval: float = 30.0,
+              timeout: float = 90.0):
+    """
+    Thousands of connected clients, some dead and some silent, swept on a
+    simulated clock. Shows ping/reap counts, online users and sweep cost.
+    Exits 1 when a dead or silent client is still online after the timeout
+    or an active one was reaped.
+    """
+    async def run():
+        users = UserRegistry()
+        users.load((i, f"u{i}", True) for i in range(clients))
+        kinds = {}
+        for i in range(clients):
+            r = random.random()
+            kind = "dead" if r < dead else "silent" if r < dead + silent else "active"
+            kinds[f"u{i}"] = kind
+            users.connect(users.get(f"u{i}"), DeadSocket() if kind == "dead" else FakeSocket())
+
+        # never started, sweep() is driven by hand on the simulated clock
+        monitor = HeartbeatMonitor(interval=interval, timeout=timeout, users=users, metrics=MetricsRegistry())
+
+        t0 = time.monotonic()
+        counts = {kind: sum(1 for k in kinds.values() if k == kind) for kind in ("active", "silent", "dead")}
+        typer.echo(f"--- {clients} clients: {counts}")
+        for step in range(1, int(timeout // interval) + 2):
+            now = t0 + step * interval + 1
+            start = time.perf_counter()
+            pinged, reaped = await monitor.sweep(now)
+            elapsed = time.perf_counter() - start
+            for conn in users.online():
+                if kinds[conn.user.username] == "active":
+                    conn.last_seen = now
+            online = {kind: 0 for kind in counts}
+            for conn in users.online():
+                online[kinds[conn.user.username]] += 1
+            typer.echo(f"  t+{now - t0:.0f}s: pinged {pinged}, reaped {reaped}, "
+                       f"sweep {elapsed * 1000:.1f}ms, still online {online}")
+
+        # past the timeout every dead and silent client is gone and every active one is left
+        failures = []
+        if online["dead"] or online["silent"]:
+            failures.append(f"not reaped: {online['dead']} dead, {online['silent']} silent")
+        if online["active"] != counts["active"]:
+            failures.append(f"{counts['active'] - online['active']} active clients reaped")
+        return failures
+
+    failures = asyncio.run(run())
+    for failure in failures:
+        typer.echo(f"FAIL {failure}")
+    raise typer.Exit(1 if failures else 0)
+
+
+# -------------------------------------------------
+# Storage engines
+# -------------------------------------------------
+@app.command("conformance")
+def conformance(engines: str = ",".join(STORAGE_ENGINES)):
+    """
+    Run the storage conformance checks against every engine, exits non-zero on a failure.
+    """
+    failed = 0
+    for engine in engines.split(","):
+        for name, error in asyncio.run(run_conformance(engine)):
+            typer.echo(f"{engine:8} {name:32} {error or 'ok'}")
+            failed += error is not None
+    if failed:
+        raise typer.Exit(code=1)
+
+
+# -------------------------------------------------
+# Login unit of work
+# -------------------------------------------------
+@app.command("login")
+def login(users: int = 2000, groups: int = 20, logins: int = 500, concurrency: int = 16):
+    """
+    Login latency and logins per second, the old chain of storage calls versus
+    DBWrapper.authenticate. Every user is in --groups groups with unread messages.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = await fresh_db(tmp)
+            names = await seed_users(db, users)
+            async with db.get_connection() as conn:
+                await conn.executemany("INSERT INTO conversations (name, type) VALUES (?, 'group')",
+                                       ((f"group{i}",) for i in range(groups)))
+                await conn.executemany("INSERT INTO participants (conversation_id, user_id) VALUES (?, ?)",
+                                       ((g, u) for g in range(1, groups + 1) for u in range(1, users + 1)))
+                await conn.executemany("INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, 'hi')",
+                                       ((g, 1 + g % users) for g in range(1, groups + 1)))
+                await conn.commit()
+            sample = random.sample(names, min(logins, len(names)))
+
+            for title, phase in (("chained calls", _legacy_auth_phase), ("authenticate", _auth_phase)):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    latencies = []
+                    start = time.perf_counter()
+                    for name in sample:
+                        t0 = time.perf_counter()
+                        await phase(db, name)
+                        latencies.append(time.perf_counter() - t0)
+                    sequential = time.perf_counter() - start
+
+                    gate = asyncio.Semaphore(concurrency)
+
+                    async def one(name):
+                        async with gate:
+                            await phase(db, name)
+
+                    start = time.perf_counter()
+                    await asyncio.gather(*(one(name) for name in sample))
+                    concurrent = time.perf_counter() - start
+                report(title, latencies, sequential,
+                       logins_per_s_sequential=f"{len(sample) / sequential:.0f}",
+                       logins_per_s_concurrent=f"{len(sample) / concurrent:.0f} ({concurrency} at a time)")
+            await db.event_handler.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Attachments
+# -------------------------------------------------
+def _upload_chunks(size: int, seed: int, chunk: int = 64 * 1024) -> Iterator[bytes]:
+    # like uvicorn, the body arrives in socket-sized pieces; the content is made on the fly
+    block = random.Random(seed).randbytes(chunk)
+    for offset in range(0, size, chunk):
+        yield block[: min(chunk, size - offset)]
+
+
+@app.command("attachments")
+def attachments(size_mb: int = 100, range_mb: int = 1):
+    """
+    Stream a --size-mb upload through POST /api/attachments, upload it again to
+    hit the dedupe path, then download it whole and as a Range. Peak Python
+    memory of the upload is measured in a separate pass with tracemalloc.
+    """
+    size = size_mb * 1024 * 1024
+    headers = {"Authorization": "Bearer bench", "Content-Type": "application/octet-stream",
+               "Content-Length": str(size)}
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, ATTACHMENT_MAX_SIZE=size * 2)
+            api = backend._app
+
+            for title, seed in (("upload", 1), ("upload, same bytes again", 1)):
+                start = time.perf_counter()
+                status, _, body = await asgi_request(api, "POST", "/api/attachments", headers, _upload_chunks(size, seed))
+                elapsed = time.perf_counter() - start
+                reference = json.loads(body)
+                typer.echo(f"--- {title}: {status} {size_mb / elapsed:.0f} MB/s ({elapsed:.2f}s), "
+                           f"deduplicated={reference['deduplicated']}")
+
+            tracemalloc.start()
+            await asgi_request(api, "POST", "/api/attachments", headers, _upload_chunks(size, 2))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            typer.echo(f"--- upload peak Python memory: {peak / 1024 / 1024:.1f} MB for a {size_mb} MB body")
+
+            path = f"/api/attachments/{reference['id']}"
+            start = time.perf_counter()
+            status, _, length = await asgi_request(api, "GET", path, {"Authorization": "Bearer bench"}, keep_body=False)
+            elapsed = time.perf_counter() - start
+            typer.echo(f"--- download: {status} {length / 1024 / 1024 / elapsed:.0f} MB/s ({elapsed:.2f}s)")
+
+            first = size // 2
+            last = first + range_mb * 1024 * 1024 - 1
+            start = time.perf_counter()
+            status, response_headers, length = await asgi_request(
+                api, "GET", path, {"Authorization": "Bearer bench", "Range": f"bytes={first}-{last}"}, keep_body=False)
+            elapsed = time.perf_counter() - start
+            typer.echo(f"--- range {response_headers.get('content-range')}: {status} {length} bytes in {elapsed * 1000:.1f}ms")
+            backend._attachments.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Online backup
+# -------------------------------------------------
+@app.command("backup")
+def backup(messages: int = 500_000, write_every_ms: float = 20.0, pages: int = 256):
+    """
+    Back up a seeded database while a writer persists one message every
+    --write-every-ms, in WAL mode and with a rollback journal (--pages steps).
+    Reports writer latency, event-loop lag and backup step durations.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            db = await fresh_db(tmp)
+            await asyncio.to_thread(seed_dataset, db.db_path, users=5000, groups=500, directs=5000, messages=messages)
+            sender = UserRecord(1, "user1", True)
+            typer.echo(f"--- database: {Path(db.db_path).stat().st_size / 1024 / 1024:.0f} MB")
+
+            for journal_mode in ("wal", "delete"):
+                with contextlib.closing(sqlite3.connect(db.db_path)) as conn:
+                    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+                metrics = MetricsRegistry()
+                writes, lags = [], []
+                done = asyncio.Event()
+
+                async def writer():
+                    while not done.is_set():
+                        t0 = time.perf_counter()
+                        await db.add_messages_to_history([{"room_id": 1, "data": {"msg": "hi"}}], sender)
+                        writes.append(time.perf_counter() - t0)
+                        await asyncio.sleep(write_every_ms / 1000)
+
+                async def lag_probe():
+                    while not done.is_set():
+                        t0 = time.perf_counter()
+                        await asyncio.sleep(0.005)
+                        lags.append(time.perf_counter() - t0 - 0.005)
+
+                tasks = [asyncio.create_task(writer()), asyncio.create_task(lag_probe())]
+                start = time.perf_counter()
+                result = await backup_db(db.db_path, Path(tmp) / "backup.db", pages=pages, metrics=metrics)
+                elapsed = time.perf_counter() - start
+                done.set()
+                await asyncio.gather(*tasks)
+                steps = metrics.histogram("backup_step_seconds")
+                report(f"backup, journal_mode={journal_mode}, writer latency", writes, elapsed,
+                       backup=f"{result['steps']} steps, {result['restarts']} restarts, "
+                              f"step p50 {steps.quantile(0.5) * 1000:.0f}ms max {steps.max * 1000:.0f}ms",
+                       loop_lag_max=f"{max(lags, default=0) * 1000:.1f}ms")
+            await db.event_handler.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Recent messages ring
+# -------------------------------------------------
+@app.command("recent")
+def recent(messages: int = 200_000, operations: int = 20_000, send_pct: int = 30, skew: float = 1.1,
+           cap_mb: int = 64, check_every: int = 10):
+    """
+    Room opens (first and second page) mixed with sends on a seeded database,
+    rooms picked with Zipf --skew. Every --check-every open is compared with
+    what storage returns. Opens are timed through the ring and straight from storage.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, RECENT_MESSAGES_MAX_BYTES=cap_mb * 1024 * 1024)
+            db = backend._db
+            await db.init_db()
+            await asyncio.to_thread(seed_dataset, db.db_path, users=2000, groups=200, directs=2000, messages=messages)
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            with contextlib.closing(sqlite3.connect(db.db_path)) as conn:
+                members: dict[int, list[int]] = {}
+                for conversation_id, user_id in conn.execute("SELECT conversation_id, user_id FROM participants"):
+                    members.setdefault(conversation_id, []).append(user_id)
+            rooms = sorted(members)
+            rnd = random.Random(1)
+            rnd.shuffle(rooms)
+            cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** skew for rank in range(len(rooms))))
+
+            ring_times, storage_times = [], []
+            sends = mismatches = 0
+            start = time.perf_counter()
+            for op, room in enumerate(rnd.choices(rooms, cum_weights=cum_weights, k=operations)):
+                if rnd.randrange(100) < send_pct:
+                    sender = backend._users.get_by_id(rnd.choice(members[room]))
+                    await backend.handle_messages([{"type": "message", "data": {"msg": f"m{op}"}, "from": sender.username,
+                                                    "room_id": room, "room_name": "", "chat_type": "group"}], sender)
+                    sends += 1
+                    continue
+                t0 = time.perf_counter()
+                page = await backend.history_page(room)
+                older = await backend.history_page(room, page[0]["content"]) if page else []
+                ring_times.append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                expected = await db.get_messages_from(room)
+                expected_older = await db.get_messages_from(room, expected[0]["content"]) if expected else []
+                storage_times.append(time.perf_counter() - t0)
+                if op % check_every == 0 and (page, older) != (expected, expected_older):
+                    mismatches += 1
+            elapsed = time.perf_counter() - start
+
+            snapshot = METRICS.snapshot()
+            hits, misses = snapshot["recent_messages_hits_total"], snapshot["recent_messages_misses_total"]
+            report("opens through the ring (2 pages)", ring_times, elapsed,
+                   hit_rate=f"{hits / max(hits + misses, 1):.1%} ({hits} hits, {misses} misses)",
+                   rings=f"{snapshot['recent_messages_conversations']} conversations, "
+                         f"{snapshot['recent_messages_bytes'] / 1024 / 1024:.1f} MB, "
+                         f"{snapshot['recent_messages_evictions_total']} evictions",
+                   sends=sends, mismatches=mismatches)
+            report("the same opens from storage", storage_times, sum(storage_times))
+            await backend.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Conditional GET
+# -------------------------------------------------
+@app.command("etag")
+def etag(polls: int = 2000, groups: int = 50, members: int = 500):
+    """
+    Poll /api/get_groups and /api/get_participants the way clients do: without
+    a tag against the old always-query path, with a tag that still matches (304)
+    and right after a membership change (cached miss, then cache hits).
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, members)
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            for i in range(groups):
+                await db.create_conversation(f"group{i}", ConversationType.Group, 1)
+            await db.add_participants_bulk(1, names)
+            api = backend._app
+            auth = {"Authorization": "Bearer bench"}
+
+            for path, query in ((f"/api/get_groups{names[0]}", lambda: db.get_user_groups(names[0])),
+                                ("/api/get_participants1", lambda: db.get_participants_from_convo(1))):
+                _, headers, body = await asgi_request(api, "GET", path, auth)
+                tag = headers["etag"]
+                for title, request_headers in (("storage on every poll (before)", None),
+                                               ("no If-None-Match, cached body", auth),
+                                               ("If-None-Match matches, 304", {**auth, "If-None-Match": tag})):
+                    latencies = []
+                    start = time.perf_counter()
+                    for _ in range(polls):
+                        t0 = time.perf_counter()
+                        if request_headers is None:
+                            JSONResponse(jsonable_encoder(await query())).body
+                        else:
+                            status, _, _ = await asgi_request(api, "GET", path, request_headers)
+                        latencies.append(time.perf_counter() - t0)
+                    report(f"{path}: {title}", latencies, time.perf_counter() - start, body_bytes=len(body))
+            await backend.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Profiling
+# -------------------------------------------------
+@app.command("profile")
+def profile(seconds: float = 3.0, stall_ms: float = 400.0, top: int = 5):
+    """
+    Clients poll /api/get_groups while a handler blocks the event loop once
+    for ``stall_ms``. Shows poll throughput with and without /debug/profile
+    sampling, the hottest collapsed stacks, loop lag and the stall the
+    watchdog attributed.
+    """
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, 200)
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            for i in range(20):
+                await db.create_conversation(f"group{i}", ConversationType.Group, 1)
+            await db.add_participants_bulk(1, names)
+            api = backend._app
+            auth = {"Authorization": "Bearer bench"}
+
+            async def poll(until: float) -> list[float]:
+                latencies = []
+                while time.monotonic() < until:
+                    t0 = time.perf_counter()
+                    await asgi_request(api, "GET", "/api/get_participants1", auth)
+                    latencies.append(time.perf_counter() - t0)
+                    # a real client waits on its socket, in-process requests never give up the loop
+                    await asyncio.sleep(0)
+                return latencies
+
+            async def blocking_handler():
+                await asyncio.sleep(seconds / 2)
+                time.sleep(stall_ms / 1000)  # the kind of call that shouldn't be on the loop
+
+            latencies = await poll(time.monotonic() + seconds)
+            report("polls, no profiler", latencies, seconds)
+
+            stall = asyncio.create_task(blocking_handler(), name="blocking-handler")
+            polls = asyncio.create_task(poll(time.monotonic() + seconds))
+            status, headers, body = await asgi_request(api, "GET", "/debug/profile", auth,
+                                                       query=f"seconds={seconds}&clock=wall")
+            latencies = await polls
+            await stall
+            report("polls while sampling every 5ms (wall clock)", latencies, seconds, profile_status=status,
+                   samples=headers.get("x-profile-samples"))
+
+            typer.echo(f"--- top {top} stacks (leaf frames)")
+            for line in body.decode().splitlines()[:top]:
+                stack, count = line.rsplit(" ", 1)
+                frames = stack.split(";")
+                typer.echo(f"  {count:>5}  {frames[0]}: ... {' <- '.join(reversed(frames[-3:]))}")
+
+            lag = METRICS.histogram("event_loop_lag_seconds")
+            typer.echo(f"--- loop lag p50 {lag.quantile(0.5) * 1000:.0f}ms p99 {lag.quantile(0.99) * 1000:.0f}ms, "
+                       f"stalls {METRICS.counter('event_loop_stalls_total').value}")
+            _, _, body = await asgi_request(api, "GET", "/debug/stalls", auth)
+            for entry in json.loads(body):
+                typer.echo(f"  {entry['stalled_for']}s+ in {entry['task']} ({entry['coroutine']}) at {entry['stack'][-1]}")
+            await backend.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Traffic recording and replay
+# -------------------------------------------------
+# endpoints that call third-party APIs, a replay shouldn't
+REPLAY_EXTERNAL = ("search_gifs", "search_gifs_with_pos")
+UNLIMITED = {"WS_RATE_LIMIT": 1e9, "WS_RATE_BURST": 1e9, "AUTH_RATE_LIMIT": 1e9, "AUTH_RATE_BURST": 1e9}
+
+
+@app.command("record")
+def record(out: str = "traffic.ndjson.gz", clients: int = 50, groups: int = 5, seconds: float = 10.0, seed: int = 7):
+    """
+    Record a synthetic session through the traffic recorder, to try replay
+    without production traffic: clients log in over /ws/chat at random times,
+    chat in groups and direct rooms, mostly single messages with the odd
+    burst, and poll their groups and rooms the way the web client does.
+    """
+    async def run():
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, TRAFFIC_RECORD_PATH=out, **UNLIMITED)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, clients)
+            rooms_of = {name: [] for name in names}
+            for i in range(groups):
+                await db.create_conversation(f"group{i}", ConversationType.Group, 1)
+                members = rng.sample(names, max(2, clients // 3))
+                await db.add_participants_bulk(i + 1, members)
+                for name in members:
+                    rooms_of[name].append((i + 1, f"group{i}", "group"))
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            api = backend._app
+            auth = {"Authorization": "Bearer bench", "Content-Type": "application/json"}
+            until = time.monotonic() + seconds
+
+            async def client(i: int, name: str):
+                await asyncio.sleep(rng.uniform(0, seconds / 4))
+                ws = AsgiWebSocket(api, "/ws/chat", client=(f"10.0.{i // 256}.{i % 256}", 40000 + i))
+                await ws.connect()
+                ws.send(json.dumps({"username": name, "password": "pw", "session_id": "", "attempt": 0}))
+                await ws.receive()
+                drain = asyncio.create_task(_drain(ws))
+                await asgi_request(api, "GET", f"/api/get_groups{name}", auth)
+                friend = rng.choice(names)
+                if friend != name:
+                    _, _, body = await asgi_request(api, "POST", "/api/get_room", auth,
+                                                    json.dumps({"user_a": name, "user_b": friend}).encode())
+                    rooms_of[name].append((json.loads(body)["room_id"], friend, "direct"))
+                while time.monotonic() < until and rooms_of[name]:
+                    room_id, room_name, chat_type = rng.choice(rooms_of[name])
+                    messages = [{"type": "message", "data": {"msg": " ".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 40)))},
+                                 "from": name, "room_id": room_id, "room_name": room_name, "chat_type": chat_type}
+                                for _ in range(rng.choice((1, 1, 1, 1, 3, 8)))]
+                    ws.send(json.dumps(messages[0] if len(messages) == 1 else {"type": "batch", "messages": messages}))
+                    if rng.random() < 0.2:
+                        await asgi_request(api, "GET", f"/api/get_room_msg{room_id}", auth)
+                    if rng.random() < 0.1 and chat_type == "group":
+                        await asgi_request(api, "GET", f"/api/get_participants{room_id}", auth)
+                    await asyncio.sleep(rng.expovariate(2.0))
+                await ws.close()
+                drain.cancel()
+
+            await asyncio.gather(*(client(i, name) for i, name in enumerate(names)))
+            await backend.shutdown()
+        typer.echo(f"recorded {clients} clients over {seconds:.0f}s to {out} ({Path(out).stat().st_size} bytes)")
+
+    asyncio.run(run())
+
+
+async def _drain(ws: AsgiWebSocket):
+    while await ws.receive() is not None:
+        pass
+
+
+def _replay_codec(subprotocol: str | None):
+    if subprotocol == SUBPROTOCOL_MSGPACK and msgpack is not None:
+        return MsgPackCodec()
+    if subprotocol == SUBPROTOCOL_JSON_DEFLATE:
+        return DeflateJsonCodec()
+    return JSON_CODEC
+
+
+@app.command("replay")
+def replay(recording: str,
+           speed: str = typer.Option("1", help="time factor, 1 is real time, 10 ten times faster, or max"),
+           concurrency: int = typer.Option(64, help="HTTP requests in flight at most"),
+           limits: bool = typer.Option(False, help="keep the websocket and login rate limits"),
+           external: bool = typer.Option(False, help="also replay calls to third-party APIs (GIF search)")):
+    """
+    Drive a fresh server from a recording made with TRAFFIC_RECORD_PATH: the
+    users and rooms it refers to are created first, then every API call and
+    websocket frame is sent at its recorded time divided by --speed, each
+    recorded connection over its own websocket. Reports HTTP latency per
+    endpoint, login latency, message delivery latency (send to arrival at
+    every connected member) and throughput.
+    """
+    entries = read_recording(recording)
+    scale = 0.0 if speed == "max" else 1 / float(speed)
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, **({} if limits else UNLIMITED))
+            await backend._db.init_db()
+            world = import_ndjson(backend._env.ALL_PATHS.db_file, io.BytesIO(recorded_world(entries)))
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            api = backend._app
+            headers = {"Authorization": "Bearer bench", "Content-Type": "application/json"}
+
+            connections: dict[str, list[dict]] = {}
+            requests_ = []
+            for entry in entries:
+                if entry["k"] == "http":
+                    if external or entry.get("r") not in REPLAY_EXTERNAL:
+                        requests_.append(entry)
+                else:
+                    connections.setdefault(entry["c"], []).append(entry)
+
+            http_latency: dict[str, list[float]] = {}
+            status_changed = 0
+            logins, deliveries = [], []
+            sent_at: dict[int, float] = {}
+            sequence = itertools.count()
+            counts = {"frames": 0, "messages": 0, "auth_failed": 0, "joined_late": 0}
+            gate = asyncio.Semaphore(concurrency)
+            start = time.perf_counter()
+
+            async def at(t: float):
+                delay = t * scale - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            async def http(entry: dict):
+                nonlocal status_changed
+                await at(entry["t"])
+                if entry.get("b") is not None:
+                    body = json.dumps(entry["b"]).encode()
+                else:
+                    body = _upload_chunks(entry.get("n", 0), entry["n"]) if entry.get("n") else b""
+                async with gate:
+                    t0 = time.perf_counter()
+                    status, _, _ = await asgi_request(api, entry["m"], entry["p"], headers, body,
+                                                      query=entry.get("q", ""), keep_body=False)
+                    http_latency.setdefault(entry.get("r") or entry["p"], []).append(time.perf_counter() - t0)
+                if status != entry.get("s"):
+                    status_changed += 1
+
+            async def receive(ws: AsgiWebSocket, codec):
+                while (message := await ws.receive()) is not None:
+                    frame = codec.decode(message)
+                    msg = frame.get("data", {}).get("msg") if isinstance(frame.get("data"), dict) else None
+                    if frame.get("type") == "message" and isinstance(msg, str) and msg.startswith("#"):
+                        sent = sent_at.get(int(msg[1:msg.index("#", 1)]))
+                        if sent is not None:
+                            deliveries.append(time.perf_counter() - sent)
+
+            def mark(frame: dict) -> dict:
+                # a sequence number in the text tells the receivers when it was sent
+                messages = frame.get("messages") if frame.get("type") == "batch" else [frame]
+                for m in messages or []:
+                    if isinstance(m, dict) and isinstance(m.get("data"), dict) and isinstance(m["data"].get("msg"), str):
+                        seq = next(sequence)
+                        marker = f"#{seq}#"
+                        m["data"]["msg"] = marker + m["data"]["msg"][len(marker):]
+                        sent_at[seq] = time.perf_counter()
+                        counts["messages"] += 1
+                return frame
+
+            async def connection(number: int, events: list[dict]):
+                if events[0]["k"] != "open":
+                    # connected before the recording started, its login isn't in it
+                    counts["joined_late"] += 1
+                    return
+                await at(events[0]["t"])
+                ws = AsgiWebSocket(api, "/ws/chat", [events[0]["sp"]] if events[0].get("sp") else [],
+                                   client=(f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}", 40000))
+                if not await ws.connect():
+                    counts["auth_failed"] += 1
+                    return
+                codec = _replay_codec(ws.subprotocol)
+                t0 = time.perf_counter()
+                ws.send(codec.encode(events[0]["f"]))
+                response = await ws.receive()
+                if response is None or codec.decode(response).get("state") != "AUTH_SUCCESS":
+                    counts["auth_failed"] += 1
+                    await ws.close()
+                    return
+                logins.append(time.perf_counter() - t0)
+                receiver = asyncio.create_task(receive(ws, codec))
+                for entry in events[1:]:
+                    await at(entry["t"])
+                    if entry["k"] == "frame":
+                        ws.send(codec.encode(mark(entry["f"]) if isinstance(entry["f"], dict) else entry["f"]))
+                        counts["frames"] += 1
+                    elif entry["k"] == "close":
+                        break
+                # let the last deliveries arrive before hanging up
+                await asyncio.sleep(0.05)
+                await ws.close()
+                receiver.cancel()
+
+            # the handlers print every login and disconnect
+            with contextlib.redirect_stdout(io.StringIO()):
+                await asyncio.gather(*(http(entry) for entry in requests_),
+                                     *(connection(i, events) for i, events in enumerate(connections.values())))
+            elapsed = time.perf_counter() - start
+            recorded = entries[-1]["t"] if entries else 0.0
+
+            typer.echo(f"--- {recording}: {len(entries)} entries over {recorded:.1f}s, world {world}")
+            typer.echo(f"  replayed in {elapsed:.2f}s at speed {speed} ({recorded / elapsed if elapsed else 0:.1f}x real time)")
+            typer.echo(f"  http {sum(map(len, http_latency.values())) / elapsed:.0f}/s, "
+                       f"frames {counts['frames'] / elapsed:.0f}/s, messages {counts['messages'] / elapsed:.0f}/s, "
+                       f"deliveries {len(deliveries) / elapsed:.0f}/s")
+            typer.echo(f"  status differing from the recording: {status_changed}, "
+                       f"failed logins {counts['auth_failed']}, connections without login {counts['joined_late']}")
+            report("login (/ws/chat auth)", logins, elapsed)
+            report("message delivery", deliveries, elapsed)
+            for route, latencies in sorted(http_latency.items(), key=lambda item: -len(item[1])):
+                report(f"http {route}", latencies, elapsed)
+            lag = METRICS.histogram("event_loop_lag_seconds")
+            typer.echo(f"--- event loop lag p99 {lag.quantile(0.99) * 1000:.0f}ms")
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.shutdown()
+
+    asyncio.run(run())
+
+
+# -------------------------------------------------
+# Memory soak
+# -------------------------------------------------
+@app.command("soak")
+def soak(minutes: float = 3.0,
+         clients: int = 500,
+         online: int = 100,
+         groups: int = 10,
+         sample_every: float = 10.0,
+         abandon: float = typer.Option(0.1, help="share of sessions that vanish without closing, for the heartbeat to reap"),
+         max_growth_mb: float = typer.Option(8.0, help="allowed growth of the traced heap after the warm-up")):
+    """
+    Connect/disconnect churn for --minutes, meant to run for hours. At most
+    --online of --clients users are connected at a time; a session logs in
+    over /ws/chat, polls its groups and inbox, chats in its groups for a few
+    seconds and leaves. Every --sample-every seconds the traced Python heap,
+    RSS, the per-subsystem estimates, connections and tasks are printed.
+
+    Exits 1 when the heap grew more than --max-growth-mb between the end of
+    the warm-up (the first quarter) and the end, or when connections or
+    tasks are left once the churn stopped. SQLite engine only: the memory
+    engine keeps every message, its growth is the point of it.
+    """
+    async def run():
+        rng = random.Random(7)
+        tracemalloc.start(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = make_backend(tmp, WS_HEARTBEAT_INTERVAL=1.0, WS_HEARTBEAT_TIMEOUT=3.0,
+                                   MEMORY_ACCOUNTING_INTERVAL=0, **UNLIMITED)
+            db = backend._db
+            await db.init_db()
+            names = await seed_users(db, clients)
+            for i in range(groups):
+                await db.create_conversation(f"group{i}", ConversationType.Group, 1)
+                await db.add_participants_bulk(i + 1, names)
+            with contextlib.redirect_stdout(io.StringIO()):
+                await backend.create_tables_at_startup()
+            api = backend._app
+            auth = {"Authorization": "Bearer bench"}
+            gate = asyncio.Semaphore(online)
+            sessions = {"done": 0, "abandoned": 0, "rejected": 0}
+            abandoned: list[AsgiWebSocket] = []
+            samples = []
+            start = time.monotonic()
+            until = start + minutes * 60
+
+            async def session(number: int):
+                name = rng.choice(names)
+                ws = AsgiWebSocket(api, "/ws/chat", client=(f"10.1.{number // 256 % 256}.{number % 256}", 40000))
+                await ws.connect()
+                ws.send(json.dumps({"username": name, "password": "pw", "session_id": "", "attempt": 0}))
+                response = await ws.receive()
+                if response is None or json.loads(response["text"]).get("state") != "AUTH_SUCCESS":
+                    # the same user logging in twice kicks the older session out
+                    sessions["rejected"] += 1
+                    await ws.close()
+                    return
+                drain = asyncio.create_task(_drain(ws))
+                await asgi_request(api, "GET", f"/api/get_groups{name}", auth, keep_body=False)
+                await asgi_request(api, "GET", "/api/inbox", auth, query=f"username={name}", keep_body=False)
+                for _ in range(rng.randint(1, 5)):
+                    room = rng.randint(1, groups)
+                    ws.send(json.dumps({"type": "message", "data": {"msg": "x" * rng.randint(5, 200)},
+                                        "from": name, "room_id": room, "room_name": f"group{room - 1}",
+                                        "chat_type": "group"}))
+                    await asyncio.sleep(rng.uniform(0.1, 1.0))
+                drain.cancel()
+                if rng.random() < abandon:
+                    # gone without a close frame, only the heartbeat notices
+                    sessions["abandoned"] += 1
+                    abandoned.append(ws)
+                    return
+                await ws.close()
+                sessions["done"] += 1
+
+            async def churn():
+                number = 0
+                running = set()
+                while time.monotonic() < until:
+                    await gate.acquire()
+                    number += 1
+                    task = asyncio.create_task(session(number))
+                    running.add(task)
+                    task.add_done_callback(lambda t: (running.discard(t), gate.release()))
+                await asyncio.gather(*running)
+
+            def sample(label: str):
+                traced = tracemalloc.get_traced_memory()[0]
+                subsystems = backend._memory.measure()
+                samples.append(traced)
+                # past the redirect that keeps the handlers quiet
+                typer.echo(f"  {label:>7}  heap {traced / 2**20:7.1f}MB  rss {resident_bytes() / 2**20:7.1f}MB  "
+                           f"online {backend._users.online_count:4d}  tasks {len(asyncio.all_tasks()):4d}  "
+                           f"sessions {sessions}  largest {max(subsystems, key=subsystems.get)} "
+                           f"{max(subsystems.values()) / 2**10:.0f}KB", file=console)
+
+            async def sampler():
+                while True:
+                    await asyncio.sleep(sample_every)
+                    sample(f"{time.monotonic() - start:.0f}s")
+
+            console = sys.stdout
+            baseline_tasks = len(asyncio.all_tasks()) + 1  # the sampler
+            typer.echo(f"--- soak: {minutes:g} min, {online} of {clients} users online at a time")
+            sampling = asyncio.create_task(sampler())
+            with contextlib.redirect_stdout(io.StringIO()):
+                await churn()
+                # abandoned sessions are reaped after the heartbeat timeout
+                await asyncio.sleep(5)
+            sampling.cancel()
+            await asyncio.gather(sampling, return_exceptions=True)
+            gc.collect()
+            sample("end")
+
+            # checked while the abandoned clients are still open, only the heartbeat may have reaped them
+            warm = samples[len(samples) // 4] if len(samples) > 4 else samples[0]
+            growth = (samples[-1] - warm) / 2**20
+            tasks = len(asyncio.all_tasks())
+            leftover_tasks = tasks - baseline_tasks + 1
+            failures = []
+            if growth > max_growth_mb:
+                failures.append(f"heap grew {growth:.1f}MB after the warm-up")
+            if backend._users.online_count:
+                failures.append(f"{backend._users.online_count} connections left")
+            if leftover_tasks > 0:
+                failures.append(f"{leftover_tasks} tasks left: {task_counts()}")
+            typer.echo(f"--- heap growth after warm-up {growth:+.1f}MB (limit {max_growth_mb:g}MB), "
+                       f"tasks {tasks} (baseline {baseline_tasks - 1})")
+            if failures:
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.statistics("lineno")[:10]:
+                    typer.echo(f"  {stat}")
+            with contextlib.redirect_stdout(io.StringIO()):
+                for ws in abandoned:
+                    await ws.close()
+                abandoned.clear()
+                await backend.shutdown()
+            tracemalloc.stop()
+            return failures
+
+    failures = asyncio.run(run())
+    for failure in failures:
+        typer.echo(f"FAIL {failure}")
+    raise typer.Exit(1 if failures else 0)
+
+
+# -------------------------------------------------
+# Inbound frame validation
+# -------------------------------------------------
+@app.command("frames")
+def frames(messages: int = 20000, batch_size: int = 50, rounds: int = 3):
+    """
+    Decode CPU per inbound chat frame: json.loads plus the dict indexing the
+    handler used to do, against decoding straight into the validated structs
+    of frames.CHAT_FRAME, with and without building the stored envelope.
+    Single-message frames, batch frames of --batch-size and, when installed,
+    msgpack. The best of --rounds is reported.
+    """
+    stream = chat_messages(messages)
+    singles = [json.dumps(m) for m in stream]
+    batches = [json.dumps({"type": "batch", "messages": stream[i:i + batch_size]})
+               for i in range(0, len(stream), batch_size)]
+
+    def dict_access(text):
+        msg = json.loads(text)
+        items = msg["messages"] if msg.get("type") == "batch" else [msg]
+        for m in items:
+            m["type"], m["from"], m["room_id"], m["data"]["msg"], m.get("room_name"), m.get("chat_type")
+
+    def struct_access(text):
+        frame = CHAT_FRAME.validate_json(text)
+        for m in frame.messages if isinstance(frame, BatchFrame) else [frame]:
+            m.type, m.room_id, m.data.msg, m.room_name, m.chat_type
+
+    def envelopes(text):
+        frame = CHAT_FRAME.validate_json(text)
+        [m.envelope("bench") for m in (frame.messages if isinstance(frame, BatchFrame) else [frame])]
+
+    def timed(decode, frames: list) -> float:
+        best = float("inf")
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            for frame in frames:
+                decode(frame)
+            best = min(best, time.perf_counter() - t0)
+        return best / messages * 1e6
+
+    for title, encoded in (("single-message frames", singles), (f"batch frames of {batch_size}", batches)):
+        typer.echo(f"--- {title}")
+        baseline = timed(dict_access, encoded)
+        typer.echo(f"  json.loads + dict access:        {baseline:6.2f}us/msg")
+        for name, decode in (("validate_json + attributes:     ", struct_access),
+                             ("validate_json + envelope:       ", envelopes)):
+            took = timed(decode, encoded)
+            typer.echo(f"  {name} {took:6.2f}us/msg ({took / baseline:.2f}x)")
+
+    if msgpack is not None:
+        codec = MsgPackCodec()
+        packed = [{"bytes": codec.encode(m)} for m in stream]
+        typer.echo("--- s3chat.msgpack single-message frames")
+
+        def packed_dict(message):
+            m = codec.decode(message)
+            m["type"], m["from"], m["room_id"], m["data"]["msg"], m.get("room_name"), m.get("chat_type")
+
+        def packed_struct(message):
+            m = codec.decode(message, CHAT_FRAME)
+            m.type, m.room_id, m.data.msg, m.room_name, m.chat_type
+
+        baseline = timed(packed_dict, packed)
+        typer.echo(f"  unpackb + dict access:           {baseline:6.2f}us/msg")
+        took = timed(packed_struct, packed)
+        typer.echo(f"  unpackb + validate_python:       {took:6.2f}us/msg ({took / baseline:.2f}x)")
+
+    # what a malformed frame costs now: rejected in the decoder, before any storage work
+    broken = [json.dumps({"type": "message", "data": {"msg": m["data"]["msg"]}}) for m in stream]
+
+    def reject(text):
+        try:
+            CHAT_FRAME.validate_json(text)
+        except ValidationError:
+            pass
+    typer.echo(f"--- frames without room_id, rejected: {timed(reject, broken):.2f}us/msg")
+
+
+if __name__ == "__main__":
+    app()
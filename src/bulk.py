@@ -0,0 +1,309 @@
+import gzip
+import itertools
+import json
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import IO, Callable, Iterable, Iterator, Optional
+
+import db_consts as dbc
+from db_consts import (
+    CONVERSATION_TABLE_NAME,
+    DIRECT_CONVERSATION_TABLE_NAME,
+    MESSAGE_TABLE_NAME,
+    PARTICIPANTS_TABLE_NAME,
+    USER_TABLE_NAME,
+    ConversationType,
+)
+
+# Tables in dependency order with the columns an NDJSON line may carry. Sessions
+# are never exported, they are tied to the machine that issued them.
+TABLE_COLUMNS = {
+    USER_TABLE_NAME: ("id", "username", "password", "approved"),
+    CONVERSATION_TABLE_NAME: ("id", "name", "type", "admin", "created_at", "updated_at"),
+    PARTICIPANTS_TABLE_NAME: ("id", "conversation_id", "user_id", "joined_at", "last_read_message_id"),
+    DIRECT_CONVERSATION_TABLE_NAME: ("user_low", "user_high", "conversation_id"),
+    MESSAGE_TABLE_NAME: ("id", "conversation_id", "sender_id", "content", "created_at"),
+}
+
+# secondary indexes are dropped for the load and rebuilt once at the end
+SECONDARY_INDEXES = ("idx_messages_conversation", "idx_participants_user")
+
+BATCH_ROWS = 50_000
+COMMIT_ROWS = 1_000_000
+
+WORDS = ("hey", "ok", "lunch", "tomorrow", "meeting", "lol", "sure", "deploy", "coffee", "thanks",
+         "when", "where", "done", "later", "nice", "ship", "it", "the", "is", "broken", "again")
+
+Progress = Callable[[str, int], None]
+
+
+def _no_progress(table: str, rows: int) -> None:
+    pass
+
+
+@contextmanager
+def bulk_connection(db_path) -> Iterator[sqlite3.Connection]:
+    """
+    Plain sqlite3 connection tuned for one big load: no fsync, rollback journal
+    in memory, a large page cache, foreign keys off and the file held
+    exclusively. The secondary indexes are dropped while it is open and built
+    once at the end, which beats updating them row by row.
+
+    Only ``journal_mode`` outlives a connection, it is put back on exit, the
+    other pragmas end with it. A crash during the load can leave a corrupt
+    file, so load into a fresh database or take a backup first.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA foreign_keys = OFF")
+    conn.execute("PRAGMA cache_size = -262144")  # 256 MiB
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+    for index in SECONDARY_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.executescript(dbc.INDEXES)
+        conn.execute("PRAGMA locking_mode = NORMAL")
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+
+def _insert(conn: sqlite3.Connection, table: str, columns: tuple, rows: Iterable[tuple],
+            progress: Progress = _no_progress) -> int:
+    """executemany in BATCH_ROWS slices, committing every COMMIT_ROWS so the journal stays small."""
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    rows = iter(rows)
+    total = 0
+    conn.execute("BEGIN")
+    while batch := list(itertools.islice(rows, BATCH_ROWS)):
+        conn.executemany(sql, batch)
+        total += len(batch)
+        if total % COMMIT_ROWS < BATCH_ROWS:
+            conn.execute("COMMIT")
+            conn.execute("BEGIN")
+        progress(table, total)
+    conn.execute("COMMIT")
+    return total
+
+
+def _next_id(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+
+
+# -------------------------------------------------
+# Synthetic data
+# -------------------------------------------------
+def seed(db_path,
+         users: int = 10_000,
+         groups: int = 1_000,
+         directs: int = 20_000,
+         messages: int = 1_000_000,
+         min_group: int = 3,
+         max_group: int = 500,
+         size_alpha: float = 1.5,
+         skew: float = 1.1,
+         read_pct: int = 80,
+         days: int = 365,
+         rng_seed: int = 0,
+         progress: Progress = _no_progress) -> dict:
+    """
+    Append a synthetic dataset to an initialised database and return the row
+    counts.
+
+    Group sizes follow a Pareto distribution with ``size_alpha`` (many small
+    groups, a few big ones) clamped to ``min_group``..``max_group``; ``directs``
+    random pairs get a direct conversation. Messages pick their conversation by
+    Zipf rank with exponent ``skew`` (0 spreads them evenly), their sender
+    among its members, and are spread over the last ``days`` in id order. At
+    the end ``read_pct`` percent of the participants have read everything,
+    the rest have unread messages.
+    """
+    rnd = random.Random(rng_seed)
+    now = datetime.now(timezone.utc)
+    counts = {}
+
+    with bulk_connection(db_path) as conn:
+        first_user = _next_id(conn, USER_TABLE_NAME)
+        user_ids = range(first_user, first_user + users)
+        names = {uid: f"user{uid}" for uid in user_ids}
+        counts["users"] = _insert(conn, USER_TABLE_NAME, ("id", "username", "password", "approved"),
+                                  ((uid, names[uid], "pw", 1) for uid in user_ids), progress)
+
+        members: list[list[int]] = []
+        convos: list[tuple] = []
+        first_convo = _next_id(conn, CONVERSATION_TABLE_NAME)
+        created = str(now - timedelta(days=days))
+        for i in range(groups):
+            size = min(max_group, users, int(min_group * rnd.paretovariate(size_alpha)))
+            group = rnd.sample(user_ids, size)
+            members.append(group)
+            convos.append((first_convo + i, f"group {first_convo + i}", ConversationType.Group.value, group[0], created, created))
+
+        pairs = set()
+        while len(pairs) < min(directs, users * (users - 1) // 2):
+            a, b = rnd.sample(user_ids, 2)
+            pairs.add((min(a, b), max(a, b)))
+        first_direct = first_convo + groups
+        pairs = sorted(pairs)
+        for i, pair in enumerate(pairs):
+            members.append(list(pair))
+            convos.append((first_direct + i, None, ConversationType.Direct.value, None, created, created))
+
+        counts["conversations"] = _insert(conn, CONVERSATION_TABLE_NAME, TABLE_COLUMNS[CONVERSATION_TABLE_NAME], convos, progress)
+        _insert(conn, DIRECT_CONVERSATION_TABLE_NAME, TABLE_COLUMNS[DIRECT_CONVERSATION_TABLE_NAME],
+                ((low, high, first_direct + i) for i, (low, high) in enumerate(pairs)), progress)
+        counts["participants"] = _insert(
+            conn, PARTICIPANTS_TABLE_NAME, ("conversation_id", "user_id", "joined_at"),
+            ((first_convo + i, uid, created) for i, group in enumerate(members) for uid in group), progress)
+
+        if messages and convos:
+            counts["messages"] = _insert(conn, MESSAGE_TABLE_NAME, ("conversation_id", "sender_id", "content", "created_at"),
+                                         _messages(rnd, members, first_convo, names, convos, messages, skew, now, days),
+                                         progress)
+
+        # one grouped scan, the per-conversation index is only rebuilt when the load ends
+        conn.execute("BEGIN")
+        conn.execute(
+            f"""
+            UPDATE {PARTICIPANTS_TABLE_NAME} AS p
+            SET last_read_message_id = latest.id
+            FROM (SELECT conversation_id, MAX(id) AS id FROM {MESSAGE_TABLE_NAME}
+                  WHERE conversation_id >= ? GROUP BY conversation_id) AS latest
+            WHERE p.conversation_id = latest.conversation_id AND abs(random()) % 100 < ?
+            """,
+            (first_convo, read_pct),
+        )
+        conn.execute("COMMIT")
+    return counts
+
+
+def _messages(rnd: random.Random, members: list[list[int]], first_convo: int, names: dict, convos: list[tuple],
+              count: int, skew: float, now: datetime, days: int) -> Iterator[tuple]:
+    # Zipf over a shuffled rank order, so the busy conversations aren't simply the lowest ids
+    ranks = list(range(len(members)))
+    rnd.shuffle(ranks)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** skew for rank in ranks))
+    indexes = range(len(members))
+    first_second = (now - timedelta(days=days)).timestamp()
+    step = days * 86400 / count
+    day, prefix = -1, ""
+    # the same layout json.dumps gives the frames the backend persists
+    template = '{"type": "message", "data": {"msg": "%s"}, "from": "%s", "room_id": %d, "room_name": "%s", "chat_type": "%s"}'
+
+    # a fixed pool of texts, drawing words per message would cost more than the insert
+    texts = [" ".join(rnd.choices(WORDS, k=rnd.randint(1, 12))) for _ in range(4096)]
+    labels = [(name or "", kind) for _, name, kind, *_ in convos]
+
+    produced = 0
+    while produced < count:
+        chunk = min(BATCH_ROWS, count - produced)
+        for offset, index in enumerate(rnd.choices(indexes, cum_weights=cum_weights, k=chunk), produced):
+            group = members[index]
+            sender = group[int(rnd.random() * len(group))]
+            name, kind = labels[index]
+            content = template % (texts[offset & 4095], names[sender], first_convo + index, name or names[sender], kind)
+            # str(datetime) per row costs as much as the insert, only the date is formatted
+            second = int(first_second + step * offset)
+            if second // 86400 != day:
+                day = second // 86400
+                prefix = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%d ")
+            second %= 86400
+            created = f"{prefix}{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}+00:00"
+            yield first_convo + index, sender, content, created
+        produced += chunk
+
+
+# -------------------------------------------------
+# NDJSON import / export
+# -------------------------------------------------
+def open_ndjson(path: str, mode: str) -> IO[bytes]:
+    """Binary file, gzip when the name ends in ``.gz``."""
+    return gzip.open(path, mode + "b", compresslevel=6) if path.endswith(".gz") else open(path, mode + "b")
+
+
+def export_ndjson(db_path, target: IO[bytes], tables: Optional[Iterable[str]] = None,
+                  progress: Progress = _no_progress) -> dict:
+    """
+    Write every row of ``tables`` (all of them by default) as one JSON object
+    per line, tagged with ``"table"``, in dependency order so the file can be
+    imported as is. Rows are read ``BATCH_ROWS`` at a time in one read
+    transaction, giving a consistent snapshot while the server keeps running.
+    Passwords are exported, treat the file like the database itself.
+    """
+    tables = [t for t in TABLE_COLUMNS if tables is None or t in tables]
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    counts = {}
+    try:
+        conn.execute("BEGIN")
+        for table in tables:
+            columns = TABLE_COLUMNS[table]
+            order = "id" if "id" in columns else "conversation_id"
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {order}")
+            counts[table] = 0
+            while rows := cursor.fetchmany(BATCH_ROWS):
+                target.write("".join(
+                    json.dumps({"table": table, **dict(zip(columns, row))}) + "\n" for row in rows
+                ).encode())
+                counts[table] += len(rows)
+                progress(table, counts[table])
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return counts
+
+
+def _ndjson_rows(source: IO[bytes]) -> Iterator[tuple[str, dict]]:
+    for number, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            table = row.pop("table")
+        except (ValueError, KeyError, AttributeError):
+            raise ValueError(f"Line {number} is not an exported row")
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Line {number} names unknown table {table}")
+        yield table, row
+
+
+def import_ndjson(db_path, source: IO[bytes], progress: Progress = _no_progress) -> dict:
+    """
+    Load rows written by ``export_ndjson``, keeping their ids, into an
+    initialised database. The file is read as a stream; consecutive rows of a
+    table go through one ``executemany``. Only the known columns of a table
+    are accepted. Ids that already exist fail the import with
+    ``sqlite3.IntegrityError``, so import into a fresh database.
+    """
+    counts = {}
+    with bulk_connection(db_path) as conn:
+        for table, rows in itertools.groupby(_ndjson_rows(source), key=lambda item: item[0]):
+            columns = TABLE_COLUMNS[table]
+            loaded = counts.get(table, 0)
+
+            def values():
+                for _, row in rows:
+                    unknown = row.keys() - set(columns)
+                    if unknown:
+                        raise ValueError(f"Unknown columns {sorted(unknown)} for table {table}")
+                    yield tuple(row.get(column) for column in columns)
+
+            counts[table] = loaded + _insert(conn, table, columns, values(),
+                                             lambda t, n: progress(t, loaded + n))
+    return counts
+
+
+def rate(rows: int, started: float) -> str:
+    elapsed = time.perf_counter() - started
+    return f"{rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s)"
@@ -1,5 +1,8 @@
-import asyncio, typer
+import asyncio, typer, sys, time, sqlite3
 from database_wrapper import DBWrapper
+from maintenance import backup as backup_db, optimize, checkpoint, incremental_vacuum, vacuum as vacuum_db, BACKUP_PAGES, BACKUP_PAUSE
+from bulk import seed as seed_dataset, export_ndjson, import_ndjson, open_ndjson, rate, COMMIT_ROWS, TABLE_COLUMNS
+from export import export_conversation, EXPORT_FORMATS
 from paths import PathWrap
 app = typer.Typer()
 
@@ -84,6 +87,135 @@ def give_admin(username : str):
     asyncio.run(run())
     
 
+@app.command("export")
+def export(conversation_id: int,
+           out: str = typer.Option("-", help="output file, - for stdout"),
+           format: str = typer.Option("ndjson", help="ndjson or csv"),
+           gzip: bool = typer.Option(False, help="gzip the output on the fly"),
+           after: int = typer.Option(0, help="resume after this message id, appends to --out")):
+    if format not in EXPORT_FORMATS:
+        typer.echo(f"{format} is not a valid export format, use one of {EXPORT_FORMATS}")
+        raise typer.Exit(1)
+
+    async def run():
+        CurrentPaths = PathWrap()
+        db = DBWrapper(CurrentPaths.db_file)
+        await db.init_db()
+        target = sys.stdout.buffer if out == "-" else open(out, "ab" if after else "wb")
+        size = 0
+        try:
+            async for chunk in export_conversation(db, conversation_id, format, gzip, after):
+                target.write(chunk)
+                size += len(chunk)
+        finally:
+            if target is not sys.stdout.buffer:
+                target.close()
+        typer.echo(f"✔ Exported conversation {conversation_id} ({size} bytes)", err=True)
+
+    asyncio.run(run())
+
+
+def _bulk_db(db: str) -> str:
+    """Create the schema once, every bulk command works on the file afterwards."""
+    path = db or str(PathWrap().db_file)
+    asyncio.run(DBWrapper(path).init_db())
+    return path
+
+
+def _progress(table: str, rows: int) -> None:
+    if rows % COMMIT_ROWS == 0:
+        typer.echo(f"  {table}: {rows}", err=True)
+
+
+@app.command("seed")
+def seed(users: int = typer.Option(10_000),
+         groups: int = typer.Option(1_000),
+         directs: int = typer.Option(20_000, help="direct conversations between random pairs"),
+         messages: int = typer.Option(1_000_000),
+         min_group: int = typer.Option(3),
+         max_group: int = typer.Option(500),
+         size_alpha: float = typer.Option(1.5, help="Pareto shape of the group sizes, lower means more big groups"),
+         skew: float = typer.Option(1.1, help="Zipf exponent of messages per conversation, 0 spreads them evenly"),
+         read_pct: int = typer.Option(80, help="percent of participants that have read everything"),
+         days: int = typer.Option(365, help="messages are spread over this many days up to now"),
+         rng_seed: int = typer.Option(0),
+         db: str = typer.Option("", help="database file, the configured one by default")):
+    path = _bulk_db(db)
+    started = time.perf_counter()
+    counts = seed_dataset(path, users, groups, directs, messages, min_group, max_group,
+                          size_alpha, skew, read_pct, days, rng_seed, _progress)
+    typer.echo(f"✔ Seeded {counts}: {rate(sum(counts.values()), started)}")
+
+
+@app.command("export_db")
+def export_db(out: str = typer.Option("-", help="output file, - for stdout, gzipped when it ends in .gz"),
+              table: list[str] = typer.Option(None, help=f"only these tables, of {', '.join(TABLE_COLUMNS)}"),
+              db: str = typer.Option("", help="database file, the configured one by default")):
+    path = _bulk_db(db)
+    started = time.perf_counter()
+    target = sys.stdout.buffer if out == "-" else open_ndjson(out, "w")
+    try:
+        counts = export_ndjson(path, target, table or None, _progress)
+    finally:
+        if target is not sys.stdout.buffer:
+            target.close()
+    typer.echo(f"✔ Exported {counts}: {rate(sum(counts.values()), started)}", err=True)
+
+
+@app.command("import_db")
+def import_db(source: str = typer.Argument(..., help="NDJSON from export_db, - for stdin, gzipped when it ends in .gz"),
+              db: str = typer.Option("", help="database file, the configured one by default")):
+    path = _bulk_db(db)
+    started = time.perf_counter()
+    stream = sys.stdin.buffer if source == "-" else open_ndjson(source, "r")
+    try:
+        counts = import_ndjson(path, stream, _progress)
+    except (ValueError, sqlite3.IntegrityError) as e:
+        typer.echo(f"Import stopped, rows committed before the failing batch are kept: {e}", err=True)
+        raise typer.Exit(1)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    typer.echo(f"✔ Imported {counts}: {rate(sum(counts.values()), started)}")
+
+
+@app.command("backup")
+def backup(dest: str,
+           pages: int = typer.Option(BACKUP_PAGES, help="pages copied per step, -1 copies everything in one step"),
+           pause: float = typer.Option(BACKUP_PAUSE, help="seconds to sleep between steps"),
+           db: str = typer.Option("", help="database file, the configured one by default")):
+    """Online backup, safe while the server is running."""
+    started = time.perf_counter()
+    result = asyncio.run(backup_db(db or PathWrap().db_file, dest, pages, pause))
+    typer.echo(f"✔ Backed up to {result['path']} ({result['bytes']} bytes, {result['steps']} steps, "
+               f"{result['restarts']} restarts) in {time.perf_counter() - started:.1f}s")
+
+
+@app.command("maintain")
+def maintain(vacuum_pages: int = typer.Option(2000, help="free pages handed back by the incremental vacuum"),
+             checkpoint_mode: str = typer.Option("PASSIVE", help="PASSIVE, FULL, RESTART or TRUNCATE"),
+             db: str = typer.Option("", help="database file, the configured one by default")):
+    """What the server's maintenance scheduler runs, once and right now."""
+    if checkpoint_mode.upper() not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        typer.echo(f"{checkpoint_mode} is not a checkpoint mode")
+        raise typer.Exit(1)
+    path = db or PathWrap().db_file
+    for name, task in (("optimize", lambda: optimize(path)),
+                       ("checkpoint", lambda: checkpoint(path, checkpoint_mode.upper())),
+                       ("incremental_vacuum", lambda: incremental_vacuum(path, vacuum_pages))):
+        started = time.perf_counter()
+        result = task()
+        typer.echo(f"✔ {name} {result} in {time.perf_counter() - started:.2f}s")
+
+
+@app.command("vacuum")
+def vacuum(incremental: bool = typer.Option(False, help="switch to auto_vacuum=INCREMENTAL so the scheduler can reclaim space"),
+           db: str = typer.Option("", help="database file, the configured one by default")):
+    """Full VACUUM, blocks all writers: stop the server first."""
+    started = time.perf_counter()
+    result = vacuum_db(db or PathWrap().db_file, incremental)
+    typer.echo(f"✔ Vacuumed {result} in {time.perf_counter() - started:.1f}s")
+
 
 if __name__ == "__main__":
     app()
@@ -1,9 +1,13 @@
 import aiosqlite
+import sqlite3
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, AsyncGenerator
 import db_consts as dbc
 import asyncio
+import heapq
+import json
+from collections import deque
 from db_consts import *
 
 
@@ -11,7 +15,23 @@ from fastapi import HTTPException
 
 from secret import generate_secret_id
 from db_objects import User
+from user_registry import UserRecord
 from eventhandler import EventHandler
+from etags import MembershipVersions
+from storage import INBOX_PREVIEW_CHARS, HISTORY_PAGE_SIZE, ConversationNotFound
+
+def parse_expiry(expires) -> datetime:
+    """Session expiry as an aware datetime, SQLite hands it back as TEXT."""
+    if isinstance(expires, str):
+        try:
+            expires = datetime.fromisoformat(expires)
+        except ValueError:
+            # Fallback for the default SQLite "YYYY-MM-DD HH:MM:SS"
+            expires = datetime.strptime(expires, "%Y-%m-%d %H:%M:%S")
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return expires
+
 
 class DBWrapper:
     def __init__(self, db_path: str = "database.db"):
@@ -19,6 +39,10 @@ class DBWrapper:
         self.event_handler = EventHandler()
         self.add_user_event = "AddUserEvent"
         self.remove_user_event = "RemoveUserEvent"
+        self.participants_event = "ParticipantsChangedEvent"
+        self.versions = MembershipVersions()
+        # (user_low, user_high) -> conversation id, direct conversations never change owner
+        self._direct_pairs: dict[tuple[int, int], int] = {}
 
     # -------------------------------------------------
     # initialisation
@@ -29,16 +53,79 @@ class DBWrapper:
                 print("DB not Found")
 
             await conn.execute("PRAGMA foreign_keys = ON;")
+            # persistent: readers (and online backups) no longer block the writer,
+            # the maintenance scheduler checkpoints the log in quiet periods
+            await conn.execute("PRAGMA journal_mode = WAL;")
             await conn.executescript(
                 "\n".join([
                     dbc.USER_TABLE,
                     dbc.SESSION_TABLE,
                     dbc.CONVERSATION_TABLE,
                     dbc.PARTICIPANTS_TABLE,
-                    dbc.MESSAGE_TABLE
+                    dbc.MESSAGE_TABLE,
+                    dbc.DIRECT_CONVERSATION_TABLE,
+                    dbc.INDEXES
                 ])
             )
             await conn.commit()
+            await self.migrate_direct_conversations(conn)
+
+    async def migrate_direct_conversations(self, conn: aiosqlite.Connection) -> None:
+        """
+        Register every direct conversation that has no pair key yet. When a pair
+        ended up with several direct conversations the oldest one is kept: the
+        messages of the others are moved over, read markers keep the newest
+        position and the duplicates are deleted.
+        """
+        async with conn.execute(
+            f"""
+            SELECT c.id, MIN(p.user_id), MAX(p.user_id)
+            FROM {CONVERSATION_TABLE_NAME} c
+            JOIN {PARTICIPANTS_TABLE_NAME} p ON p.conversation_id = c.id
+            WHERE c.type = ?
+              AND c.id NOT IN (SELECT conversation_id FROM {DIRECT_CONVERSATION_TABLE_NAME})
+            GROUP BY c.id
+            HAVING COUNT(*) = 2
+            ORDER BY c.id
+            """,
+            (ConversationType.Direct.value,)
+        ) as cursor:
+            unmapped = await cursor.fetchall()
+        if not unmapped:
+            return
+
+        merged = 0
+        for conversation_id, user_low, user_high in unmapped:
+            async with conn.execute(
+                f"SELECT conversation_id FROM {DIRECT_CONVERSATION_TABLE_NAME} WHERE user_low = ? AND user_high = ?",
+                (user_low, user_high),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                await conn.execute(
+                    f"INSERT INTO {DIRECT_CONVERSATION_TABLE_NAME} (user_low, user_high, conversation_id) VALUES (?, ?, ?)",
+                    (user_low, user_high, conversation_id),
+                )
+                continue
+
+            survivor = row[0]
+            await conn.execute(
+                f"UPDATE {MESSAGE_TABLE_NAME} SET conversation_id = ? WHERE conversation_id = ?",
+                (survivor, conversation_id),
+            )
+            await conn.execute(
+                f"""
+                UPDATE {PARTICIPANTS_TABLE_NAME} AS keep
+                SET last_read_message_id = MAX(COALESCE(keep.last_read_message_id, 0), COALESCE(dup.last_read_message_id, 0))
+                FROM {PARTICIPANTS_TABLE_NAME} AS dup
+                WHERE keep.conversation_id = ? AND dup.conversation_id = ? AND keep.user_id = dup.user_id
+                """,
+                (survivor, conversation_id),
+            )
+            await conn.execute(f"DELETE FROM {CONVERSATION_TABLE_NAME} WHERE id = ?", (conversation_id,))
+            merged += 1
+        await conn.commit()
+        print(f"Registered {len(unmapped) - merged} direct conversations, merged {merged} duplicates")
 
     # -------------------------------------------------
     # Connection helper
@@ -64,39 +151,73 @@ class DBWrapper:
     async def add_user(self, username: str, password: str, approved: bool = False) -> None:
         async with self.get_connection() as conn:
             try:
-                await conn.execute(
+                cursor = await conn.execute(
                     "INSERT INTO users (username, password, approved) VALUES (?, ?, ?)",
                     (username, password, int(approved)),
                 )
                 await conn.commit()
-                payload = {"adding": username}
+                payload = {"adding": username, "user_id": cursor.lastrowid, "approved": bool(approved)}
             except aiosqlite.IntegrityError:
                 raise HTTPException(status_code=409, detail="Username already exists")
             
             await self.event_handler.call_event(self.add_user_event, payload)
 
             
-    async def approve_user(self, username: str) -> None:
+    async def approve_user(self, username: str) -> Optional[int]:
+        """Returns the id of the approved user, None if there is no such user."""
+        user_id = await self._set_approved(username, True)
+        if user_id is not None:
+            payload = {"approve": username, "user_id": user_id, "approved": True}
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return user_id
+
+    async def reject_user(self, username: str) -> Optional[int]:
+        """Returns the id of the rejected user, None if there is no such user."""
+        user_id = await self._set_approved(username, False)
+        if user_id is not None:
+            payload = {"reject": username, "user_id": user_id, "approved": False}
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return user_id
+
+    async def set_approved_bulk(self, usernames: list[str], approved: bool) -> dict[str, Optional[int]]:
+        """
+        Approve or reject many users in one transaction. Returns username -> id,
+        with None for usernames that don't exist. A single event carries every
+        changed user.
+        """
         async with self.get_connection() as conn:
-            await conn.execute(
-                "UPDATE users SET approved = 1 WHERE username = ?",
-                (username,),
+            ids = await self.resolve_user_ids(conn, usernames)
+            await conn.executemany(
+                "UPDATE users SET approved = ? WHERE id = ?",
+                ((int(approved), user_id) for user_id in ids.values()),
             )
             await conn.commit()
-            payload = {"approve": username}
 
-        await self.event_handler.call_event(self.add_user_event, payload)
+        if ids:
+            payload = {
+                "bulk": [{"username": name, "user_id": user_id, "approved": approved} for name, user_id in ids.items()],
+                "action": "approve" if approved else "reject",
+            }
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return {name: ids.get(name) for name in usernames}
+
+    async def resolve_user_ids(self, conn: aiosqlite.Connection, usernames: list[str]) -> dict[str, int]:
+        """username -> id for all existing usernames, in one query no matter how many."""
+        async with conn.execute(
+            f"SELECT id, username FROM {USER_TABLE_NAME} WHERE username IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(usernames)),),
+        ) as cursor:
+            return {row[1]: row[0] for row in await cursor.fetchall()}
 
-    async def reject_user(self, username: str) -> None:
+    async def _set_approved(self, username: str, approved: bool) -> Optional[int]:
         async with self.get_connection() as conn:
-            await conn.execute(
-                "UPDATE users SET approved = 0 WHERE username = ?",
-                (username,),
-            )
+            async with conn.execute(
+                "UPDATE users SET approved = ? WHERE username = ? RETURNING id",
+                (int(approved), username),
+            ) as cursor:
+                row = await cursor.fetchone()
             await conn.commit()
-
-        payload = {"reject": username}
-        asyncio.create_task(self.event_handler.call_event(self.add_user_event, payload))
+        return row["id"] if row else None
 
     async def get_user(self, username: str) -> Optional[aiosqlite.Row]:
         async with self.get_connection() as conn:
@@ -110,19 +231,26 @@ class DBWrapper:
             async with conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
                 return await cursor.fetchone()
             
-    async def get_participant_by_user_and_convo(self, user : User, conversation_id : int):
+    async def get_participant_by_user_and_convo(self, user : UserRecord, conversation_id : int):
         async with self.get_connection() as conn:
             async with conn.execute(
                 f"""
                 SELECT *
                 FROM {PARTICIPANTS_TABLE_NAME}
-                WHERE user_id = (SELECT id FROM users WHERE username = ?)
+                WHERE user_id = ?
                   AND conversation_id = ?
                 """,
-                (user._credentials.username, conversation_id)
+                (user.id, conversation_id)
             ) as cursor:
                 return await cursor.fetchone()
             
+    async def get_participant_by_id(self, participant_id: int) -> Optional[aiosqlite.Row]:
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                f"SELECT * FROM {PARTICIPANTS_TABLE_NAME} WHERE id = ?", (participant_id,)
+            ) as cursor:
+                return await cursor.fetchone()
+
     async def get_newest_message_in_conversation(self, conversation_id):
         async with self.get_connection() as conn:
             async with conn.execute(
@@ -143,6 +271,25 @@ class DBWrapper:
                 rows = await cursor.fetchall()
         return [User(username=row["username"], password=row["password"], approved=row["approved"]) for row in rows]
 
+    async def get_user_record(self, username: str) -> Optional[tuple]:
+        """Single ``(id, username, approved)`` row, the password is never read."""
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                "SELECT id, username, approved FROM users WHERE username = ?", (username,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return tuple(row) if row else None
+
+    async def iter_user_records(self, chunk_size: int = 10000) -> AsyncGenerator[list[tuple], None]:
+        """Yield ``(id, username, approved)`` tuples in chunks, passwords are never read."""
+        async with aiosqlite.connect(self.db_path) as conn:
+            async with conn.execute("SELECT id, username, approved FROM users ORDER BY id") as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
     # -------------------------------------------------
     # Session helpers
     # -------------------------------------------------
@@ -151,7 +298,7 @@ class DBWrapper:
             async with conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)) as cursor:
                 return await cursor.fetchone()
 
-    async def create_session_id(self, user: User, now: Optional[datetime] = None) -> str:
+    async def create_session_id(self, user: UserRecord, now: Optional[datetime] = None) -> str:
         if not isinstance(now, datetime):
             now = datetime.now(timezone.utc)
 
@@ -160,11 +307,10 @@ class DBWrapper:
             async with conn.execute(
                 """SELECT session_id, expires_at
                        FROM sessions s
-                       JOIN users u ON s.user_id = u.id
-                       WHERE u.username = ? AND s.expires_at > ?
+                       WHERE s.user_id = ? AND s.expires_at > ?
                        ORDER BY s.expires_at DESC
                        LIMIT 1""",
-                (user._credentials.username, now),
+                (user.id, now),
             ) as cursor:
                 existing = await cursor.fetchone()
                 if existing:
@@ -175,17 +321,9 @@ class DBWrapper:
         expires_at = now + timedelta(days=1)
 
         async with self.get_connection() as conn:
-            async with conn.execute(
-                "SELECT id FROM users WHERE username = ?", (user._credentials.username,)
-            ) as cursor:
-                row = await cursor.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="User not found")
-            user_id = row["id"]
-
             await conn.execute(
                 "INSERT INTO sessions (user_id, session_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
-                (user_id, session_id, now, expires_at),
+                (user.id, session_id, now, expires_at),
             )
             await conn.commit()
         return session_id
@@ -216,26 +354,13 @@ class DBWrapper:
 
             session_row = await self.get_session(creds.session_id)
             if session_row:
-                expires = session_row["expires_at"]
-
-                # --- Option B: coerce only here ----------------------------------
-                if isinstance(expires, str):                 # comes back as TEXT
-                    try:
-                        expires = datetime.fromisoformat(expires)
-                    except ValueError:
-                        # Fallback for the default SQLite “YYYY-MM-DD HH:MM:SS”
-                        expires = datetime.strptime(expires, "%Y-%m-%d %H:%M:%S")
-                    if expires.tzinfo is None:               # make it comparable to `now`
-                        expires = expires.replace(tzinfo=timezone.utc)
-                # ----------------------------------------------------------------
-
-                if expires > now:
+                if parse_expiry(session_row["expires_at"]) > now:
                     user_row = await self.get_user_by_id(session_row["user_id"])
-                if not user_row or user_row["username"] != creds.username:
-                    raise HTTPException(status_code=401, detail="Session does not belong to this user")
-                if user_row["approved"]:
-                    return {"status": "success", "username": user_row["username"]}
-                raise HTTPException(status_code=401, detail="User not approved")
+                    if not user_row or user_row["username"] != creds.username:
+                        raise HTTPException(status_code=401, detail="Session does not belong to this user")
+                    if user_row["approved"]:
+                        return {"status": "success", "username": user_row["username"]}
+                    raise HTTPException(status_code=401, detail="User not approved")
             # fall‑through to password flow if session missing/expired
 
         # ---------------------------
@@ -254,6 +379,100 @@ class DBWrapper:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
 
+    async def authenticate(self,
+                           username: str,
+                           password: str = "",
+                           session_id: str = "",
+                           now: Optional[datetime] = None) -> dict:
+        """
+        The whole login step of /ws/chat as one unit of work: check the session
+        or the password like ``login``, reuse or issue a session like
+        ``create_session_id`` and collect the ``find_unread_messages`` summary.
+        Runs on one plain sqlite3 connection in one executor hop instead of a
+        dozen aiosqlite round trips. Raises HTTPException when login fails.
+
+        Returns ``{"user": (id, username, approved), "session_id": ..., "unread": [...]}``.
+        """
+        if not isinstance(now, datetime):
+            now = datetime.now(timezone.utc)
+        return await asyncio.to_thread(self._authenticate, username, password, session_id, now)
+
+    def _authenticate(self, username: str, password: str, session_id: str, now: datetime) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            user = None
+            if session_id:
+                print(f"Session Based Login: {username}")
+                if not username:
+                    raise HTTPException(status_code=400, detail="Username is required when using session_id")
+                session = conn.execute(
+                    "SELECT user_id, expires_at FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if session and parse_expiry(session["expires_at"]) > datetime.now(timezone.utc):
+                    user = conn.execute(
+                        "SELECT id, username, approved FROM users WHERE id = ?", (session["user_id"],)
+                    ).fetchone()
+                    if not user or user["username"] != username:
+                        raise HTTPException(status_code=401, detail="Session does not belong to this user")
+                    if not user["approved"]:
+                        raise HTTPException(status_code=401, detail="User not approved")
+
+            if user is None:
+                print(f"Password Based Login: {username}")
+                user = conn.execute(
+                    "SELECT id, username, password, approved FROM users WHERE username = ?", (username,)
+                ).fetchone()
+                if not (user and user["password"] == password and user["approved"]):
+                    raise HTTPException(status_code=401, detail="Invalid credentials")
+
+            row = conn.execute(
+                """SELECT session_id FROM sessions
+                   WHERE user_id = ? AND expires_at > ?
+                   ORDER BY expires_at DESC
+                   LIMIT 1""",
+                (user["id"], now),
+            ).fetchone()
+            if row is not None:
+                new_session = row["session_id"]
+            else:
+                new_session = generate_secret_id()
+                with conn:
+                    conn.execute(
+                        "INSERT INTO sessions (user_id, session_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                        (user["id"], new_session, now, now + timedelta(days=1)),
+                    )
+
+            # conversations with messages from someone else past the read marker, with their display name
+            unread = conn.execute(
+                f"""
+                SELECT CASE c.type
+                         WHEN 'direct' THEN (SELECT u.username
+                                             FROM {PARTICIPANTS_TABLE_NAME} o
+                                             JOIN {USER_TABLE_NAME} u ON u.id = o.user_id
+                                             WHERE o.conversation_id = c.id AND o.user_id != p.user_id
+                                             LIMIT 1)
+                         WHEN 'group' THEN c.name
+                       END AS display_name
+                FROM {PARTICIPANTS_TABLE_NAME} p
+                JOIN {CONVERSATION_TABLE_NAME} c ON c.id = p.conversation_id
+                WHERE p.user_id = ?
+                  AND EXISTS (SELECT 1 FROM {MESSAGE_TABLE_NAME} m
+                              WHERE m.conversation_id = p.conversation_id
+                                AND m.id > COALESCE(p.last_read_message_id, 0)
+                                AND m.sender_id != p.user_id)
+                ORDER BY p.id
+                """,
+                (user["id"],),
+            ).fetchall()
+            return {
+                "user": (user["id"], user["username"], user["approved"]),
+                "session_id": new_session,
+                "unread": [row["display_name"] for row in unread if row["display_name"]],
+            }
+        finally:
+            conn.close()
+
     """
     a message object from the frontend would look something like this:
     message_data = {
@@ -300,19 +519,16 @@ class DBWrapper:
                 for row in rows
             ]
         
-    async def find_unread_messages(self, user: User):
-        await user.set_id(self)
-
+    async def find_unread_messages(self, user: UserRecord):
         async with self.get_connection() as conn:
             # Get all participant entries for this user
             async with conn.execute(
                 f"""
                 SELECT p.id as participant_id, p.conversation_id, p.last_read_message_id
                 FROM {PARTICIPANTS_TABLE_NAME} p
-                JOIN users u ON p.user_id = u.id
-                WHERE u.username = ?
+                WHERE p.user_id = ?
                 """,
-                (user._credentials.username,)
+                (user.id,)
             ) as cursor:
                 participant_rows = await cursor.fetchall()
 
@@ -331,7 +547,7 @@ class DBWrapper:
                       AND id > COALESCE(?, 0)
                       AND sender_id != ?
                     """,
-                    (conversation_id, last_read_message_id, user._id)
+                    (conversation_id, last_read_message_id, user.id)
                 ) as msg_cursor:
                     msg_row = await msg_cursor.fetchone()
                     unread_count = msg_row["unread_count"] if msg_row else 0
@@ -358,10 +574,10 @@ class DBWrapper:
                             SELECT u.username
                             FROM {PARTICIPANTS_TABLE_NAME} p
                             JOIN users u ON p.user_id = u.id
-                            WHERE p.conversation_id = ? AND u.username != ?
+                            WHERE p.conversation_id = ? AND u.id != ?
                             LIMIT 1
                             """,
-                            (conversation_id, user._credentials.username)
+                            (conversation_id, user.id)
                         ) as other_cursor:
                             other_row = await other_cursor.fetchone()
                         display_name = other_row["username"] if other_row else None
@@ -380,8 +596,69 @@ class DBWrapper:
             return [conv["display_name"] for conv in unread_conversations if conv["display_name"]]
 
 
+    async def get_inbox(self, user_id: int) -> list[dict]:
+        """
+        One entry per conversation of the user, most recent activity first: display
+        name, type, the last message with a text preview and the number of unread
+        messages from others. A single query; the last message and the unread range
+        are index lookups on (conversation_id, id), a window function picks the
+        other user of a direct conversation.
+        """
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                f"""
+                WITH mine AS (
+                    SELECT conversation_id, COALESCE(last_read_message_id, 0) AS read_to
+                    FROM {PARTICIPANTS_TABLE_NAME}
+                    WHERE user_id = :user_id
+                ),
+                latest AS (
+                    SELECT mine.conversation_id,
+                           (SELECT MAX(m.id) FROM {MESSAGE_TABLE_NAME} m
+                            WHERE m.conversation_id = mine.conversation_id) AS last_id
+                    FROM mine
+                ),
+                unread AS (
+                    SELECT m.conversation_id, COUNT(*) AS unread_count
+                    FROM mine
+                    JOIN {MESSAGE_TABLE_NAME} m ON m.conversation_id = mine.conversation_id AND m.id > mine.read_to
+                    WHERE m.sender_id != :user_id
+                    GROUP BY m.conversation_id
+                ),
+                others AS (
+                    SELECT o.conversation_id, u.username,
+                           ROW_NUMBER() OVER (PARTITION BY o.conversation_id ORDER BY o.id) AS rn
+                    FROM mine
+                    JOIN {PARTICIPANTS_TABLE_NAME} o ON o.conversation_id = mine.conversation_id
+                    JOIN {USER_TABLE_NAME} u ON u.id = o.user_id
+                    WHERE o.user_id != :user_id
+                )
+                SELECT c.id AS conversation_id,
+                       c.type,
+                       CASE c.type WHEN 'direct' THEN others.username ELSE c.name END AS display_name,
+                       m.id AS last_message_id,
+                       substr(CASE WHEN json_valid(m.content) THEN json_extract(m.content, '$.data.msg')
+                                   ELSE m.content END, 1, :preview) AS last_message,
+                       m.sender_id AS last_sender_id,
+                       m.created_at AS last_message_at,
+                       COALESCE(unread.unread_count, 0) AS unread_count
+                FROM latest
+                JOIN {CONVERSATION_TABLE_NAME} c ON c.id = latest.conversation_id
+                LEFT JOIN {MESSAGE_TABLE_NAME} m ON m.id = latest.last_id
+                LEFT JOIN unread ON unread.conversation_id = c.id
+                LEFT JOIN others ON others.conversation_id = c.id AND others.rn = 1
+                ORDER BY COALESCE(m.id, 0) DESC, c.id DESC
+                """,
+                {"user_id": user_id, "preview": INBOX_PREVIEW_CHARS},
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return [
+            {**dict(row), "last_message_at": str(row["last_message_at"]) if row["last_message_at"] is not None else None}
+            for row in rows
+        ]
+
     async def get_messages_from(self, conversation_id: int, last_message: Optional[int] = None) -> list[dict]:
-        limit = 10
+        limit = HISTORY_PAGE_SIZE
         async with self.get_connection() as conn:
             if last_message is None:
                 async with conn.execute(
@@ -428,6 +705,105 @@ class DBWrapper:
             for row in reversed(rows)
         ]
     
+    async def iter_missed_messages(self,
+                                   user_id: int,
+                                   high_water: Optional[dict[int, int]] = None,
+                                   cursor: Optional[int] = None,
+                                   page_size: int = 500) -> AsyncGenerator[dict, None]:
+        """
+        Every message the user has not seen yet, across all of their conversations,
+        in message id order. A conversation counts as seen up to ``cursor`` when
+        given, else up to its entry in ``high_water``, else up to the participant's
+        read marker. Each conversation is paged from its own high water on
+        (conversation_id, id), so a long-unread conversation doesn't make the
+        others read history the user already saw, and the pages are merged by
+        id. At most one page per conversation is held in memory.
+        """
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                f"SELECT conversation_id, last_read_message_id FROM {PARTICIPANTS_TABLE_NAME} WHERE user_id = ?",
+                (user_id,)
+            ) as cur:
+                participant_rows = await cur.fetchall()
+            if not participant_rows:
+                return
+
+            high_water = high_water or {}
+            seen = {
+                row["conversation_id"]: cursor if cursor is not None
+                else high_water.get(row["conversation_id"], row["last_read_message_id"] or 0)
+                for row in participant_rows
+            }
+
+            async def page(conversation_id: int, after_id: int) -> list[aiosqlite.Row]:
+                async with conn.execute(
+                    f"""
+                    SELECT id, conversation_id, sender_id, content, created_at
+                    FROM {MESSAGE_TABLE_NAME}
+                    WHERE conversation_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                    """,
+                    (conversation_id, after_id, page_size)
+                ) as cur:
+                    return await cur.fetchall()
+
+            # (next id, conversation) of every conversation with something left to read
+            heads: list[tuple[int, int]] = []
+            pages: dict[int, deque] = {}
+            # conversations whose last page came back short, nothing more to read there
+            drained = set()
+            for conversation_id, after_id in seen.items():
+                rows = await page(conversation_id, after_id)
+                if len(rows) < page_size:
+                    drained.add(conversation_id)
+                if rows:
+                    pages[conversation_id] = deque(rows)
+                    heapq.heappush(heads, (rows[0]["id"], conversation_id))
+
+            while heads:
+                _, conversation_id = heapq.heappop(heads)
+                rows = pages[conversation_id]
+                row = rows.popleft()
+                yield {
+                    "id": row["id"],
+                    "room_id": row["conversation_id"],
+                    "sender_id": row["sender_id"],
+                    "content": row["content"],
+                    "created_at": str(row["created_at"]),
+                }
+                if not rows and conversation_id not in drained:
+                    rows.extend(await page(conversation_id, row["id"]))
+                    if len(rows) < page_size:
+                        drained.add(conversation_id)
+                if rows:
+                    heapq.heappush(heads, (rows[0]["id"], conversation_id))
+                else:
+                    del pages[conversation_id]
+
+    async def iter_conversation_messages(self,
+                                         conversation_id: int,
+                                         after_id: int = 0,
+                                         chunk_size: int = 1000) -> AsyncGenerator[list[aiosqlite.Row], None]:
+        """Whole history of a conversation in id order, one chunk of rows at a time."""
+        async with self.get_connection() as conn:
+            while True:
+                async with conn.execute(
+                    f"""
+                    SELECT id, conversation_id, sender_id, created_at, content
+                    FROM {MESSAGE_TABLE_NAME}
+                    WHERE conversation_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                    """,
+                    (conversation_id, after_id, chunk_size)
+                ) as cursor:
+                    rows = await cursor.fetchall()
+                if not rows:
+                    return
+                yield rows
+                after_id = rows[-1]["id"]
+
     async def get_user_groups(self, username: str) -> list[dict]:
         async with self.get_connection() as conn:
             async with conn.execute(
@@ -446,7 +822,7 @@ class DBWrapper:
     async def create_conversation(self, name: str | None, type: ConversationType, creator: int) -> bool:
         async with self.get_connection() as conn:
             cursor = await conn.execute(
-                f"INSERT INTO {CONVERSATION_TABLE_NAME} (name, type, creator) VALUES (?, ?, ?)",
+                f"INSERT INTO {CONVERSATION_TABLE_NAME} (name, type, admin) VALUES (?, ?, ?)",
                 (name, type.value, creator),
             )
             await conn.commit()
@@ -456,6 +832,11 @@ class DBWrapper:
                 return True
                 
 
+    async def _participants_changed(self, payload: dict) -> None:
+        # versions first: an ETag must never be older than the rows it describes
+        self.versions.changed(payload)
+        await self.event_handler.call_event(self.participants_event, payload)
+
     async def remove_participant(self, group_id, user_id):
         async with self.get_connection() as conn:
             await conn.execute(
@@ -463,6 +844,7 @@ class DBWrapper:
                 (group_id, user_id),
             )
             await conn.commit()
+        await self._participants_changed({"conversation_id": group_id, "removed": [user_id]})
 
     async def create_participants(self, conversation_id, user_id):
         async with self.get_connection() as conn:
@@ -471,43 +853,141 @@ class DBWrapper:
                 (conversation_id, user_id),
             )
             await conn.commit()
+        await self._participants_changed({"conversation_id": conversation_id, "added": [user_id]})
 
-    async def add_message_to_history(self, msg_body, sender : User):
-        if msg_body["room_id"] is not None:
+    async def is_participant(self, conversation_id: int, user_id: int) -> bool:
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                f"SELECT 1 FROM {PARTICIPANTS_TABLE_NAME} WHERE conversation_id = ? AND user_id = ?",
+                (conversation_id, user_id),
+            ) as cursor:
+                return await cursor.fetchone() is not None
 
-            async with self.get_connection() as conn:
-                import json
-                await conn.execute(
-                    f"INSERT INTO {MESSAGE_TABLE_NAME} (conversation_id, sender_id, content, created_at) VALUES (?, ?, ?, ?)",
-                    (
-                        msg_body["room_id"],
-                        await sender.set_id(self),
-                        json.dumps(msg_body),
-                        msg_body.get("created_at", datetime.now(timezone.utc)),
-                    ),
+    async def add_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]:
+        """
+        Add many users to a conversation in one transaction.
+        Returns username -> "added" | "already_participant" | "user_not_found".
+        """
+        async with self.get_connection() as conn:
+            ids = await self.resolve_user_ids(conn, usernames)
+            existing = await self._participant_ids(conn, conversation_id, ids.values())
+            new_ids = [user_id for user_id in dict.fromkeys(ids.values()) if user_id not in existing]
+            try:
+                await conn.executemany(
+                    f"INSERT INTO {PARTICIPANTS_TABLE_NAME} (conversation_id, user_id) VALUES (?, ?)",
+                    ((conversation_id, user_id) for user_id in new_ids),
                 )
-                await conn.commit()
+            except aiosqlite.IntegrityError:
+                raise ConversationNotFound(conversation_id)
+            await conn.commit()
+
+        if new_ids:
+            await self._participants_changed({"conversation_id": conversation_id, "added": new_ids})
+        return {
+            name: "user_not_found" if name not in ids
+            else "already_participant" if ids[name] in existing
+            else "added"
+            for name in usernames
+        }
+
+    async def remove_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]:
+        """
+        Remove many users from a conversation in one transaction.
+        Returns username -> "removed" | "not_a_participant" | "user_not_found".
+        """
+        async with self.get_connection() as conn:
+            ids = await self.resolve_user_ids(conn, usernames)
+            existing = await self._participant_ids(conn, conversation_id, ids.values())
+            await conn.executemany(
+                f"DELETE FROM {PARTICIPANTS_TABLE_NAME} WHERE conversation_id = ? AND user_id = ?",
+                ((conversation_id, user_id) for user_id in existing),
+            )
+            await conn.commit()
+
+        if existing:
+            await self._participants_changed({"conversation_id": conversation_id, "removed": sorted(existing)})
+        return {
+            name: "user_not_found" if name not in ids
+            else "removed" if ids[name] in existing
+            else "not_a_participant"
+            for name in usernames
+        }
+
+    async def _participant_ids(self, conn: aiosqlite.Connection, conversation_id: int, user_ids) -> set[int]:
+        async with conn.execute(
+            f"""
+            SELECT user_id FROM {PARTICIPANTS_TABLE_NAME}
+            WHERE conversation_id = ? AND user_id IN (SELECT value FROM json_each(?))
+            """,
+            (conversation_id, json.dumps(list(user_ids))),
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def add_message_to_history(self, msg_body, sender : UserRecord):
+        if msg_body["room_id"] is not None:
+            await self.add_messages_to_history([msg_body], sender, mark_read=False)
             return
         return
 
-    async def retrieve_direct_convo(self, friend: User, user: User):
+    async def add_messages_to_history(self, messages: list[dict], sender: UserRecord, mark_read: bool = True) -> list[int]:
+        """
+        Persist a batch of messages from one sender in a single transaction and
+        return their ids in order. With ``mark_read`` the sender's read marker of
+        every touched conversation moves to the sender's newest message there, in
+        the same transaction. A conversation that doesn't exist raises
+        ConversationNotFound and nothing of the batch is written.
+        """
+        messages = [m for m in messages if m["room_id"] is not None]
+        if not messages:
+            return []
+        now = datetime.now(timezone.utc)
+
         async with self.get_connection() as conn:
+            rooms = list(dict.fromkeys(m["room_id"] for m in messages))
             async with conn.execute(
-                f"""
-                SELECT c.*
-                FROM {CONVERSATION_TABLE_NAME} c
-                JOIN {PARTICIPANTS_TABLE_NAME} p1 ON c.id = p1.conversation_id
-                JOIN {PARTICIPANTS_TABLE_NAME} p2 ON c.id = p2.conversation_id
-                WHERE p1.user_id = (SELECT id FROM users WHERE username = ?)
-                  AND p2.user_id = (SELECT id FROM users WHERE username = ?)
-                  AND c.type = ?
-                """,
-                (user._credentials.username, friend._credentials.username, ConversationType.Direct.value)
+                f"SELECT id FROM {CONVERSATION_TABLE_NAME} WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(rooms),),
+            ) as cursor:
+                found = {row[0] for row in await cursor.fetchall()}
+            for room_id in rooms:
+                if room_id not in found:
+                    # same contract as the memory engine: nothing of the batch is written
+                    raise ConversationNotFound(room_id)
+            await conn.executemany(
+                f"INSERT INTO {MESSAGE_TABLE_NAME} (conversation_id, sender_id, content, created_at) VALUES (?, ?, ?, ?)",
+                ((m["room_id"], sender.id, json.dumps(m), m.get("created_at", now)) for m in messages),
+            )
+            # ids are consecutive, we hold the write lock for the whole transaction
+            async with conn.execute("SELECT last_insert_rowid()") as cursor:
+                last_id = (await cursor.fetchone())[0]
+            ids = list(range(last_id - len(messages) + 1, last_id + 1))
+
+            if mark_read:
+                newest = {}
+                for m, message_id in zip(messages, ids):
+                    newest[m["room_id"]] = message_id
+                await conn.executemany(
+                    f"UPDATE {PARTICIPANTS_TABLE_NAME} SET last_read_message_id = ? WHERE conversation_id = ? AND user_id = ?",
+                    ((message_id, room_id, sender.id) for room_id, message_id in newest.items()),
+                )
+            await conn.commit()
+        return ids
+
+    async def retrieve_direct_convo(self, friend: UserRecord, user: UserRecord) -> Optional[int]:
+        pair = (min(friend.id, user.id), max(friend.id, user.id))
+        conversation_id = self._direct_pairs.get(pair)
+        if conversation_id is not None:
+            return conversation_id
+        async with self.get_connection() as conn:
+            async with conn.execute(
+                f"SELECT conversation_id FROM {DIRECT_CONVERSATION_TABLE_NAME} WHERE user_low = ? AND user_high = ?",
+                pair,
             ) as cursor:
                 row = await cursor.fetchone()
-                if row == None:
-                    return None
-                return row["id"]
+        if row is None:
+            return None
+        self._direct_pairs[pair] = row["conversation_id"]
+        return row["conversation_id"]
     
     async def update_last_message(self, participant_id, message_id):
         async with self.get_connection() as conn:
@@ -517,38 +997,47 @@ class DBWrapper:
             )
             await conn.commit()
 
-    async def create_direct_chat(self, user_a: User, user_b: User):
+    async def create_direct_chat(self, user_a: UserRecord, user_b: UserRecord) -> int:
         """
-        Create a direct conversation between user_a and user_b, and add both as participants.
-        Returns the conversation id.
+        Get or create the direct conversation between user_a and user_b in one
+        transaction and return its id. The (user_low, user_high) primary key
+        makes sure concurrent callers end up with the same conversation.
         """
+        pair = (min(user_a.id, user_b.id), max(user_a.id, user_b.id))
+        conversation_id = self._direct_pairs.get(pair)
+        if conversation_id is not None:
+            return conversation_id
+
+        created = False
         async with self.get_connection() as conn:
-            cursor = await conn.execute(
-                f"INSERT INTO {CONVERSATION_TABLE_NAME} (name, type) VALUES (?, ?)",
-                (None, ConversationType.Direct.value),
-            )
-            conversation_id = cursor.lastrowid
-
-            # Get user ids
-            async with conn.execute("SELECT id FROM users WHERE username = ?", (user_a._credentials.username,)) as cur_a:
-                row_a = await cur_a.fetchone()
-            async with conn.execute("SELECT id FROM users WHERE username = ?", (user_b._credentials.username,)) as cur_b:
-                row_b = await cur_b.fetchone()
-            if not row_a or not row_b:
-                raise HTTPException(status_code=404, detail="One or both users not found")
-            user_a_id = row_a["id"]
-            user_b_id = row_b["id"]
-
-            # Add both users as participants
-            await conn.execute(
-                f"INSERT INTO {PARTICIPANTS_TABLE_NAME} (conversation_id, user_id) VALUES (?, ?)",
-                (conversation_id, user_a_id),
-            )
-            await conn.execute(
-                f"INSERT INTO {PARTICIPANTS_TABLE_NAME} (conversation_id, user_id) VALUES (?, ?)",
-                (conversation_id, user_b_id),
-            )
+            # take the write lock before looking, so two creators can't both see a miss
+            await conn.execute("BEGIN IMMEDIATE")
+            async with conn.execute(
+                f"SELECT conversation_id FROM {DIRECT_CONVERSATION_TABLE_NAME} WHERE user_low = ? AND user_high = ?",
+                pair,
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                conversation_id = row["conversation_id"]
+            else:
+                cursor = await conn.execute(
+                    f"INSERT INTO {CONVERSATION_TABLE_NAME} (name, type) VALUES (?, ?)",
+                    (None, ConversationType.Direct.value),
+                )
+                conversation_id = cursor.lastrowid
+                await conn.execute(
+                    f"INSERT INTO {DIRECT_CONVERSATION_TABLE_NAME} (user_low, user_high, conversation_id) VALUES (?, ?, ?)",
+                    (*pair, conversation_id),
+                )
+                # Add both users as participants
+                await conn.executemany(
+                    f"INSERT INTO {PARTICIPANTS_TABLE_NAME} (conversation_id, user_id) VALUES (?, ?)",
+                    ((conversation_id, user_id) for user_id in pair),
+                )
+                created = True
             await conn.commit()
-        return conversation_id
-
 
+        self._direct_pairs[pair] = conversation_id
+        if created:
+            await self._participants_changed({"conversation_id": conversation_id, "added": list(pair)})
+        return conversation_id
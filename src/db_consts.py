@@ -56,4 +56,23 @@ MESSAGE_TABLE = """CREATE TABLE IF NOT EXISTS messages(
                         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                         FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
                         FOREIGN KEY (sender_id) REFERENCES users(id)
-                    );"""
\ No newline at end of file
+                    );"""
+
+DIRECT_CONVERSATION_TABLE_NAME = "direct_conversations"
+
+# one row per pair of users, user_low < user_high, so a pair can only ever own one direct conversation
+DIRECT_CONVERSATION_TABLE = """CREATE TABLE IF NOT EXISTS direct_conversations(
+                        user_low INTEGER NOT NULL,
+                        user_high INTEGER NOT NULL,
+                        conversation_id INTEGER NOT NULL UNIQUE,
+                        PRIMARY KEY (user_low, user_high),
+                        CHECK (user_low < user_high),
+                        FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
+                        FOREIGN KEY (user_low) REFERENCES users(id),
+                        FOREIGN KEY (user_high) REFERENCES users(id)
+                    );"""
+
+
+
+INDEXES = """CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id);
+             CREATE INDEX IF NOT EXISTS idx_participants_user ON participants(user_id);"""
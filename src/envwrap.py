@@ -9,4 +9,28 @@ class EnvParam():
     ALL_PATHS : PathWrap
     BEARER_TOKEN : str
     TENOR_API : str
-    GIPHY_API : str
\ No newline at end of file
+    GIPHY_API : str
+    AUTH_CONCURRENCY : int = 16
+    AUTH_QUEUE_LIMIT : int = 512
+    WS_DEFLATE_THRESHOLD : int = 1024
+    WS_PER_MESSAGE_DEFLATE : bool = True
+    WS_RATE_LIMIT : float = 20.0
+    WS_RATE_BURST : float = 40.0
+    WS_RATE_MODE : str = "delay"
+    AUTH_RATE_LIMIT : float = 1.0
+    AUTH_RATE_BURST : float = 10.0
+    WS_HEARTBEAT_INTERVAL : float = 30.0
+    WS_HEARTBEAT_TIMEOUT : float = 90.0
+    STORAGE_ENGINE : str = "sqlite"
+    ATTACHMENT_MAX_SIZE : int = 256 * 1024 * 1024
+    MAINTENANCE_INTERVAL : float = 3600.0
+    MAINTENANCE_QUIET : float = 60.0
+    DB_BACKUP_INTERVAL : float = 0.0
+    DB_BACKUP_KEEP : int = 7
+    RECENT_MESSAGES_PER_CONVERSATION : int = 50
+    RECENT_MESSAGES_MAX_BYTES : int = 64 * 1024 * 1024
+    LOOP_LAG_INTERVAL : float = 0.1
+    LOOP_STALL_THRESHOLD : float = 0.25
+    TRAFFIC_RECORD_PATH : str = ""
+    TRAFFIC_RECORD_SECRET : str = ""
+    MEMORY_ACCOUNTING_INTERVAL : float = 60.0
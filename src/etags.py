@@ -0,0 +1,75 @@
+import secrets
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from metrics import METRICS, MetricsRegistry
+
+
+def if_none_match(headers, etag: str) -> bool:
+    """True when the request's ``If-None-Match`` names ``etag`` (or ``*``)."""
+    header = headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in tags or "*" in tags
+
+
+class MembershipVersions():
+    """
+    Version counters for everything a participants change can alter: the
+    conversations of each user and the participant list of each
+    conversation. The storage engines bump them in the same call that
+    changes the rows, before the ``participants_event`` is even queued, so an
+    ETag built from them is never behind the database.
+
+    Counters live in memory and start over with the process, the random
+    ``epoch`` in every tag keeps tags from before a restart from matching.
+    """
+    def __init__(self):
+        self._epoch = secrets.token_hex(4)
+        self._users: Dict[int, int] = {}
+        self._conversations: Dict[int, int] = {}
+
+    def changed(self, payload: dict) -> None:
+        """Bump after a participants change, takes the ``participants_event`` payload."""
+        conversation_id = payload.get("conversation_id")
+        if conversation_id is not None:
+            self._conversations[conversation_id] = self._conversations.get(conversation_id, 0) + 1
+        for user_id in payload.get("added", []) + payload.get("removed", []):
+            self._users[user_id] = self._users.get(user_id, 0) + 1
+
+    def user_etag(self, user_id: int) -> str:
+        return f'"{self._epoch}-u{user_id}-{self._users.get(user_id, 0)}"'
+
+    def conversation_etag(self, conversation_id: int) -> str:
+        return f'"{self._epoch}-c{conversation_id}-{self._conversations.get(conversation_id, 0)}"'
+
+
+class ResponseCache():
+    """
+    Serialized response bodies by ETag, least recently used evicted beyond
+    ``max_entries``. A new version means a new tag, so entries are never
+    invalidated, the old ones simply age out.
+    """
+    def __init__(self, max_entries: int = 10000, metrics: MetricsRegistry = METRICS):
+        self._max_entries = max_entries
+        self._bodies: OrderedDict[str, bytes] = OrderedDict()
+
+        metrics.gauge("etag_cache_entries", lambda: len(self._bodies))
+        self._hits = metrics.counter("etag_cache_hits_total")
+        self._misses = metrics.counter("etag_cache_misses_total")
+        self.not_modified = metrics.counter("etag_not_modified_total")
+
+    def get(self, etag: str) -> Optional[bytes]:
+        body = self._bodies.get(etag)
+        if body is None:
+            self._misses.inc()
+            return None
+        self._bodies.move_to_end(etag)
+        self._hits.inc()
+        return body
+
+    def put(self, etag: str, body: bytes) -> None:
+        self._bodies[etag] = body
+        if len(self._bodies) > self._max_entries:
+            self._bodies.popitem(last=False)
@@ -1,23 +1,109 @@
 from _collections_abc import Awaitable, Callable
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 import asyncio
+import logging
+import time
+
+from metrics import METRICS, MetricsRegistry
 
 
 Listener = Callable[[str, Dict[str, Any]], Awaitable[None]]
+BatchListener = Callable[[str, List[Dict[str, Any]]], Awaitable[None]]
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
 
 
 class EventHandler():
-    def __init__(self):
-        self._listeners: Dict[str, List[Listener]] = {}
-        pass
+    """
+    Event bus with one bounded queue and one consumer task per event name.
+
+    Events of the same name are delivered strictly in the order they were
+    raised, one listener after the other. ``call_event`` only waits when the
+    queue is full, which pushes back on producers instead of piling up tasks.
+    Bursts are drained in batches: plain listeners still get one payload per
+    call, listeners registered with ``batched=True`` get the whole batch.
+    Listener errors are logged and counted, they never kill the consumer.
+    Events raised after ``shutdown`` began are logged, counted and dropped.
+    """
+    def __init__(self, max_queue: int = 1024, max_batch: int = 64, metrics: MetricsRegistry = METRICS):
+        self._listeners: Dict[str, List[Tuple[Callable, bool]]] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._consumers: Dict[str, asyncio.Task] = {}
+        self._max_queue = max_queue
+        self._max_batch = max_batch
+        self._closing = False
 
-    def add_listener(self, event: str, cb: Listener) -> None:
-        self._listeners.setdefault(event, []).append(cb)
+        metrics.gauge("event_queue_depth", lambda: sum(q.qsize() for q in self._queues.values()))
+        self._published = metrics.counter("event_published_total")
+        self._delivered = metrics.counter("event_delivered_total")
+        self._dropped = metrics.counter("event_dropped_total")
+        self._failures = metrics.counter("event_listener_failures_total")
+        self._lag = metrics.histogram("event_queue_lag_seconds")
+        self._batch_size = metrics.histogram("event_batch_size", BATCH_BUCKETS)
+
+    def add_listener(self, event: str, cb: Listener | BatchListener, batched: bool = False) -> None:
+        self._listeners.setdefault(event, []).append((cb, batched))
+
+    def remove_listener(self, event: str, cb: Listener | BatchListener) -> None:
+        listeners = self._listeners.get(event, [])
+        listeners[:] = [entry for entry in listeners if entry[0] != cb]
 
-    def remove_listener(self, event: str, cb: Listener) -> None:
-        self._listeners.get(event, []).remove(cb)
-    
     async def call_event(self, event: str, payload: Dict[str, Any] | None = None) -> None:
-        for cb in self._listeners.get(event, []):
-            # every listener runs in its own task – never blocks the caller
-            asyncio.create_task(cb(event, payload or {}))
\ No newline at end of file
+        if self._closing:
+            # the change behind the event is already committed, failing the caller wouldn't undo it
+            self._dropped.inc()
+            logging.warning(f"EventHandler is shutting down, dropped {event}")
+            return
+        queue = self._queues.get(event)
+        if queue is None:
+            queue = asyncio.Queue(self._max_queue)
+            self._queues[event] = queue
+            self._consumers[event] = asyncio.create_task(self._consume(event, queue), name=f"event:{event}")
+        await queue.put((time.perf_counter(), payload or {}))
+        self._published.inc()
+
+    async def _consume(self, event: str, queue: asyncio.Queue) -> None:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            self._batch_size.observe(len(batch))
+
+            now = time.perf_counter()
+            for enqueued_at, _ in batch:
+                self._lag.observe(now - enqueued_at)
+            payloads = [payload for _, payload in batch]
+
+            for cb, batched in list(self._listeners.get(event, [])):
+                if batched:
+                    await self._deliver(event, cb, payloads)
+                else:
+                    for payload in payloads:
+                        await self._deliver(event, cb, payload)
+
+            for _ in batch:
+                queue.task_done()
+
+    async def _deliver(self, event: str, cb: Callable, payload) -> None:
+        try:
+            await cb(event, payload)
+            self._delivered.inc()
+        except Exception:
+            self._failures.inc()
+            logging.exception(f"Listener {getattr(cb, '__qualname__', cb)} failed on {event}")
+
+    async def shutdown(self, timeout: float = 5.0) -> None:
+        """Stop accepting events, deliver what is queued and stop the consumers."""
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"EventHandler shutdown timed out with {sum(q.qsize() for q in self._queues.values())} events queued")
+        for task in self._consumers.values():
+            task.cancel()
+        await asyncio.gather(*self._consumers.values(), return_exceptions=True)
+        self._consumers.clear()
+        self._queues.clear()
@@ -0,0 +1,70 @@
+import csv
+import io
+import json
+import zlib
+from typing import AsyncGenerator
+
+from storage import Storage
+
+EXPORT_FIELDS = ("id", "conversation_id", "sender_id", "created_at", "content")
+EXPORT_FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _ndjson(rows) -> str:
+    return "".join(
+        json.dumps({field: (str(row[field]) if field == "created_at" else row[field]) for field in EXPORT_FIELDS}) + "\n"
+        for row in rows
+    )
+
+
+def _csv(rows, header: bool = False) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows([row[field] for field in EXPORT_FIELDS] for row in rows)
+    return buf.getvalue()
+
+
+async def export_conversation(db: Storage,
+                              conversation_id: int,
+                              fmt: str = "ndjson",
+                              compress: bool = False,
+                              after_id: int = 0,
+                              chunk_size: int = 1000) -> AsyncGenerator[bytes, None]:
+    """
+    Encode a conversation as NDJSON or CSV while it is read, optionally gzipped
+    on the fly. Memory use is one chunk of rows no matter how long the history is.
+
+    ``after_id`` resumes an interrupted export: the output can be appended to
+    the partial file (a gzip stream simply gets a second member, which every
+    gzip reader concatenates). The CSV header is only written on a fresh export.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, use one of {EXPORT_FORMATS}")
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    header = fmt == "csv" and after_id == 0
+
+    async for rows in db.iter_conversation_messages(conversation_id, after_id, chunk_size):
+        if fmt == "csv":
+            data = _csv(rows, header).encode()
+            header = False
+        else:
+            data = _ndjson(rows).encode()
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+
+    if header:
+        # empty conversation, still produce a valid CSV
+        data = _csv([], True).encode()
+        yield compressor.compress(data) if compressor is not None else data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def export_filename(conversation_id: int, fmt: str, compress: bool) -> str:
+    return f"conversation_{conversation_id}.{fmt}" + (".gz" if compress else "")
@@ -0,0 +1,107 @@
+from typing import Annotated, List, Literal, Optional, Union
+
+from pydantic import ConfigDict, Field, TypeAdapter, ValidationError, conint, constr
+from pydantic.dataclasses import dataclass
+
+
+# unknown keys are dropped, what gets stored and fanned out is what the schema knows
+_CONFIG = ConfigDict(extra="ignore")
+
+
+class InvalidFrame(ValueError):
+    """An inbound frame that didn't decode or didn't match its schema."""
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+# a reference with anything more than these fields is refused, not trimmed
+@dataclass(slots=True, config=ConfigDict(extra="forbid"))
+class AttachmentRef():
+    """
+    What a message carries of an attachment, the fields POST /api/attachments
+    returned. The bytes stay in the AttachmentStore, the backend checks that
+    ``id`` is stored there with this size and media type before the message is.
+    """
+    id: constr(pattern=r"^[0-9a-f]{64}$")
+    name: constr(max_length=255) = ""
+    media_type: constr(max_length=255) = "application/octet-stream"
+    size: conint(ge=0) = 0
+    thumbnail: bool = False
+    # part of the upload answer, accepted so clients can pass it on as is, never stored
+    deduplicated: bool = False
+
+    def reference(self) -> dict:
+        return {"id": self.id, "name": self.name, "media_type": self.media_type,
+                "size": self.size, "thumbnail": self.thumbnail}
+
+
+@dataclass(slots=True, config=_CONFIG)
+class MessageData():
+    msg: str
+    attachment: Optional[AttachmentRef] = None
+
+
+@dataclass(slots=True, config=_CONFIG)
+class ChatMessage():
+    """
+    One chat message. The sender is never taken from the frame: a "from" key
+    is ignored and ``envelope`` fills in the authenticated user.
+    """
+    type: Literal["message"]
+    data: MessageData
+    room_id: conint(gt=0)
+    room_name: Optional[str] = None
+    chat_type: Optional[Literal["direct", "group"]] = None
+
+    def envelope(self, sender: str) -> dict:
+        """The dict that is stored and fanned out, in the shape clients always got."""
+        data = {"msg": self.data.msg}
+        if self.data.attachment is not None:
+            data["attachment"] = self.data.attachment.reference()
+        envelope = {"type": "message", "data": data, "from": sender, "room_id": self.room_id}
+        if self.room_name is not None:
+            envelope["room_name"] = self.room_name
+        if self.chat_type is not None:
+            envelope["chat_type"] = self.chat_type
+        return envelope
+
+
+@dataclass(slots=True, config=_CONFIG)
+class BatchFrame():
+    type: Literal["batch"]
+    messages: List[ChatMessage] = Field(default_factory=list)
+
+
+@dataclass(slots=True, config=_CONFIG)
+class PingFrame():
+    type: Literal["ping"]
+
+
+@dataclass(slots=True, config=_CONFIG)
+class PongFrame():
+    type: Literal["pong"]
+
+
+@dataclass(slots=True, config=_CONFIG)
+class AuthFrame():
+    username: str = ""
+    password: str = ""
+    session_id: Optional[str] = ""
+    attempt: int = 0
+
+
+ChatFrame = Annotated[Union[ChatMessage, BatchFrame, PingFrame, PongFrame], Field(discriminator="type")]
+
+# compiled once; JSON text goes straight from bytes to these structs without an intermediate dict
+CHAT_FRAME = TypeAdapter(ChatFrame)
+AUTH_FRAME = TypeAdapter(AuthFrame)
+
+
+def describe(error: ValidationError, limit: int = 3) -> str:
+    """A short, client-facing summary of the first few problems."""
+    problems = []
+    for e in error.errors(include_url=False, include_input=False)[:limit]:
+        where = ".".join(str(part) for part in e["loc"])
+        problems.append(f"{where}: {e['msg']}" if where else e["msg"])
+    return "; ".join(problems)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from fastapi import status
+
+from metrics import METRICS, MetricsRegistry
+from user_registry import Connection, UserRegistry
+from wire import send_encoded
+
+
+PING = {"type": "ping"}
+PING_WORKERS = 32
+
+
+class HeartbeatMonitor():
+    """
+    Finds dead websockets without waiting for a fan-out to trip over them.
+
+    Every connection carries a ``last_seen`` stamp that the chat handler bumps
+    on each inbound frame. One task sweeps the registry every ``interval``
+    seconds: connections quiet for longer than ``interval`` get a ping frame
+    (clients answer with ``{"type": "pong"}``), connections quiet for longer
+    than ``timeout`` or whose ping could not be sent are dropped from the
+    registry in one go and their sockets closed.
+    """
+    def __init__(self,
+                 interval: float = 30.0,
+                 timeout: float = 90.0,
+                 send_timeout: float = 5.0,
+                 users: Optional[UserRegistry] = None,
+                 metrics: MetricsRegistry = METRICS):
+        self._interval = interval
+        self._timeout = timeout
+        self._send_timeout = send_timeout
+        self._users = users
+        self._task: Optional[asyncio.Task] = None
+
+        self._pings = metrics.counter("heartbeat_pings_total")
+        self._reaped = metrics.counter("heartbeat_reaped_total")
+        self._sweep_time = metrics.histogram("heartbeat_sweep_seconds")
+
+    def start(self, users: Optional[UserRegistry] = None) -> None:
+        """Start sweeping ``users``, or the registry given at construction."""
+        if users is not None:
+            self._users = users
+        if self._interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="heartbeat")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("Heartbeat sweep failed")
+
+    async def sweep(self, now: Optional[float] = None) -> tuple[int, int]:
+        """One pass over all connections, returns ``(pinged, reaped)``."""
+        start = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        ping_before = now - self._interval
+        dead_before = now - self._timeout
+
+        stale: List[Connection] = []
+        idle: List[Connection] = []
+        for conn in self._users.online():
+            if conn.last_seen < dead_before:
+                stale.append(conn)
+            elif conn.last_seen < ping_before:
+                idle.append(conn)
+
+        pinged = 0
+        if idle:
+            frames = {}
+            for conn in idle:
+                if conn.codec not in frames:
+                    frames[conn.codec] = conn.codec.encode(PING)
+            # a few workers share the list, so one stuck peer only holds up its own worker
+            failed: List[Connection] = []
+            await asyncio.gather(*(self._ping(idle[i::PING_WORKERS], frames, failed) for i in range(PING_WORKERS)))
+            pinged = len(idle) - len(failed)
+            stale.extend(failed)
+
+        await self.reap(stale)
+        self._sweep_time.observe(time.perf_counter() - start)
+        return pinged, len(stale)
+
+    async def _ping(self, conns: List[Connection], frames: dict, failed: List[Connection]) -> None:
+        for conn in conns:
+            try:
+                async with asyncio.timeout(self._send_timeout):
+                    await send_encoded(conn.ws, frames[conn.codec])
+                self._pings.inc()
+            except Exception:
+                failed.append(conn)
+
+    async def reap(self, conns: List[Connection]) -> None:
+        """
+        Remove ``conns`` from the registry first, so fan-out and presence stop
+        seeing them at once, then close the sockets concurrently.
+        """
+        if not conns:
+            return
+        gone = [conn for conn in conns if self._users.disconnect(conn.user.username, conn.ws) is not None]
+        self._reaped.inc(len(gone))
+        if gone:
+            logging.info(f"Reaped {len(gone)} idle connections")
+            await asyncio.gather(*(self._close(gone[i::PING_WORKERS]) for i in range(PING_WORKERS)))
+
+    async def _close(self, conns: List[Connection]) -> None:
+        for conn in conns:
+            try:
+                async with asyncio.timeout(self._send_timeout):
+                    await conn.ws.close(code=status.WS_1001_GOING_AWAY)
+            except Exception:
+                pass
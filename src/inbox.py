@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable
+
+from metrics import METRICS, MetricsRegistry
+
+
+class InboxCache():
+    """
+    Per-user cache of ``Storage.get_inbox`` results, least recently used users
+    are evicted beyond ``max_users``. Whatever changes an inbox (a persisted
+    message, a moved read marker, joining or leaving a conversation) calls
+    ``invalidate`` for the users it touches.
+
+    Every invalidation bumps the user's version, and a load only stores its
+    result when the version did not move while it ran. That way an inbox read
+    racing a new message can't put a stale copy back into the cache.
+    """
+    def __init__(self, max_users: int = 10000, metrics: MetricsRegistry = METRICS):
+        self._max_users = max_users
+        self._entries: OrderedDict[int, list] = OrderedDict()
+        self._versions: Dict[int, int] = {}
+
+        metrics.gauge("inbox_cache_users", lambda: len(self._entries))
+        self._hits = metrics.counter("inbox_cache_hits_total")
+        self._misses = metrics.counter("inbox_cache_misses_total")
+        self._invalidations = metrics.counter("inbox_cache_invalidations_total")
+
+    async def get(self, user_id: int, load: Callable[[int], Awaitable[list]]) -> list:
+        inbox = self._entries.get(user_id)
+        if inbox is not None:
+            self._entries.move_to_end(user_id)
+            self._hits.inc()
+            return inbox
+
+        self._misses.inc()
+        version = self._versions.get(user_id, 0)
+        inbox = await load(user_id)
+        if self._versions.get(user_id, 0) == version:
+            self._entries[user_id] = inbox
+            if len(self._entries) > self._max_users:
+                self._entries.popitem(last=False)
+        return inbox
+
+    def invalidate(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            if self._entries.pop(user_id, None) is not None:
+                self._invalidations.inc()
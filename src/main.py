@@ -32,8 +32,45 @@ if __name__ == "__main__":
     BEARER_TOKEN = os.getenv("BEARER_TOKEN")
     TENOR_API = os.getenv("TENOR_API")
     GIPHY_API = os.getenv("GIPHY_API")
+    AUTH_CONCURRENCY = int(os.getenv("AUTH_CONCURRENCY", 16))
+    AUTH_QUEUE_LIMIT = int(os.getenv("AUTH_QUEUE_LIMIT", 512))
+    WS_DEFLATE_THRESHOLD = int(os.getenv("WS_DEFLATE_THRESHOLD", 1024))
+    WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() in ("1", "true", "yes")
+    WS_RATE_LIMIT = float(os.getenv("WS_RATE_LIMIT", 20))
+    WS_RATE_BURST = float(os.getenv("WS_RATE_BURST", 40))
+    WS_RATE_MODE = os.getenv("WS_RATE_MODE", "delay")
+    AUTH_RATE_LIMIT = float(os.getenv("AUTH_RATE_LIMIT", 1))
+    AUTH_RATE_BURST = float(os.getenv("AUTH_RATE_BURST", 10))
+    WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", 30))
+    WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", 90))
+    STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "sqlite")
+    ATTACHMENT_MAX_SIZE = int(os.getenv("ATTACHMENT_MAX_SIZE", 256 * 1024 * 1024))
+    MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 3600))
+    MAINTENANCE_QUIET = float(os.getenv("MAINTENANCE_QUIET", 60))
+    DB_BACKUP_INTERVAL = float(os.getenv("DB_BACKUP_INTERVAL", 0))
+    DB_BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", 7))
+    RECENT_MESSAGES_PER_CONVERSATION = int(os.getenv("RECENT_MESSAGES_PER_CONVERSATION", 50))
+    RECENT_MESSAGES_MAX_BYTES = int(os.getenv("RECENT_MESSAGES_MAX_BYTES", 64 * 1024 * 1024))
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.1))
+    LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.25))
+    TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+    TRAFFIC_RECORD_SECRET = os.getenv("TRAFFIC_RECORD_SECRET", "")
+    MEMORY_ACCOUNTING_INTERVAL = float(os.getenv("MEMORY_ACCOUNTING_INTERVAL", 60))
 
-    CurrentEnv = EnvParam(HOST=HOST, PORT=PORT, ALL_PATHS=CurrentPaths, ALLOWED_ORIGINS=ALLOWED_ORIGINS, BEARER_TOKEN=BEARER_TOKEN, TENOR_API=TENOR_API, GIPHY_API=GIPHY_API)
+    CurrentEnv = EnvParam(HOST=HOST, PORT=PORT, ALL_PATHS=CurrentPaths, ALLOWED_ORIGINS=ALLOWED_ORIGINS, BEARER_TOKEN=BEARER_TOKEN, TENOR_API=TENOR_API, GIPHY_API=GIPHY_API,
+                          AUTH_CONCURRENCY=AUTH_CONCURRENCY, AUTH_QUEUE_LIMIT=AUTH_QUEUE_LIMIT,
+                          WS_DEFLATE_THRESHOLD=WS_DEFLATE_THRESHOLD, WS_PER_MESSAGE_DEFLATE=WS_PER_MESSAGE_DEFLATE,
+                          WS_RATE_LIMIT=WS_RATE_LIMIT, WS_RATE_BURST=WS_RATE_BURST, WS_RATE_MODE=WS_RATE_MODE,
+                          AUTH_RATE_LIMIT=AUTH_RATE_LIMIT, AUTH_RATE_BURST=AUTH_RATE_BURST,
+                          WS_HEARTBEAT_INTERVAL=WS_HEARTBEAT_INTERVAL, WS_HEARTBEAT_TIMEOUT=WS_HEARTBEAT_TIMEOUT,
+                          STORAGE_ENGINE=STORAGE_ENGINE, ATTACHMENT_MAX_SIZE=ATTACHMENT_MAX_SIZE,
+                          MAINTENANCE_INTERVAL=MAINTENANCE_INTERVAL, MAINTENANCE_QUIET=MAINTENANCE_QUIET,
+                          DB_BACKUP_INTERVAL=DB_BACKUP_INTERVAL, DB_BACKUP_KEEP=DB_BACKUP_KEEP,
+                          RECENT_MESSAGES_PER_CONVERSATION=RECENT_MESSAGES_PER_CONVERSATION,
+                          RECENT_MESSAGES_MAX_BYTES=RECENT_MESSAGES_MAX_BYTES,
+                          LOOP_LAG_INTERVAL=LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD=LOOP_STALL_THRESHOLD,
+                          TRAFFIC_RECORD_PATH=TRAFFIC_RECORD_PATH, TRAFFIC_RECORD_SECRET=TRAFFIC_RECORD_SECRET,
+                          MEMORY_ACCOUNTING_INTERVAL=MEMORY_ACCOUNTING_INTERVAL)
     print(f"Using Following Settings for Server Setup:{CurrentEnv}")
 
     app = FastAPI()
@@ -57,4 +94,5 @@ if __name__ == "__main__":
             ]
     )
     CurrentBackend = Backend(app, CurrentEnv, args.dedicated)
-    uvicorn.run(CurrentBackend._app, host=CurrentEnv.HOST, port=CurrentEnv.PORT, reload=False)
\ No newline at end of file
+    uvicorn.run(CurrentBackend._app, host=CurrentEnv.HOST, port=CurrentEnv.PORT, reload=False,
+                ws_per_message_deflate=CurrentEnv.WS_PER_MESSAGE_DEFLATE)
\ No newline at end of file
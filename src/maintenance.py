@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from metrics import METRICS, MetricsRegistry
+
+
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.005
+# after this many restarts caused by concurrent writes the rest is copied in one step
+BACKUP_MAX_RESTARTS = 3
+BUSY_TIMEOUT_MS = 5000
+
+
+class _Restart(Exception):
+    pass
+
+
+def _connect(db_path) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def _backup(src_path, dest_path, pages: int, pause: float, step_time, restarts, progress_pages) -> dict:
+    tmp = Path(f"{dest_path}.tmp")
+    tmp.unlink(missing_ok=True)
+    src = _connect(src_path)
+    steps, restarted = 0, 0
+    restarts_before = restarts.value
+    try:
+        # in WAL mode one step reads a snapshot without blocking any writer,
+        # while paged steps would only be restarted by every commit
+        if src.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            restarted = BACKUP_MAX_RESTARTS
+        while True:
+            dest = sqlite3.connect(tmp)
+            last = time.perf_counter()
+            remaining_before = None
+
+            def progress(status, remaining, total):
+                nonlocal last, steps, remaining_before
+                now = time.perf_counter()
+                step_time.observe(now - last)
+                steps += 1
+                progress_pages.set(total - remaining)
+                # a write from another connection makes SQLite start over from page one
+                if remaining_before is not None and remaining > remaining_before and pages > 0:
+                    raise _Restart()
+                remaining_before = remaining
+                # the read lock is released between steps, give writers room here
+                time.sleep(pause)
+                last = time.perf_counter()
+
+            try:
+                src.backup(dest, pages=pages if restarted < BACKUP_MAX_RESTARTS else -1, progress=progress)
+                dest.close()
+                break
+            except _Restart:
+                dest.close()
+                restarted += 1
+                restarts.inc()
+
+        check = sqlite3.connect(tmp)
+        try:
+            result = check.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            check.close()
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"Backup failed its quick_check: {result}")
+        os.replace(tmp, dest_path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        src.close()
+    return {"path": str(dest_path), "bytes": os.path.getsize(dest_path), "steps": steps,
+            "restarts": restarts.value - restarts_before}
+
+
+async def backup(src_path,
+                 dest_path,
+                 pages: int = BACKUP_PAGES,
+                 pause: float = BACKUP_PAUSE,
+                 metrics: MetricsRegistry = METRICS) -> dict:
+    """
+    Copy a live database with SQLite's online backup API in a worker thread,
+    so the event loop never waits on it. The copy is written next to
+    ``dest_path`` and only moved into place after a ``quick_check``.
+
+    A database in WAL mode (the default since ``init_db`` sets it) is copied
+    in one step: the backup reads a snapshot and writers carry on. With a
+    rollback journal a reader blocks every commit, so the copy goes ``pages``
+    pages per step with a ``pause`` between steps. Any write from another
+    connection restarts such a backup; after ``BACKUP_MAX_RESTARTS`` restarts
+    the rest is copied in one step, which always finishes.
+    """
+    return await asyncio.to_thread(
+        _backup, src_path, dest_path, pages, pause,
+        metrics.histogram("backup_step_seconds"),
+        metrics.counter("backup_restarts_total"),
+        metrics.gauge("backup_pages_copied"),
+    )
+
+
+# -------------------------------------------------
+# Maintenance tasks, each on its own short-lived connection
+# -------------------------------------------------
+def optimize(db_path) -> dict:
+    """``PRAGMA optimize`` with a bounded ``ANALYZE``, cheap enough to run hourly."""
+    conn = _connect(db_path)
+    try:
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+    return {}
+
+
+def checkpoint(db_path, mode: str = "PASSIVE") -> dict:
+    """WAL checkpoint, a no-op unless the database is in WAL mode."""
+    conn = _connect(db_path)
+    try:
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            return {"skipped": "not in WAL mode"}
+        busy, log, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+    return {"busy": busy, "wal_pages": log, "checkpointed": checkpointed}
+
+
+def incremental_vacuum(db_path, max_pages: int = 2000) -> dict:
+    """
+    Hand back up to ``max_pages`` free pages to the file system. Needs
+    ``auto_vacuum = INCREMENTAL``, which ``vacuum(incremental=True)`` sets.
+    """
+    conn = _connect(db_path)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return {"skipped": "auto_vacuum is not INCREMENTAL"}
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            # the pragma frees one page per step, executescript runs it to the end
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+    finally:
+        conn.close()
+    return {"freed_pages": min(free, max_pages)}
+
+
+def vacuum(db_path, incremental: bool = False) -> dict:
+    """
+    Full ``VACUUM``, rewrites the whole file and blocks every writer while it
+    runs, so it is an offline admin command. With ``incremental`` the
+    database is switched to ``auto_vacuum = INCREMENTAL`` on the way.
+    """
+    conn = _connect(db_path)
+    try:
+        before = os.path.getsize(db_path)
+        if incremental:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return {"bytes_before": before, "bytes_after": os.path.getsize(db_path)}
+
+
+class MaintenanceScheduler():
+    """
+    Runs the maintenance tasks of the SQLite engine in the background,
+    ``PRAGMA optimize`` and the incremental vacuum every ``interval`` seconds
+    and WAL checkpoints every ``checkpoint_interval``, preferably in a quiet
+    period: a due task waits until nothing was written for ``quiet`` seconds,
+    but never longer than another interval. The backend calls ``touch``
+    whenever it writes.
+
+    With ``backup_interval`` set a backup goes to ``backup_dir`` that often and
+    only the newest ``backup_keep`` are kept. Every task runs in a thread on its
+    own connection; durations end up in ``maintenance_<task>_seconds``.
+    """
+    def __init__(self,
+                 db_path,
+                 interval: float = 3600.0,
+                 quiet: float = 60.0,
+                 checkpoint_interval: float = 300.0,
+                 backup_dir: Optional[Path] = None,
+                 backup_interval: float = 0.0,
+                 backup_keep: int = 7,
+                 vacuum_pages: int = 2000,
+                 metrics: MetricsRegistry = METRICS):
+        self._db_path = db_path
+        self._quiet = quiet
+        self._backup_dir = Path(backup_dir) if backup_dir is not None else None
+        self._backup_keep = max(1, backup_keep)
+        self._metrics = metrics
+        self._task: Optional[asyncio.Task] = None
+        self._last_write = time.monotonic()
+
+        self._tasks: Dict[str, tuple[float, Callable[[], dict]]] = {}
+        if interval > 0:
+            self._tasks["optimize"] = (interval, lambda: optimize(self._db_path))
+            # a quiet server can afford to reset the log, a busy one only copies back what it can
+            self._tasks["checkpoint"] = (min(checkpoint_interval, interval),
+                                         lambda: checkpoint(self._db_path, "TRUNCATE" if self.quiet() else "PASSIVE"))
+            self._tasks["incremental_vacuum"] = (interval, lambda: incremental_vacuum(self._db_path, vacuum_pages))
+        if backup_interval > 0 and self._backup_dir is not None:
+            self._tasks["backup"] = (backup_interval, self._scheduled_backup)
+        started = time.monotonic()
+        self._last_run = {name: started for name in self._tasks}
+
+    def touch(self) -> None:
+        self._last_write = time.monotonic()
+
+    def start(self) -> None:
+        if self._tasks and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="maintenance")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def quiet(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return now - self._last_write >= self._quiet
+
+    def due(self, now: Optional[float] = None) -> list[str]:
+        now = time.monotonic() if now is None else now
+        quiet = self.quiet(now)
+        due = []
+        for name, (interval, _) in self._tasks.items():
+            waited = now - self._last_run[name]
+            if waited >= 2 * interval or (waited >= interval and quiet):
+                due.append(name)
+        return due
+
+    async def run(self, name: str) -> dict:
+        """Run one task now, whether it is due or not."""
+        _, task = self._tasks[name]
+        self._last_run[name] = time.monotonic()
+        try:
+            with self._metrics.histogram(f"maintenance_{name}_seconds").time():
+                result = await asyncio.to_thread(task)
+        except Exception:
+            self._metrics.counter(f"maintenance_{name}_failures_total").inc()
+            raise
+        self._metrics.counter(f"maintenance_{name}_total").inc()
+        return result
+
+    async def _run(self) -> None:
+        check_every = min(self._quiet, min(interval for interval, _ in self._tasks.values())) / 2
+        while True:
+            await asyncio.sleep(max(check_every, 1.0))
+            for name in self.due():
+                try:
+                    result = await self.run(name)
+                    logging.info(f"Maintenance {name}: {result}")
+                except Exception:
+                    logging.exception(f"Maintenance {name} failed")
+
+    def _scheduled_backup(self) -> dict:
+        self._backup_dir.mkdir(parents=True, exist_ok=True)
+        dest = self._backup_dir / f"database-{datetime.now():%Y%m%d-%H%M%S}.db"
+        result = _backup(self._db_path, dest, BACKUP_PAGES, BACKUP_PAUSE,
+                         self._metrics.histogram("backup_step_seconds"),
+                         self._metrics.counter("backup_restarts_total"),
+                         self._metrics.gauge("backup_pages_copied"))
+        for old in sorted(self._backup_dir.glob("database-*.db"))[:-self._backup_keep]:
+            old.unlink()
+        return result
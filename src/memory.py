@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter, deque
+from itertools import islice
+from types import FrameType, ModuleType
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from metrics import METRICS, MetricsRegistry
+
+try:
+    import resource
+except ImportError:  # Windows, RSS is then read from nowhere
+    resource = None
+
+
+# containers longer than this are sized from a sample of their items
+SIZE_SAMPLE = 64
+SIZE_MAX_DEPTH = 12
+# type objects, modules, the event loop and anything callable (the app, bound
+# methods, listeners) are shared with the rest of the process and never counted
+_SKIP = (type, ModuleType, FrameType, asyncio.AbstractEventLoop)
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def deep_size(obj: Any, sample: int = SIZE_SAMPLE, seen: Optional[set] = None, depth: int = 0) -> int:
+    """
+    Approximate bytes held by ``obj`` and everything it references: its
+    ``__dict__`` or ``__slots__`` and the items of containers. A container with
+    more than ``sample`` items is sized from its first items times its length,
+    which keeps a pass over a million-entry registry in the milliseconds.
+    Objects already in ``seen`` count nothing, so shared records count once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, _SKIP) or callable(obj) or depth > SIZE_MAX_DEPTH:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+
+    if isinstance(obj, dict):
+        items = obj.items()
+        pairs = True
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        items = obj
+        pairs = False
+    else:
+        attributes = getattr(obj, "__dict__", None)
+        if attributes is not None:
+            size += deep_size(attributes, sample, seen, depth + 1)
+        for cls in type(obj).__mro__:
+            slots = getattr(cls, "__slots__", ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                value = getattr(obj, name, None)
+                if value is not None:
+                    size += deep_size(value, sample, seen, depth + 1)
+        # asyncio.Queue and friends keep their items in a deque attribute, covered above
+        return size
+
+    length = len(obj)
+    if not length:
+        return size
+    sized = 0
+    taken = 0
+    for item in islice(items, sample):
+        if pairs:
+            sized += deep_size(item[0], sample, seen, depth + 1) + deep_size(item[1], sample, seen, depth + 1)
+        else:
+            sized += deep_size(item, sample, seen, depth + 1)
+        taken += 1
+    return size + sized * length // taken
+
+
+def resident_bytes() -> int:
+    """Current RSS from /proc, the peak from getrusage where there is no /proc, else 0."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def task_counts() -> Dict[str, int]:
+    """Live asyncio tasks by coroutine, a growing entry is a task nobody awaits or cancels."""
+    return dict(Counter(getattr(task.get_coro(), "__qualname__", "?") for task in asyncio.all_tasks()).most_common())
+
+
+class MemoryAccounting():
+    """
+    Estimated bytes per subsystem. Backend ``track``s the objects that grow
+    with traffic, the connections, the user registry, the caches and the
+    event queues, each as a callable returning its current objects, and every
+    ``interval`` seconds their ``deep_size`` goes to ``memory_<name>_bytes``.
+    The pass runs on the event loop, the structures it walks are only changed
+    there, and a sampled pass costs milliseconds.
+
+    An object reachable from two subsystems counts in the first one tracked.
+    ``process_resident_bytes`` and ``asyncio_tasks`` are read on every scrape.
+    """
+    def __init__(self, interval: float = 60.0, sample: int = SIZE_SAMPLE, metrics: MetricsRegistry = METRICS):
+        self._interval = interval
+        self._sample = sample
+        self._metrics = metrics
+        self._tracked: Dict[str, Callable[[], Iterable[Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        metrics.gauge("process_resident_bytes", resident_bytes)
+        metrics.gauge("asyncio_tasks", lambda: len(asyncio.all_tasks()))
+        self._pass_time = metrics.histogram("memory_accounting_seconds")
+
+    def track(self, name: str, objects: Callable[[], Iterable[Any]]) -> None:
+        self._tracked[name] = objects
+
+    def measure(self) -> Dict[str, int]:
+        seen: set = set()
+        sizes = {}
+        with self._pass_time.time():
+            for name, objects in self._tracked.items():
+                sizes[name] = sum(deep_size(obj, self._sample, seen) for obj in objects())
+                self._metrics.gauge(f"memory_{name}_bytes").set(sizes[name])
+        return sizes
+
+    def start(self) -> None:
+        if self._interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="memory-accounting")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.measure()
+            except Exception:
+                logging.exception("Memory accounting failed")
+            await asyncio.sleep(self._interval)
+
+
+class AllocationTracker():
+    """
+    tracemalloc snapshots on demand. ``start`` turns tracing on (it slows
+    allocations down, so it is off until an admin asks) and takes a baseline;
+    every ``diff`` takes a new snapshot, returns the allocation sites that
+    grew most since the previous one and keeps it as the next baseline.
+    """
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        self._previous_at = 0.0
+        self._started_here = False
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+    async def start(self, frames: int = 1) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._started_here = True
+        self._previous = await asyncio.to_thread(self._snapshot)
+        self._previous_at = time.monotonic()
+        return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+    async def diff(self, top: int = 25, key: str = "lineno") -> dict:
+        if not tracemalloc.is_tracing() or self._previous is None:
+            raise RuntimeError("tracemalloc is not started")
+        snapshot = await asyncio.to_thread(self._snapshot)
+        stats = await asyncio.to_thread(snapshot.compare_to, self._previous, key)
+        now = time.monotonic()
+        elapsed = now - self._previous_at
+        self._previous, self._previous_at = snapshot, now
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "seconds": round(elapsed, 1),
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "growth_bytes": sum(stat.size_diff for stat in stats),
+            "top": [{"where": str(stat.traceback),
+                     "size_diff": stat.size_diff, "count_diff": stat.count_diff,
+                     "size": stat.size, "count": stat.count}
+                    for stat in stats[:top]],
+        }
+
+    def stop(self) -> None:
+        self._previous = None
+        if self._started_here:
+            tracemalloc.stop()
+            self._started_here = False
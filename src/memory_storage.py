@@ -0,0 +1,485 @@
+import bisect
+import heapq
+import itertools
+import json
+from datetime import datetime, timedelta, timezone
+from typing import AsyncGenerator, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from db_consts import ConversationType
+from db_objects import User
+from etags import MembershipVersions
+from eventhandler import EventHandler
+from secret import generate_secret_id
+from storage import INBOX_PREVIEW_CHARS, HISTORY_PAGE_SIZE, ConversationNotFound
+from user_registry import UserRecord
+
+
+def _preview(content: str) -> str:
+    try:
+        text = json.loads(content)["data"]["msg"]
+    except (ValueError, TypeError, KeyError):
+        text = content
+    return text[:INBOX_PREVIEW_CHARS] if isinstance(text, str) else text
+
+
+def _utc(value: datetime) -> datetime:
+    # naive timestamps are taken as UTC, like the SQLite engine does on login
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+class MemoryStorage():
+    """
+    Storage engine that keeps everything in dicts, for load benchmarks and for
+    exercising the layers above storage without disk I/O. It behaves like
+    ``DBWrapper`` and raises the same HTTP errors; rows are plain dicts.
+    Nothing survives a restart.
+
+    Every table is a dict keyed by id. Participants are indexed by conversation
+    and by user, messages are kept per conversation in id order next to a list
+    of their ids, so "newer than" and paging lookups are a bisect.
+    """
+    def __init__(self):
+        self.event_handler = EventHandler()
+        self.add_user_event = "AddUserEvent"
+        self.remove_user_event = "RemoveUserEvent"
+        self.participants_event = "ParticipantsChangedEvent"
+        self.versions = MembershipVersions()
+
+        self._user_ids = itertools.count(1)
+        self._session_ids = itertools.count(1)
+        self._conversation_ids = itertools.count(1)
+        self._participant_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+        self._users: Dict[int, dict] = {}
+        self._users_by_name: Dict[str, dict] = {}
+        self._sessions: Dict[str, dict] = {}
+        self._user_sessions: Dict[int, List[dict]] = {}
+        self._conversations: Dict[int, dict] = {}
+        self._participants: Dict[int, dict] = {}
+        # conversation id -> user id -> participant, and the other way round
+        self._members: Dict[int, Dict[int, dict]] = {}
+        self._memberships: Dict[int, Dict[int, dict]] = {}
+        self._messages: Dict[int, List[dict]] = {}
+        self._message_index: Dict[int, List[int]] = {}
+        self._direct_pairs: Dict[tuple[int, int], int] = {}
+
+    # -------------------------------------------------
+    # initialisation
+    # -------------------------------------------------
+    async def init_db(self) -> None:
+        return
+
+    # -------------------------------------------------
+    # User helpers
+    # -------------------------------------------------
+    async def add_user(self, username: str, password: str, approved: bool = False) -> None:
+        if username in self._users_by_name:
+            raise HTTPException(status_code=409, detail="Username already exists")
+        user = {"id": next(self._user_ids), "username": username, "password": password, "approved": int(approved)}
+        self._users[user["id"]] = user
+        self._users_by_name[username] = user
+        payload = {"adding": username, "user_id": user["id"], "approved": bool(approved)}
+        await self.event_handler.call_event(self.add_user_event, payload)
+
+    async def approve_user(self, username: str) -> Optional[int]:
+        user_id = self._set_approved(username, True)
+        if user_id is not None:
+            payload = {"approve": username, "user_id": user_id, "approved": True}
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return user_id
+
+    async def reject_user(self, username: str) -> Optional[int]:
+        user_id = self._set_approved(username, False)
+        if user_id is not None:
+            payload = {"reject": username, "user_id": user_id, "approved": False}
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return user_id
+
+    async def set_approved_bulk(self, usernames: list[str], approved: bool) -> dict[str, Optional[int]]:
+        ids = self._resolve_user_ids(usernames)
+        for user_id in ids.values():
+            self._users[user_id]["approved"] = int(approved)
+        if ids:
+            payload = {
+                "bulk": [{"username": name, "user_id": user_id, "approved": approved} for name, user_id in ids.items()],
+                "action": "approve" if approved else "reject",
+            }
+            await self.event_handler.call_event(self.add_user_event, payload)
+        return {name: ids.get(name) for name in usernames}
+
+    def _resolve_user_ids(self, usernames: list[str]) -> dict[str, int]:
+        return {name: self._users_by_name[name]["id"] for name in usernames if name in self._users_by_name}
+
+    def _set_approved(self, username: str, approved: bool) -> Optional[int]:
+        user = self._users_by_name.get(username)
+        if user is None:
+            return None
+        user["approved"] = int(approved)
+        return user["id"]
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        user = self._users_by_name.get(username)
+        return dict(user) if user else None
+
+    async def get_user_by_id(self, user_id: int) -> Optional[dict]:
+        user = self._users.get(user_id)
+        return dict(user) if user else None
+
+    async def get_participant_by_user_and_convo(self, user: UserRecord, conversation_id: int) -> Optional[dict]:
+        participant = self._members.get(conversation_id, {}).get(user.id)
+        return dict(participant) if participant else None
+
+    async def get_participant_by_id(self, participant_id: int) -> Optional[dict]:
+        participant = self._participants.get(participant_id)
+        return dict(participant) if participant else None
+
+    async def get_newest_message_in_conversation(self, conversation_id: int) -> Optional[dict]:
+        messages = self._messages.get(conversation_id)
+        return dict(messages[-1]) if messages else None
+
+    async def get_all_users(self) -> List[User]:
+        return [User(username=u["username"], password=u["password"], approved=u["approved"]) for u in self._users.values()]
+
+    async def get_user_record(self, username: str) -> Optional[tuple]:
+        user = self._users_by_name.get(username)
+        return (user["id"], user["username"], user["approved"]) if user else None
+
+    async def iter_user_records(self, chunk_size: int = 10000) -> AsyncGenerator[list[tuple], None]:
+        rows = [(u["id"], u["username"], u["approved"]) for u in self._users.values()]
+        for i in range(0, len(rows), chunk_size):
+            yield rows[i:i + chunk_size]
+
+    # -------------------------------------------------
+    # Session helpers
+    # -------------------------------------------------
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        session = self._sessions.get(session_id)
+        return dict(session) if session else None
+
+    async def create_session_id(self, user: UserRecord, now: Optional[datetime] = None) -> str:
+        if not isinstance(now, datetime):
+            now = datetime.now(timezone.utc)
+
+        valid = [s for s in self._user_sessions.get(user.id, ()) if _utc(s["expires_at"]) > _utc(now)]
+        if valid:
+            return max(valid, key=lambda s: _utc(s["expires_at"]))["session_id"]
+
+        session = {
+            "id": next(self._session_ids),
+            "user_id": user.id,
+            "session_id": generate_secret_id(),
+            "created_at": now,
+            "expires_at": now + timedelta(days=1),
+        }
+        self._sessions[session["session_id"]] = session
+        self._user_sessions.setdefault(user.id, []).append(session)
+        return session["session_id"]
+
+    # -------------------------------------------------
+    # Authentication / login
+    # -------------------------------------------------
+    async def login(self, request: User):
+        """Same two flows as ``DBWrapper.login``: session id + username, else password."""
+        now = datetime.now(timezone.utc)
+        creds = request._credentials
+        if creds.session_id:
+            print(f"Session Based Login: {creds.username}")
+            if not creds.username:
+                raise HTTPException(status_code=400, detail="Username is required when using session_id")
+            session = self._sessions.get(creds.session_id)
+            if session and _utc(session["expires_at"]) > now:
+                user = self._users.get(session["user_id"])
+                if not user or user["username"] != creds.username:
+                    raise HTTPException(status_code=401, detail="Session does not belong to this user")
+                if user["approved"]:
+                    return {"status": "success", "username": user["username"]}
+                raise HTTPException(status_code=401, detail="User not approved")
+
+        print(f"Password Based Login: {creds.username}")
+        user = self._users_by_name.get(creds.username)
+        if user and user["password"] == creds.password and user["approved"]:
+            return {"status": "success", "username": user["username"]}
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    async def authenticate(self,
+                           username: str,
+                           password: str = "",
+                           session_id: str = "",
+                           now: Optional[datetime] = None) -> dict:
+        await self.login(User(username, password, session_id))
+        user = self._users_by_name[username]
+        record = UserRecord(user["id"], user["username"], user["approved"])
+        return {
+            "user": (user["id"], user["username"], user["approved"]),
+            "session_id": await self.create_session_id(record, now),
+            "unread": await self.find_unread_messages(record),
+        }
+
+    # -------------------------------------------------
+    # Conversations and participants
+    # -------------------------------------------------
+    async def get_participants_from_convo(self, conversation_id: int) -> list[dict]:
+        return [
+            {
+                "participant_id": p["id"],
+                "user_id": p["user_id"],
+                "username": self._users[p["user_id"]]["username"],
+            }
+            for p in self._members.get(conversation_id, {}).values()
+        ]
+
+    async def get_user_groups(self, username: str) -> list[dict]:
+        user = self._users_by_name.get(username)
+        if user is None:
+            return []
+        return [
+            dict(self._conversations[conversation_id])
+            for conversation_id in self._memberships.get(user["id"], {})
+            if self._conversations[conversation_id]["type"] == ConversationType.Group.value
+        ]
+
+    def _new_conversation(self, name: str | None, type: ConversationType, admin: Optional[int] = None) -> int:
+        now = datetime.now(timezone.utc)
+        conversation = {
+            "id": next(self._conversation_ids),
+            "name": name,
+            "type": type.value,
+            "admin": admin,
+            "created_at": str(now),
+            "updated_at": str(now),
+        }
+        self._conversations[conversation["id"]] = conversation
+        self._members[conversation["id"]] = {}
+        self._messages[conversation["id"]] = []
+        self._message_index[conversation["id"]] = []
+        return conversation["id"]
+
+    def _add_participant(self, conversation_id: int, user_id: int) -> dict:
+        if conversation_id not in self._conversations:
+            raise ConversationNotFound(conversation_id)
+        participant = {
+            "id": next(self._participant_ids),
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "joined_at": str(datetime.now(timezone.utc)),
+            "last_read_message_id": None,
+        }
+        self._participants[participant["id"]] = participant
+        self._members[conversation_id][user_id] = participant
+        self._memberships.setdefault(user_id, {})[conversation_id] = participant
+        return participant
+
+    def _drop_participant(self, conversation_id: int, user_id: int) -> bool:
+        participant = self._members.get(conversation_id, {}).pop(user_id, None)
+        if participant is None:
+            return False
+        del self._participants[participant["id"]]
+        del self._memberships[user_id][conversation_id]
+        return True
+
+    async def create_conversation(self, name: str | None, type: ConversationType, creator: int) -> bool:
+        conversation_id = self._new_conversation(name, type, creator)
+        await self.create_participants(conversation_id, creator)
+        return True
+
+    async def _participants_changed(self, payload: dict) -> None:
+        # versions first: an ETag must never be older than the rows it describes
+        self.versions.changed(payload)
+        await self.event_handler.call_event(self.participants_event, payload)
+
+    async def remove_participant(self, group_id: int, user_id: int) -> None:
+        self._drop_participant(group_id, user_id)
+        await self._participants_changed({"conversation_id": group_id, "removed": [user_id]})
+
+    async def create_participants(self, conversation_id: int, user_id: int) -> None:
+        if user_id in self._members.get(conversation_id, {}):
+            raise HTTPException(status_code=409, detail="Already a participant")
+        self._add_participant(conversation_id, user_id)
+        await self._participants_changed({"conversation_id": conversation_id, "added": [user_id]})
+
+    async def is_participant(self, conversation_id: int, user_id: int) -> bool:
+        return user_id in self._members.get(conversation_id, {})
+
+    async def add_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]:
+        if conversation_id not in self._conversations:
+            raise ConversationNotFound(conversation_id)
+        ids = self._resolve_user_ids(usernames)
+        members = self._members[conversation_id]
+        existing = {user_id for user_id in ids.values() if user_id in members}
+        new_ids = [user_id for user_id in dict.fromkeys(ids.values()) if user_id not in existing]
+        for user_id in new_ids:
+            self._add_participant(conversation_id, user_id)
+
+        if new_ids:
+            await self._participants_changed({"conversation_id": conversation_id, "added": new_ids})
+        return {
+            name: "user_not_found" if name not in ids
+            else "already_participant" if ids[name] in existing
+            else "added"
+            for name in usernames
+        }
+
+    async def remove_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]:
+        ids = self._resolve_user_ids(usernames)
+        members = self._members.get(conversation_id, {})
+        existing = {user_id for user_id in ids.values() if user_id in members}
+        for user_id in existing:
+            self._drop_participant(conversation_id, user_id)
+
+        if existing:
+            await self._participants_changed({"conversation_id": conversation_id, "removed": sorted(existing)})
+        return {
+            name: "user_not_found" if name not in ids
+            else "removed" if ids[name] in existing
+            else "not_a_participant"
+            for name in usernames
+        }
+
+    async def retrieve_direct_convo(self, friend: UserRecord, user: UserRecord) -> Optional[int]:
+        return self._direct_pairs.get((min(friend.id, user.id), max(friend.id, user.id)))
+
+    async def create_direct_chat(self, user_a: UserRecord, user_b: UserRecord) -> int:
+        pair = (min(user_a.id, user_b.id), max(user_a.id, user_b.id))
+        conversation_id = self._direct_pairs.get(pair)
+        if conversation_id is not None:
+            return conversation_id
+        conversation_id = self._new_conversation(None, ConversationType.Direct)
+        self._direct_pairs[pair] = conversation_id
+        for user_id in pair:
+            self._add_participant(conversation_id, user_id)
+        await self._participants_changed({"conversation_id": conversation_id, "added": list(pair)})
+        return conversation_id
+
+    # -------------------------------------------------
+    # Messages and read markers
+    # -------------------------------------------------
+    async def add_message_to_history(self, msg_body: dict, sender: UserRecord) -> None:
+        if msg_body["room_id"] is not None:
+            await self.add_messages_to_history([msg_body], sender, mark_read=False)
+
+    async def add_messages_to_history(self, messages: list[dict], sender: UserRecord, mark_read: bool = True) -> list[int]:
+        messages = [m for m in messages if m["room_id"] is not None]
+        if not messages:
+            return []
+        for m in messages:
+            if m["room_id"] not in self._conversations:
+                raise ConversationNotFound(m["room_id"])
+        now = str(datetime.now(timezone.utc))
+
+        ids = []
+        newest = {}
+        for m in messages:
+            room_id = m["room_id"]
+            message = {
+                "id": next(self._message_ids),
+                "conversation_id": room_id,
+                "sender_id": sender.id,
+                "content": json.dumps(m),
+                "created_at": str(m.get("created_at", now)),
+            }
+            self._messages[room_id].append(message)
+            self._message_index[room_id].append(message["id"])
+            ids.append(message["id"])
+            newest[room_id] = message["id"]
+
+        if mark_read:
+            memberships = self._memberships.get(sender.id, {})
+            for room_id, message_id in newest.items():
+                participant = memberships.get(room_id)
+                if participant is not None:
+                    participant["last_read_message_id"] = message_id
+        return ids
+
+    async def get_messages_from(self, conversation_id: int, last_message: Optional[int] = None) -> list[dict]:
+        limit = HISTORY_PAGE_SIZE
+        messages = self._messages.get(conversation_id, [])
+        if last_message is None:
+            end = len(messages)
+        else:
+            # the client identifies its oldest message by content, newest match wins
+            end = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["content"] == last_message), None)
+            if end is None:
+                return []
+        return [{"id": m["id"], "content": m["content"]} for m in messages[max(0, end - limit):end]]
+
+    async def iter_missed_messages(self,
+                                   user_id: int,
+                                   high_water: Optional[dict[int, int]] = None,
+                                   cursor: Optional[int] = None,
+                                   page_size: int = 500) -> AsyncGenerator[dict, None]:
+        memberships = self._memberships.get(user_id)
+        if not memberships:
+            return
+        high_water = high_water or {}
+        streams = []
+        for conversation_id, participant in memberships.items():
+            seen = cursor if cursor is not None else high_water.get(conversation_id, participant["last_read_message_id"] or 0)
+            start = bisect.bisect_right(self._message_index[conversation_id], seen)
+            streams.append(itertools.islice(self._messages[conversation_id], start, None))
+        for m in heapq.merge(*streams, key=lambda m: m["id"]):
+            yield {
+                "id": m["id"],
+                "room_id": m["conversation_id"],
+                "sender_id": m["sender_id"],
+                "content": m["content"],
+                "created_at": m["created_at"],
+            }
+
+    async def iter_conversation_messages(self,
+                                         conversation_id: int,
+                                         after_id: int = 0,
+                                         chunk_size: int = 1000) -> AsyncGenerator[list[dict], None]:
+        messages = self._messages.get(conversation_id, [])
+        start = bisect.bisect_right(self._message_index.get(conversation_id, []), after_id)
+        for i in range(start, len(messages), chunk_size):
+            yield [dict(m) for m in messages[i:i + chunk_size]]
+
+    async def find_unread_messages(self, user: UserRecord) -> list[str]:
+        names = []
+        for conversation_id, participant in self._memberships.get(user.id, {}).items():
+            start = bisect.bisect_right(self._message_index[conversation_id], participant["last_read_message_id"] or 0)
+            messages = self._messages[conversation_id]
+            if not any(messages[i]["sender_id"] != user.id for i in range(start, len(messages))):
+                continue
+            conversation = self._conversations[conversation_id]
+            if conversation["type"] == ConversationType.Direct.value:
+                other = next((uid for uid in self._members[conversation_id] if uid != user.id), None)
+                display_name = self._users[other]["username"] if other is not None else None
+            else:
+                display_name = conversation["name"]
+            if display_name:
+                names.append(display_name)
+        return names
+
+    async def get_inbox(self, user_id: int) -> list[dict]:
+        inbox = []
+        for conversation_id, participant in self._memberships.get(user_id, {}).items():
+            conversation = self._conversations[conversation_id]
+            messages = self._messages[conversation_id]
+            start = bisect.bisect_right(self._message_index[conversation_id], participant["last_read_message_id"] or 0)
+            if conversation["type"] == ConversationType.Direct.value:
+                other = next((uid for uid in self._members[conversation_id] if uid != user_id), None)
+                display_name = self._users[other]["username"] if other is not None else None
+            else:
+                display_name = conversation["name"]
+            last = messages[-1] if messages else None
+            inbox.append({
+                "conversation_id": conversation_id,
+                "type": conversation["type"],
+                "display_name": display_name,
+                "last_message_id": last["id"] if last else None,
+                "last_message": _preview(last["content"]) if last else None,
+                "last_sender_id": last["sender_id"] if last else None,
+                "last_message_at": last["created_at"] if last else None,
+                "unread_count": sum(1 for i in range(start, len(messages)) if messages[i]["sender_id"] != user_id),
+            })
+        inbox.sort(key=lambda entry: (entry["last_message_id"] or 0, entry["conversation_id"]), reverse=True)
+        return inbox
+
+    async def update_last_message(self, participant_id: int, message_id: int) -> None:
+        participant = self._participants.get(participant_id)
+        if participant is not None:
+            participant["last_read_message_id"] = message_id
@@ -17,6 +17,8 @@ class PathWrap():
     static:     Path = build / "static"
 
     db_file:    Path = backend / "database.db"
+    attachments: Path = backend / "attachments"
+    backups:    Path = backend / "backups"
 
     paths_to_validate = [_here, root, backend, frontend, public, build, static]
 
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Optional
+
+from metrics import METRICS, MetricsRegistry
+
+
+PROFILE_MAX_SECONDS = 120.0
+# leaf frames of a thread parked in the selector or on a lock, dropped unless idle time is asked for
+IDLE_LEAVES = ("select", "poll", "epoll", "wait", "_worker")
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _frame_name(frame, current_line: bool) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    short = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+    line = (frame.f_lineno if current_line else None) or code.co_firstlineno
+    return f"{code.co_qualname} ({short}:{line})".replace(";", ":")
+
+
+def collapse(frame, root: str, current_line: bool = False) -> str:
+    """
+    One stack in the collapsed ``root;outer;...;leaf`` form flamegraph tools
+    read. Frames name the function's first line so samples from anywhere in a
+    function add up, ``current_line`` names the line it is executing instead.
+    """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame, current_line))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+
+def _is_idle(frame) -> bool:
+    return frame.f_code.co_name in IDLE_LEAVES
+
+
+# the CPU clock only advances while the process computes, the wall clock also
+# catches the loop waiting on something that should not block it
+CLOCKS = {
+    "cpu": (signal.ITIMER_PROF, signal.SIGPROF) if hasattr(signal, "setitimer") else None,
+    "wall": (signal.ITIMER_REAL, signal.SIGALRM) if hasattr(signal, "setitimer") else None,
+}
+
+
+class StackSampler():
+    """
+    Samples the stacks of every thread every ``interval`` seconds of the
+    ``clock``. An interval timer signal does the sampling: Python runs the
+    handler in the main thread, which is the event loop thread, between two
+    bytecodes, so the sample is the frame the loop is actually executing. A
+    sampling thread could only look while the loop released the GIL, nearly
+    always in the selector. Other threads, e.g. the ``asyncio.to_thread``
+    workers, are taken from ``sys._current_frames`` in the same handler.
+
+    Needs ``signal.setitimer`` and has to be started from the main thread.
+    """
+    def __init__(self, interval: float = 0.005, idle: bool = False, clock: str = "cpu"):
+        if CLOCKS.get(clock) is None:
+            raise ValueError(f"No {clock!r} sampling clock on this platform")
+        self._interval = interval
+        self._idle = idle
+        self._timer, self._signal = CLOCKS[clock]
+        self._previous = None
+        self.samples: Counter[str] = Counter()
+        self.taken = 0
+
+    def sample(self, signum, frame) -> None:
+        main = threading.main_thread()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, thread_frame in sys._current_frames().items():
+            if ident == main.ident:
+                # the handler's own frame is on top, the interrupted one is the signal frame
+                thread_frame = frame
+            if thread_frame is None or (not self._idle and _is_idle(thread_frame)):
+                continue
+            self.samples[collapse(thread_frame, names.get(ident, str(ident)))] += 1
+        self.taken += 1
+
+    def start(self) -> None:
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("The sampler can only be started from the main thread")
+        self._previous = signal.signal(self._signal, self.sample)
+        signal.setitimer(self._timer, self._interval, self._interval)
+
+    def stop(self) -> None:
+        signal.setitimer(self._timer, 0)
+        signal.signal(self._signal, self._previous)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+async def profile(seconds: float, interval: float = 0.005, idle: bool = False, clock: str = "cpu") -> StackSampler:
+    """Sample for ``seconds`` while the event loop keeps serving."""
+    sampler = StackSampler(interval, idle, clock)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+    return sampler
+
+
+class LoopLagMonitor():
+    """
+    Always-on event loop lag measurement. A task on the loop sleeps
+    ``interval`` seconds at a time and records how late it wakes up in
+    ``event_loop_lag_seconds``.
+
+    A watchdog thread notices when that task hasn't run for ``threshold``
+    seconds, i.e. while the loop is still stuck, and takes the stack of the
+    loop thread and the name of the running task right then. That is the
+    code responsible for the stall, it is logged once per stall and the last
+    few are kept for ``/debug/stalls``.
+    """
+    def __init__(self,
+                 interval: float = 0.1,
+                 threshold: float = 0.25,
+                 keep: int = 20,
+                 metrics: MetricsRegistry = METRICS):
+        self._interval = interval
+        self._threshold = threshold
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._last_tick = time.monotonic()
+        self.stalls: Deque[dict] = deque(maxlen=keep)
+
+        self._lag = metrics.histogram("event_loop_lag_seconds", LAG_BUCKETS)
+        self._stall_count = metrics.counter("event_loop_stalls_total")
+
+    def start(self) -> None:
+        if self._interval <= 0 or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._tick(), name="loop-lag")
+        if self._threshold > 0:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _tick(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self._interval)
+            self._last_tick = now = time.monotonic()
+            self._lag.observe(max(0.0, now - before - self._interval))
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopping.wait(self._threshold / 2):
+            last = self._last_tick
+            stalled = time.monotonic() - last - self._interval
+            if stalled < self._threshold or reported == last:
+                continue
+            reported = last
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            task = asyncio.tasks._current_tasks.get(self._loop)
+            stall = {
+                "at": time.time(),
+                "stalled_for": round(stalled, 3),
+                "task": task.get_name() if task is not None else None,
+                "coroutine": getattr(task.get_coro(), "__qualname__", None) if task is not None else None,
+                "stack": collapse(frame, "loop", current_line=True).split(";"),
+            }
+            self.stalls.append(stall)
+            self._stall_count.inc()
+            logging.warning(f"Event loop stalled for {stall['stalled_for']}s+ in task {stall['task']} "
+                            f"({stall['coroutine']}) at {stall['stack'][-1]}")
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from typing import Dict, Hashable
+
+from metrics import METRICS, MetricsRegistry
+
+
+DROP = "drop"
+DELAY = "delay"
+DISCONNECT = "disconnect"
+MODES = (DROP, DELAY, DISCONNECT)
+
+
+class TokenBucket():
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter():
+    """
+    Token buckets keyed by user id or client IP. A bucket refills at ``rate``
+    tokens per second up to ``burst``; refilling happens lazily when a key is
+    checked, so a check is a dict lookup and a bit of arithmetic.
+
+    What happens to traffic over the limit is up to the caller via ``mode``:
+    drop the frame, delay it until the bucket has refilled, or disconnect.
+    """
+    def __init__(self,
+                 name: str,
+                 rate: float,
+                 burst: float,
+                 mode: str = DELAY,
+                 max_keys: int = 100_000,
+                 metrics: MetricsRegistry = METRICS):
+        if mode not in MODES:
+            raise ValueError(f"Unknown rate limit mode {mode}, use one of {MODES}")
+        if rate <= 0 or burst <= 0:
+            raise ValueError(f"Rate limit {name} needs a positive rate and burst, got rate={rate} burst={burst}")
+        self.name = name
+        self.mode = mode
+        self._rate = rate
+        self._burst = burst
+        self._max_keys = max_keys
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+        metrics.gauge(f"ratelimit_{name}_keys", lambda: len(self._buckets))
+        self._throttled = metrics.counter(f"ratelimit_{name}_throttled_total")
+        self._passed = metrics.counter(f"ratelimit_{name}_passed_total")
+
+    def consume(self, key: Hashable, cost: float = 1.0) -> float:
+        """
+        Take ``cost`` tokens from the bucket of ``key``. Returns 0 when allowed,
+        otherwise the seconds until the bucket could pay for it. In delay mode the
+        tokens are taken anyway, so waiting callers line up behind each other.
+
+        A cost above ``burst`` could never be paid in full, it passes once the
+        bucket is full and leaves it in debt, so the key still averages ``rate``.
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(self._burst, now)
+        else:
+            tokens = bucket.tokens + (now - bucket.updated) * self._rate
+            bucket.tokens = tokens if tokens < self._burst else self._burst
+            bucket.updated = now
+
+        if bucket.tokens >= cost or bucket.tokens >= self._burst:
+            bucket.tokens -= cost
+            self._passed.inc()
+            return 0.0
+
+        self._throttled.inc()
+        wait = (cost - bucket.tokens) / self._rate
+        if self.mode == DELAY:
+            bucket.tokens -= cost
+        return wait
+
+    async def admit(self, key: Hashable, cost: float = 1.0) -> bool:
+        """
+        True when the caller may go ahead (possibly after being delayed), False
+        when the frame has to be dropped or the client disconnected.
+        """
+        wait = self.consume(key, cost)
+        if wait == 0.0:
+            return True
+        if self.mode == DELAY:
+            await asyncio.sleep(wait)
+            return True
+        return False
+
+    def _prune(self, now: float) -> None:
+        # buckets that refilled completely carry no information, forget them
+        full_after = self._burst / self._rate
+        idle = [key for key, bucket in self._buckets.items() if now - bucket.updated >= full_after]
+        for key in idle:
+            del self._buckets[key]
+        if len(self._buckets) >= self._max_keys:
+            # everyone is active, drop the oldest half rather than grow without bound
+            for key in list(self._buckets)[: self._max_keys // 2]:
+                del self._buckets[key]
@@ -0,0 +1,135 @@
+from collections import OrderedDict, deque
+from typing import Iterable, Optional
+
+from metrics import METRICS, MetricsRegistry
+from storage import HISTORY_PAGE_SIZE
+
+# rough per-message cost beyond the content string: tuple, int, deque slot
+MESSAGE_OVERHEAD = 120
+
+
+class _Ring():
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, per_conversation: int):
+        self.messages: deque[tuple[int, str]] = deque(maxlen=per_conversation)
+        # True when the ring holds every message the conversation has
+        self.complete = False
+        self.size = 0
+
+
+class RecentMessages():
+    """
+    The newest ``per_conversation`` messages of each conversation as
+    ``(id, content)``, so opening a room doesn't ask the storage engine for
+    the messages it just fanned out.
+
+    Persisted messages are appended with the ids ``add_messages_to_history``
+    returned, and a miss warms the ring with the page read from storage.
+    A ring only answers when it can answer exactly what storage would: the
+    first page needs ``HISTORY_PAGE_SIZE`` messages or the whole conversation,
+    an older page the same below the message it starts from. Beyond
+    ``max_bytes`` the least recently used conversations are dropped.
+    """
+    def __init__(self,
+                 per_conversation: int = 50,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 metrics: MetricsRegistry = METRICS):
+        self._per_conversation = max(per_conversation, HISTORY_PAGE_SIZE)
+        self._max_bytes = max_bytes
+        self._rings: OrderedDict[int, _Ring] = OrderedDict()
+        self._bytes = 0
+
+        metrics.gauge("recent_messages_conversations", lambda: len(self._rings))
+        metrics.gauge("recent_messages_bytes", lambda: self._bytes)
+        self._hits = metrics.counter("recent_messages_hits_total")
+        self._misses = metrics.counter("recent_messages_misses_total")
+        self._evictions = metrics.counter("recent_messages_evictions_total")
+
+    def __len__(self) -> int:
+        return len(self._rings)
+
+    def _ring(self, conversation_id: int) -> _Ring:
+        ring = self._rings.get(conversation_id)
+        if ring is None:
+            ring = self._rings[conversation_id] = _Ring(self._per_conversation)
+        else:
+            self._rings.move_to_end(conversation_id)
+        return ring
+
+    def _push(self, ring: _Ring, message: tuple[int, str]) -> None:
+        if len(ring.messages) == ring.messages.maxlen:
+            dropped = ring.messages[0]
+            ring.size -= len(dropped[1]) + MESSAGE_OVERHEAD
+            self._bytes -= len(dropped[1]) + MESSAGE_OVERHEAD
+            ring.complete = False
+        ring.messages.append(message)
+        ring.size += len(message[1]) + MESSAGE_OVERHEAD
+        self._bytes += len(message[1]) + MESSAGE_OVERHEAD
+
+    def _evict(self) -> None:
+        while self._bytes > self._max_bytes and self._rings:
+            _, ring = self._rings.popitem(last=False)
+            self._bytes -= ring.size
+            self._evictions.inc()
+
+    def _refill(self, ring: _Ring, messages: dict[int, str], complete: bool) -> None:
+        self._bytes -= ring.size
+        ring.messages.clear()
+        ring.size = 0
+        ring.complete = complete
+        for message_id in sorted(messages):
+            self._push(ring, (message_id, messages[message_id]))
+
+    def append(self, conversation_id: int, messages: Iterable[tuple[int, str]]) -> None:
+        """Messages just persisted, with their ids."""
+        ring = self._ring(conversation_id)
+        for message in messages:
+            if ring.messages and message[0] <= ring.messages[-1][0]:
+                # two batches of one room persisted concurrently and finished out of order
+                self._refill(ring, {**dict(ring.messages), message[0]: message[1]}, ring.complete)
+            else:
+                self._push(ring, message)
+        self._evict()
+
+    def warm(self, conversation_id: int, rows: list[dict], complete: bool) -> None:
+        """
+        Merge a first page read from storage, ``complete`` when it was the whole
+        conversation. Messages appended while the read was running are newer
+        than the page and kept.
+        """
+        ring = self._ring(conversation_id)
+        self._refill(ring, {**{row["id"]: row["content"] for row in rows}, **dict(ring.messages)}, complete)
+        self._evict()
+
+    def page(self, conversation_id: int, before_content: Optional[str] = None) -> Optional[list[dict]]:
+        """
+        What ``Storage.get_messages_from`` returns for the same arguments, or
+        None when the ring can't tell.
+        """
+        ring = self._rings.get(conversation_id)
+        if ring is None:
+            self._misses.inc()
+            return None
+        messages = ring.messages
+        if before_content is None:
+            end = len(messages)
+        else:
+            # storage looks the content up newest first, the ring holds the newest messages
+            end = next((i for i in range(len(messages) - 1, -1, -1) if messages[i][1] == before_content), None)
+            if end is None:
+                self._misses.inc()
+                return None
+        if end < HISTORY_PAGE_SIZE and not ring.complete:
+            self._misses.inc()
+            return None
+        self._rings.move_to_end(conversation_id)
+        self._hits.inc()
+        return [{"id": message_id, "content": content}
+                for message_id, content in list(messages)[max(0, end - HISTORY_PAGE_SIZE):end]]
+
+    def newest_id(self, conversation_id: int) -> Optional[int]:
+        ring = self._rings.get(conversation_id)
+        if ring is None or not ring.messages:
+            return None
+        return ring.messages[-1][0]
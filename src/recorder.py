@@ -0,0 +1,457 @@
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import logging
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Any, Iterable, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from bulk import open_ndjson
+from db_consts import ConversationType
+from metrics import METRICS, MetricsRegistry
+from wire import (JSON_CODEC, SUBPROTOCOL_JSON_DEFLATE, SUBPROTOCOL_MSGPACK,
+                  DeflateJsonCodec, MsgPackCodec, msgpack)
+
+
+RECORDING_VERSION = 1
+# requests outside these are pages, static assets and the admin's debug endpoints
+RECORDED_PREFIXES = ("/api/", "/add_user", "/ws/")
+UNRECORDED_PATHS = ("/api/metrics",)
+# larger bodies (attachment uploads) are recorded by size only
+MAX_RECORDED_BODY = 64 * 1024
+# every recorded user gets this password, the replay creates them with it
+REPLAY_PASSWORD = "replay"
+
+# fields that name a user, a list of users, a room or a file, and free text
+USER_KEYS = {"username", "user", "user_a", "user_b", "from"}
+USER_LIST_KEYS = {"usernames", "users"}
+NAME_KEYS = {"group_name", "room_name", "name"}
+TEXT_KEYS = {"msg", "oldest_message", "search_term"}
+
+_FILLER = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+           "labore et dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris "
+           "nisi ut aliquip ex ea commodo consequat duis aute irure dolor in reprehenderit in voluptate ") * 8
+
+_CODECS = {SUBPROTOCOL_JSON_DEFLATE: DeflateJsonCodec()}
+if msgpack is not None:
+    _CODECS[SUBPROTOCOL_MSGPACK] = MsgPackCodec()
+
+
+class Anonymizer():
+    """
+    Replaces who said what, keeping the shape of the traffic. A user, room or
+    file name becomes a keyed hash, the same one every time within a recording
+    (and across recordings with the same ``secret``). Message text becomes
+    filler of the same length, passwords become ``REPLAY_PASSWORD`` and
+    session ids are dropped. Ids are kept, they don't name anyone and the
+    replay needs them to line up.
+    """
+    def __init__(self, secret: str = ""):
+        self._key = (secret or secrets.token_hex(16)).encode()
+        self._names: dict[str, str] = {}
+        self._offset = 0
+
+    def name(self, value: str) -> str:
+        anonymous = self._names.get(value)
+        if anonymous is None:
+            digest = hmac.new(self._key, value.encode(), hashlib.sha256).hexdigest()
+            anonymous = self._names[value] = f"u{digest[:12]}"
+        return anonymous
+
+    def text(self, value: str) -> str:
+        self._offset = (self._offset + 97) % 512
+        filler = _FILLER if len(value) + self._offset <= len(_FILLER) else _FILLER * (len(value) // len(_FILLER) + 2)
+        return filler[self._offset:self._offset + len(value)]
+
+    def scrub(self, obj: Any) -> Any:
+        """A JSON body or websocket frame with every identifying field replaced."""
+        if isinstance(obj, list):
+            return [self.scrub(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        out = {}
+        for key, value in obj.items():
+            if isinstance(value, str):
+                if key in USER_KEYS or key in NAME_KEYS:
+                    value = self.name(value)
+                elif key in TEXT_KEYS:
+                    value = self.text(value)
+                elif key == "password":
+                    value = REPLAY_PASSWORD
+                elif key == "session_id":
+                    value = ""
+            elif key in USER_LIST_KEYS and isinstance(value, list):
+                value = [self.name(item) if isinstance(item, str) else item for item in value]
+            else:
+                value = self.scrub(value)
+            out[key] = value
+        return out
+
+    def path(self, path: str, path_params: dict) -> str:
+        # e.g. /api/get_groups{username}, the parameter is the tail of the path
+        for key, value in path_params.items():
+            if isinstance(value, str) and value and path.endswith(value):
+                scrubbed = self.scrub({key: value})[key]
+                path = path[:len(path) - len(value)] + scrubbed
+        return path
+
+    def query(self, query: str) -> str:
+        return urlencode([(key, self.scrub({key: value})[key]) for key, value in parse_qsl(query, keep_blank_values=True)])
+
+
+class TrafficRecorder():
+    """
+    Appends every API call and inbound websocket frame, anonymized, to a
+    compact NDJSON log (gzip when the name ends in ``.gz``), one entry per
+    line with ``t`` the seconds since recording started:
+
+        {"k": "http", "t": 1.2, "m": "POST", "p": "/api/get_room", "q": "", "pp": {}, "b": {...}, "n": 43, "s": 200, "d": 3.1, "r": "get_room"}
+        {"k": "open", "t": 2.0, "c": 7, "sp": null, "f": {"username": "u3f...", "password": "replay", ...}}
+        {"k": "auth", "t": 2.01, "c": 7, "st": "AUTH_SUCCESS", "id": 12}
+        {"k": "frame", "t": 3.5, "c": 7, "f": {"type": "message", ...}}
+        {"k": "close", "t": 9.0, "c": 7}
+
+    Each start writes a ``header`` line; restarts append to the same file.
+    Entries are buffered and written by a background task every
+    ``flush_interval`` seconds in a thread; beyond ``max_pending`` unwritten
+    entries new ones are dropped and counted rather than held.
+    """
+    def __init__(self,
+                 path: str,
+                 secret: str = "",
+                 flush_interval: float = 1.0,
+                 max_pending: int = 100_000,
+                 metrics: MetricsRegistry = METRICS):
+        self._path = str(path)
+        self.anonymizer = Anonymizer(secret)
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending: list[dict] = []
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+        self._started = 0.0
+        self._connections = 0
+
+        self._recorded = metrics.counter("recorder_events_total")
+        self._dropped = metrics.counter("recorder_dropped_total")
+        metrics.gauge("recorder_pending", lambda: len(self._pending))
+
+    @property
+    def active(self) -> bool:
+        return self._file is not None
+
+    def start(self) -> None:
+        if self._file is not None:
+            return
+        self._file = open_ndjson(self._path, "a")
+        self._started = time.monotonic()
+        self._pending.append({"k": "header", "v": RECORDING_VERSION,
+                              "started": datetime.now(timezone.utc).isoformat(timespec="seconds")})
+        self._task = asyncio.create_task(self._run(), name="traffic-recorder")
+        logging.info(f"Recording traffic to {self._path}")
+
+    async def stop(self) -> None:
+        if self._file is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._flush()
+        file, self._file = self._file, None
+        await asyncio.to_thread(file.close)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self._flush()
+            except OSError:
+                logging.exception("Writing the traffic recording failed")
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        entries, self._pending = self._pending, []
+
+        def write():
+            self._file.write(b"".join(json.dumps(entry, separators=(",", ":"), default=str).encode() + b"\n"
+                                      for entry in entries))
+            self._file.flush()
+
+        await asyncio.to_thread(write)
+
+    def _put(self, entry: dict, started: Optional[float] = None) -> None:
+        if len(self._pending) >= self._max_pending:
+            self._dropped.inc()
+            return
+        entry["t"] = round((time.monotonic() if started is None else started) - self._started, 4)
+        self._pending.append(entry)
+        self._recorded.inc()
+
+    def http(self, scope: dict, body: Optional[bytes], size: int, status: int, started: float) -> None:
+        path_params = scope.get("path_params") or {}
+        endpoint = scope.get("endpoint")
+        decoded = None
+        if body:
+            try:
+                decoded = self.anonymizer.scrub(json.loads(body))
+            except ValueError:
+                pass
+        self._put({"k": "http", "m": scope["method"],
+                   "p": self.anonymizer.path(scope["path"], path_params),
+                   "q": self.anonymizer.query(scope.get("query_string", b"").decode("latin-1")),
+                   "pp": self.anonymizer.scrub(path_params),
+                   "b": decoded, "n": size, "s": status,
+                   "d": round((time.monotonic() - started) * 1000, 2),
+                   "r": getattr(endpoint, "__name__", None)}, started)
+
+    def connection(self) -> int:
+        self._connections += 1
+        return self._connections
+
+    def ws_open(self, connection: int, subprotocol: Optional[str], auth_frame: dict) -> None:
+        self._put({"k": "open", "c": connection, "sp": subprotocol, "f": self.anonymizer.scrub(auth_frame)})
+
+    def ws_auth(self, connection: int, response: dict) -> None:
+        self._put({"k": "auth", "c": connection, "st": response.get("state"), "id": response.get("id")})
+
+    def ws_frame(self, connection: int, frame: Any) -> None:
+        self._put({"k": "frame", "c": connection, "f": self.anonymizer.scrub(frame)})
+
+    def ws_close(self, connection: int) -> None:
+        self._put({"k": "close", "c": connection})
+
+
+class RecordingMiddleware():
+    """
+    ASGI middleware feeding a ``TrafficRecorder``, a pass-through while the
+    recorder isn't started. Websocket frames are decoded with the codec of
+    the subprotocol the server accepted, the first one is the auth frame and
+    the server's first ``response`` carries the user's id.
+    """
+    def __init__(self, app, recorder: TrafficRecorder):
+        self.app = app
+        self._recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (not self._recorder.active or scope["type"] not in ("http", "websocket")
+                or not path.startswith(RECORDED_PREFIXES) or path in UNRECORDED_PATHS):
+            return await self.app(scope, receive, send)
+        if scope["type"] == "http":
+            return await self._http(scope, receive, send)
+        return await self._websocket(scope, receive, send)
+
+    async def _http(self, scope, receive, send):
+        started = time.monotonic()
+        body = bytearray()
+        size = 0
+        status = 0
+
+        async def recording_receive():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size <= MAX_RECORDED_BODY:
+                    body.extend(chunk)
+            return message
+
+        async def recording_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            self._recorder.http(scope, bytes(body) if size <= MAX_RECORDED_BODY else None, size, status, started)
+
+    async def _websocket(self, scope, receive, send):
+        recorder = self._recorder
+        connection = recorder.connection()
+        codec = JSON_CODEC
+        opened = authenticated = closed = False
+
+        def close():
+            nonlocal closed
+            if opened and not closed:
+                closed = True
+                recorder.ws_close(connection)
+
+        async def recording_receive():
+            nonlocal opened
+            message = await receive()
+            if message["type"] == "websocket.receive":
+                try:
+                    frame = codec.decode(message)
+                except Exception:
+                    # the handler fails on it the same way, there is nothing to replay
+                    return message
+                if not opened:
+                    opened = True
+                    recorder.ws_open(connection, codec.subprotocol, frame)
+                else:
+                    recorder.ws_frame(connection, frame)
+            elif message["type"] == "websocket.disconnect":
+                close()
+            return message
+
+        async def recording_send(message):
+            nonlocal codec, authenticated
+            if message["type"] == "websocket.accept":
+                codec = _CODECS.get(message.get("subprotocol"), JSON_CODEC)
+            elif message["type"] == "websocket.send" and opened and not authenticated:
+                try:
+                    response = codec.decode(message)
+                except Exception:
+                    response = None
+                if isinstance(response, dict) and response.get("type") == "response":
+                    authenticated = True
+                    recorder.ws_auth(connection, response)
+            elif message["type"] == "websocket.close":
+                close()
+            await send(message)
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            close()
+
+
+# -------------------------------------------------
+# Reading a recording back
+# -------------------------------------------------
+def read_recording(path: str) -> list[dict]:
+    """
+    Every entry of a recording in time order. Runs appended after a restart
+    are laid end to end and their connection numbers made unique.
+    """
+    entries, run, offset, last = [], 0, 0.0, 0.0
+    with open_ndjson(str(path), "r") as source:
+        for line in source:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["k"] == "header":
+                if entry.get("v") != RECORDING_VERSION:
+                    raise ValueError(f"Unsupported recording version {entry.get('v')}")
+                run += 1
+                offset = last
+                continue
+            entry["t"] += offset
+            last = max(last, entry["t"])
+            if "c" in entry:
+                entry["c"] = f"{run}:{entry['c']}"
+            entries.append(entry)
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def _names(obj: Any, found: set) -> None:
+    if isinstance(obj, list):
+        for item in obj:
+            _names(item, found)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in USER_KEYS and isinstance(value, str):
+                found.add(value)
+            elif key in USER_LIST_KEYS and isinstance(value, list):
+                found.update(v for v in value if isinstance(v, str))
+            else:
+                _names(value, found)
+
+
+def _messages(frame: Any) -> Iterable[dict]:
+    if not isinstance(frame, dict):
+        return []
+    if frame.get("type") == "batch":
+        return [m for m in frame.get("messages") or [] if isinstance(m, dict)]
+    return [frame] if frame.get("type") == "message" else []
+
+
+def recorded_world(entries: list[dict]) -> bytes:
+    """
+    The users and conversations a recording refers to, as ``bulk.export_ndjson``
+    lines ready for ``bulk.import_ndjson`` into a fresh database. Users keep
+    the ids their logins returned, others are numbered after them, and all get
+    ``REPLAY_PASSWORD``. Every room gets its recorded id, its senders as
+    participants and, for a direct chat, the pair behind it. Who else was in
+    a group isn't in the traffic, so the replayed fan-out reaches the senders
+    only, and groups created during the recording get new ids on replay.
+    """
+    names: set = set()
+    ids: dict[str, int] = {}
+    users_of: dict[str, str] = {}
+    rooms: dict[int, str] = {}
+    members: dict[int, set] = {}
+    directs: dict[int, tuple[str, str]] = {}
+    for entry in entries:
+        kind = entry["k"]
+        if kind == "open":
+            username = entry["f"].get("username") if isinstance(entry["f"], dict) else None
+            if isinstance(username, str):
+                users_of[entry["c"]] = username
+                names.add(username)
+        elif kind == "auth":
+            username = users_of.get(entry["c"])
+            if username is not None and isinstance(entry.get("id"), int):
+                ids[username] = entry["id"]
+        elif kind == "frame":
+            _names(entry["f"], names)
+            for message in _messages(entry["f"]):
+                room_id, sender = message.get("room_id"), message.get("from")
+                if not isinstance(room_id, int):
+                    continue
+                if message.get("chat_type") == ConversationType.Direct.value:
+                    rooms[room_id] = ConversationType.Direct.value
+                    if isinstance(sender, str) and isinstance(message.get("room_name"), str):
+                        directs.setdefault(room_id, (sender, message["room_name"]))
+                        names.add(message["room_name"])
+                else:
+                    rooms.setdefault(room_id, ConversationType.Group.value)
+                if isinstance(sender, str):
+                    members.setdefault(room_id, set()).add(sender)
+        elif kind == "http":
+            _names(entry.get("b"), names)
+            _names(entry.get("pp"), names)
+            for source in (entry.get("b"), entry.get("pp")):
+                if isinstance(source, dict):
+                    for key in ("group_id", "conversation_id", "room_id"):
+                        if isinstance(source.get(key), int):
+                            rooms.setdefault(source[key], ConversationType.Group.value)
+
+    next_id = max(ids.values(), default=0) + 1
+    for username in sorted(names - ids.keys()):
+        ids[username] = next_id
+        next_id += 1
+
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    out = io.BytesIO()
+
+    def row(table: str, **values):
+        out.write(json.dumps({"table": table, **values}).encode() + b"\n")
+
+    for username, user_id in sorted(ids.items(), key=lambda item: item[1]):
+        row("users", id=user_id, username=username, password=REPLAY_PASSWORD, approved=1)
+    for room_id, kind in sorted(rooms.items()):
+        row("conversations", id=room_id, name=None if kind == ConversationType.Direct.value else f"room{room_id}",
+            type=kind, created_at=now, updated_at=now)
+    for room_id in sorted(rooms):
+        in_room = set(members.get(room_id, ()))
+        in_room.update(directs.get(room_id, ()))
+        for username in sorted(in_room):
+            row("participants", conversation_id=room_id, user_id=ids[username], joined_at=now)
+    pairs = set()
+    for room_id, (a, b) in sorted(directs.items()):
+        low, high = sorted((ids[a], ids[b]))
+        if low != high and (low, high) not in pairs:
+            pairs.add((low, high))
+            row("direct_conversations", user_low=low, user_high=high, conversation_id=room_id)
+    return out.getvalue()
@@ -0,0 +1,158 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import re
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi import Response
+from fastapi.responses import FileResponse
+
+from etags import if_none_match
+
+try:
+    import brotli
+except ImportError:  # brotli is in requirements.txt, a bare install only serves gzip
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml",
+                      "application/xml", "application/manifest+json", "application/wasm")
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class StaticAsset():
+    __slots__ = ("path", "media_type", "etag", "cache_control", "size", "body", "gzip", "br")
+
+    def __init__(self, path: Path, media_type: str, etag: str, cache_control: str, size: int):
+        self.path = path
+        self.media_type = media_type
+        self.etag = etag
+        self.cache_control = cache_control
+        self.size = size
+        self.body: Optional[bytes] = None
+        self.gzip: Optional[bytes] = None
+        self.br: Optional[bytes] = None
+
+
+class StaticAssetCache():
+    """
+    In-memory index of the React build directory.
+
+    Built once at startup: every file gets a strong ETag, small files are held
+    in memory together with gzip/brotli variants so a request is a dict lookup
+    instead of a stat + open. Files bigger than ``max_inline_size`` stay on disk
+    and are streamed with ``FileResponse`` but still get ETags and cache headers.
+    Precompressed ``.gz``/``.br`` siblings produced by the frontend build are
+    picked up instead of compressing again.
+    """
+    def __init__(self, root: Path, max_inline_size: int = 1024 * 1024, min_compress_size: int = 512):
+        self._root = Path(root)
+        self._max_inline_size = max_inline_size
+        self._min_compress_size = min_compress_size
+        self._assets: Dict[str, StaticAsset] = {}
+
+    def __len__(self):
+        return len(self._assets)
+
+    def load(self) -> None:
+        assets = {}
+        if not self._root.is_dir():
+            logging.warning(f"Static build directory {self._root} does not exist")
+            self._assets = assets
+            return
+
+        for file in self._root.rglob("*"):
+            if not file.is_file() or file.suffix in (".gz", ".br"):
+                continue
+            rel = file.relative_to(self._root).as_posix()
+            assets[rel] = self._load_asset(file, rel)
+        self._assets = assets
+        logging.info(f"Indexed {len(assets)} static assets from {self._root}")
+
+    def _load_asset(self, file: Path, rel: str) -> StaticAsset:
+        media_type = mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+        if rel.startswith("static/") and HASHED_NAME.search(file.name):
+            cache_control = IMMUTABLE
+        else:
+            cache_control = REVALIDATE
+        size = file.stat().st_size
+
+        if size > self._max_inline_size:
+            digest = hashlib.sha256()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            return StaticAsset(file, media_type, f'"{digest.hexdigest()[:32]}"', cache_control, size)
+
+        body = file.read_bytes()
+        asset = StaticAsset(file, media_type, f'"{hashlib.sha256(body).hexdigest()[:32]}"', cache_control, size)
+        asset.body = body
+        if size >= self._min_compress_size and media_type.startswith(COMPRESSIBLE_TYPES):
+            asset.gzip = self._precompressed(file, ".gz") or gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                asset.br = self._precompressed(file, ".br") or brotli.compress(body, quality=11)
+            # keep a variant only when it is actually smaller
+            if asset.gzip is not None and len(asset.gzip) >= size:
+                asset.gzip = None
+            if asset.br is not None and len(asset.br) >= size:
+                asset.br = None
+        return asset
+
+    @staticmethod
+    def _precompressed(file: Path, suffix: str) -> Optional[bytes]:
+        sibling = file.with_name(file.name + suffix)
+        if sibling.is_file() and sibling.stat().st_mtime >= file.stat().st_mtime:
+            return sibling.read_bytes()
+        return None
+
+    @staticmethod
+    def _accepts(accept_encoding: str) -> set[str]:
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if q > 0:
+                accepted.add(coding.strip().lower())
+        return accepted
+
+    def get(self, rel_path: str) -> Optional[StaticAsset]:
+        return self._assets.get(rel_path.lstrip("/"))
+
+    def response(self, rel_path: str, headers) -> Optional[Response]:
+        """
+        Build the response for ``rel_path`` honouring ``Accept-Encoding`` and
+        ``If-None-Match``. Returns None for paths that are not in the build.
+        """
+        asset = self.get(rel_path)
+        if asset is None:
+            return None
+
+        body, encoding, etag = asset.body, None, asset.etag
+        accepted = self._accepts(headers.get("accept-encoding", ""))
+        if asset.br is not None and "br" in accepted:
+            body, encoding, etag = asset.br, "br", asset.etag[:-1] + '-br"'
+        elif asset.gzip is not None and ("gzip" in accepted or "*" in accepted):
+            body, encoding, etag = asset.gzip, "gzip", asset.etag[:-1] + '-gz"'
+
+        response_headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if asset.gzip is not None or asset.br is not None:
+            response_headers["Vary"] = "Accept-Encoding"
+
+        if if_none_match(headers, etag):
+            return Response(status_code=304, headers=response_headers)
+
+        if body is None:
+            return FileResponse(str(asset.path), media_type=asset.media_type, headers=response_headers)
+        if encoding is not None:
+            response_headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=asset.media_type, headers=response_headers)
@@ -0,0 +1,112 @@
+from datetime import datetime
+from typing import Any, AsyncGenerator, List, Optional, Protocol, runtime_checkable
+
+from fastapi import HTTPException
+
+from db_consts import ConversationType
+from db_objects import User
+from etags import MembershipVersions
+from eventhandler import EventHandler
+from user_registry import UserRecord
+
+
+STORAGE_ENGINES = ("sqlite", "memory")
+
+# characters of the last message shown in an inbox entry
+INBOX_PREVIEW_CHARS = 120
+
+# messages per page of get_messages_from
+HISTORY_PAGE_SIZE = 10
+
+class ConversationNotFound(HTTPException):
+    """
+    What every engine raises for a conversation id that doesn't exist, before
+    writing anything. It is a 404 wherever it reaches the HTTP layer.
+    """
+    def __init__(self, conversation_id: int):
+        super().__init__(status_code=404, detail="Conversation not found")
+        self.conversation_id = conversation_id
+
+
+# Rows come back as mappings: aiosqlite.Row from SQLite, plain dicts from memory.
+Row = Any
+
+
+@runtime_checkable
+class Storage(Protocol):
+    """
+    Everything the backend asks of its storage engine. ``DBWrapper`` (SQLite)
+    and ``MemoryStorage`` implement it; ``storage_conformance`` checks that they
+    behave the same.
+    """
+    event_handler: EventHandler
+    add_user_event: str
+    remove_user_event: str
+    participants_event: str
+    versions: MembershipVersions
+
+    async def init_db(self) -> None: ...
+
+    # users
+    async def add_user(self, username: str, password: str, approved: bool = False) -> None: ...
+    async def approve_user(self, username: str) -> Optional[int]: ...
+    async def reject_user(self, username: str) -> Optional[int]: ...
+    async def set_approved_bulk(self, usernames: list[str], approved: bool) -> dict[str, Optional[int]]: ...
+    async def get_user(self, username: str) -> Optional[Row]: ...
+    async def get_user_by_id(self, user_id: int) -> Optional[Row]: ...
+    async def get_all_users(self) -> List[User]: ...
+    async def get_user_record(self, username: str) -> Optional[tuple]: ...
+    def iter_user_records(self, chunk_size: int = 10000) -> AsyncGenerator[list[tuple], None]: ...
+
+    # sessions
+    async def get_session(self, session_id: str) -> Optional[Row]: ...
+    async def create_session_id(self, user: UserRecord, now: Optional[datetime] = None) -> str: ...
+    async def login(self, request: User) -> dict: ...
+    async def authenticate(self,
+                           username: str,
+                           password: str = "",
+                           session_id: str = "",
+                           now: Optional[datetime] = None) -> dict: ...
+
+    # conversations and participants
+    async def get_user_groups(self, username: str) -> list[dict]: ...
+    async def create_conversation(self, name: str | None, type: ConversationType, creator: int) -> bool: ...
+    async def retrieve_direct_convo(self, friend: UserRecord, user: UserRecord) -> Optional[int]: ...
+    async def create_direct_chat(self, user_a: UserRecord, user_b: UserRecord) -> int: ...
+    async def get_participants_from_convo(self, conversation_id: int) -> list[dict]: ...
+    async def get_participant_by_id(self, participant_id: int) -> Optional[Row]: ...
+    async def get_participant_by_user_and_convo(self, user: UserRecord, conversation_id: int) -> Optional[Row]: ...
+    async def create_participants(self, conversation_id: int, user_id: int) -> None: ...
+    async def remove_participant(self, group_id: int, user_id: int) -> None: ...
+    async def is_participant(self, conversation_id: int, user_id: int) -> bool: ...
+    async def add_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]: ...
+    async def remove_participants_bulk(self, conversation_id: int, usernames: list[str]) -> dict[str, str]: ...
+
+    # messages and read markers
+    async def add_message_to_history(self, msg_body: dict, sender: UserRecord) -> None: ...
+    async def add_messages_to_history(self, messages: list[dict], sender: UserRecord, mark_read: bool = True) -> list[int]: ...
+    async def get_newest_message_in_conversation(self, conversation_id: int) -> Optional[Row]: ...
+    async def get_messages_from(self, conversation_id: int, last_message: Optional[int] = None) -> list[dict]: ...
+    def iter_missed_messages(self,
+                             user_id: int,
+                             high_water: Optional[dict[int, int]] = None,
+                             cursor: Optional[int] = None,
+                             page_size: int = 500) -> AsyncGenerator[dict, None]: ...
+    def iter_conversation_messages(self,
+                                   conversation_id: int,
+                                   after_id: int = 0,
+                                   chunk_size: int = 1000) -> AsyncGenerator[list[Row], None]: ...
+    async def find_unread_messages(self, user: UserRecord) -> list[str]: ...
+    async def get_inbox(self, user_id: int) -> list[dict]: ...
+    async def update_last_message(self, participant_id: int, message_id: int) -> None: ...
+
+
+def open_storage(engine: str, db_path: str = "database.db") -> Storage:
+    """Build the storage engine named in the settings, ``db_path`` is ignored by ``memory``."""
+    if engine == "sqlite":
+        from database_wrapper import DBWrapper
+        return DBWrapper(db_path=db_path)
+    if engine == "memory":
+        from memory_storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage engine {engine}, use one of {STORAGE_ENGINES}")
@@ -0,0 +1,334 @@
+"""
+Behaviour every storage engine has to share. Each check gets a fresh, initialised
+engine and raises ConformanceError on the first difference. Run it with
+
+    python bench.py conformance
+"""
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, List, Tuple
+
+from fastapi import HTTPException
+
+from db_consts import ConversationType
+from db_objects import User
+from storage import ConversationNotFound, Storage, open_storage
+from user_registry import UserRecord
+
+
+class ConformanceError(AssertionError):
+    pass
+
+
+def expect(condition: bool, message: str) -> None:
+    if not condition:
+        raise ConformanceError(message)
+
+
+async def expect_http_error(status_code: int, awaitable: Awaitable) -> None:
+    try:
+        await awaitable
+    except HTTPException as e:
+        expect(e.status_code == status_code, f"expected HTTP {status_code}, got {e.status_code}")
+        return
+    raise ConformanceError(f"expected HTTP {status_code}, nothing was raised")
+
+
+async def _users(db: Storage, *names: str, approved: bool = True) -> List[UserRecord]:
+    records = []
+    for name in names:
+        await db.add_user(name, "pw", approved)
+        user_id, username, is_approved = await db.get_user_record(name)
+        records.append(UserRecord(user_id, username, is_approved))
+    return records
+
+
+async def _group(db: Storage, name: str, creator: UserRecord, *members: UserRecord) -> int:
+    await db.create_conversation(name, ConversationType.Group, creator.id)
+    groups = await db.get_user_groups(creator.username)
+    conversation_id = max(g["id"] for g in groups if g["name"] == name)
+    if members:
+        await db.add_participants_bulk(conversation_id, [m.username for m in members])
+    return conversation_id
+
+
+def _msg(room_id: int, text: str, sender: UserRecord) -> dict:
+    return {"type": "message", "data": {"msg": text}, "from": sender.username,
+            "room_id": room_id, "room_name": "room", "chat_type": "group"}
+
+
+# -------------------------------------------------
+# Checks
+# -------------------------------------------------
+async def check_users(db: Storage) -> None:
+    alice, bob = await _users(db, "alice", "bob")
+    expect(alice.id != bob.id, "user ids must be unique")
+    await expect_http_error(409, db.add_user("alice", "other"))
+
+    row = await db.get_user("alice")
+    expect(row["id"] == alice.id and row["username"] == "alice" and row["password"] == "pw", "get_user fields")
+    expect(bool(row["approved"]), "user added as approved")
+    expect((await db.get_user_by_id(bob.id))["username"] == "bob", "get_user_by_id")
+    expect(await db.get_user("nobody") is None, "missing user is None")
+    expect(await db.get_user_record("nobody") is None, "missing user record is None")
+
+    records = [r async for chunk in db.iter_user_records(chunk_size=1) for r in chunk]
+    expect([(r[0], r[1]) for r in records] == [(alice.id, "alice"), (bob.id, "bob")], "iter_user_records in id order")
+    expect(sorted(u._credentials.username for u in await db.get_all_users()) == ["alice", "bob"], "get_all_users")
+
+
+async def check_approval(db: Storage) -> None:
+    (carol,) = await _users(db, "carol", approved=False)
+    expect(not (await db.get_user_record("carol"))[2], "user added as pending")
+    expect(await db.approve_user("carol") == carol.id, "approve_user returns the id")
+    expect((await db.get_user_record("carol"))[2], "approved after approve_user")
+    expect(await db.reject_user("carol") == carol.id, "reject_user returns the id")
+    expect(not (await db.get_user_record("carol"))[2], "pending after reject_user")
+    expect(await db.approve_user("nobody") is None, "approving a missing user returns None")
+
+    result = await db.set_approved_bulk(["carol", "nobody"], True)
+    expect(result == {"carol": carol.id, "nobody": None}, f"set_approved_bulk result {result}")
+    expect((await db.get_user_record("carol"))[2], "approved after set_approved_bulk")
+
+
+async def check_events(db: Storage) -> None:
+    seen = []
+
+    async def listener(_, payload):
+        seen.append(payload)
+
+    db.event_handler.add_listener(db.add_user_event, listener)
+    (dave,) = await _users(db, "dave", approved=False)
+    await db.approve_user("dave")
+    await db.set_approved_bulk(["dave"], False)
+    await db.event_handler.shutdown()
+    expect(seen[0] == {"adding": "dave", "user_id": dave.id, "approved": False}, f"add event {seen[0]}")
+    expect(seen[1] == {"approve": "dave", "user_id": dave.id, "approved": True}, f"approve event {seen[1]}")
+    expect(seen[2]["action"] == "reject" and seen[2]["bulk"][0]["user_id"] == dave.id, f"bulk event {seen[2]}")
+
+
+async def check_login_and_sessions(db: Storage) -> None:
+    alice, _ = await _users(db, "alice", "bob")
+    await _users(db, "pending", approved=False)
+
+    expect((await db.login(User("alice", "pw")))["username"] == "alice", "password login")
+    await expect_http_error(401, db.login(User("alice", "wrong")))
+    await expect_http_error(401, db.login(User("pending", "pw")))
+    await expect_http_error(401, db.login(User("nobody", "pw")))
+
+    now = datetime.now()
+    session_id = await db.create_session_id(alice, now)
+    expect(await db.create_session_id(alice, now + timedelta(hours=1)) == session_id, "a valid session is reused")
+    expect((await db.get_session(session_id))["user_id"] == alice.id, "get_session")
+    expect((await db.login(User("alice", "", session_id)))["username"] == "alice", "session login")
+    await expect_http_error(401, db.login(User("bob", "", session_id)))
+    expect(await db.create_session_id(alice, now + timedelta(days=2)) != session_id, "an expired session is replaced")
+
+    expired = await db.create_session_id(alice, now - timedelta(days=3))
+    expect((await db.login(User("alice", "pw", expired)))["username"] == "alice",
+           "an expired session falls back to the password")
+
+
+async def check_authenticate(db: Storage) -> None:
+    alice, bob = await _users(db, "alice", "bob")
+    await _users(db, "pending", approved=False)
+    room = await _group(db, "room", alice, bob)
+    await db.add_messages_to_history([_msg(room, "hi", alice)], alice)
+
+    now = datetime.now()
+    auth = await db.authenticate("bob", "pw", now=now)
+    expect(tuple(auth["user"])[:2] == (bob.id, "bob") and auth["user"][2], f"authenticated user {auth['user']}")
+    expect(auth["unread"] == await db.find_unread_messages(bob) == ["room"], f"unread summary {auth['unread']}")
+    expect(auth["session_id"] == await db.create_session_id(bob, now), "authenticate issues the same session")
+    again = await db.authenticate("bob", "", auth["session_id"], now=now)
+    expect(again["session_id"] == auth["session_id"], "session login reuses the session")
+
+    await expect_http_error(401, db.authenticate("bob", "wrong"))
+    await expect_http_error(401, db.authenticate("pending", "pw"))
+    await expect_http_error(401, db.authenticate("alice", "", auth["session_id"]))
+    await expect_http_error(400, db.authenticate("", "", auth["session_id"]))
+
+
+async def check_groups_and_participants(db: Storage) -> None:
+    alice, bob, carol = await _users(db, "alice", "bob", "carol")
+    room = await _group(db, "room", alice)
+    expect(await db.is_participant(room, alice.id), "the creator is a participant")
+    expect([g["name"] for g in await db.get_user_groups("alice")] == ["room"], "get_user_groups")
+    expect(await db.get_user_groups("bob") == [], "no groups for a non member")
+
+    await db.create_participants(room, bob.id)
+    members = await db.get_participants_from_convo(room)
+    expect(sorted(m["username"] for m in members) == ["alice", "bob"], f"participants {members}")
+
+    participant = await db.get_participant_by_user_and_convo(bob, room)
+    expect(participant["conversation_id"] == room and participant["user_id"] == bob.id, "participant by user")
+    expect((await db.get_participant_by_id(participant["id"]))["user_id"] == bob.id, "participant by id")
+
+    result = await db.add_participants_bulk(room, ["bob", "carol", "nobody"])
+    expect(result == {"bob": "already_participant", "carol": "added", "nobody": "user_not_found"}, f"bulk add {result}")
+    result = await db.remove_participants_bulk(room, ["alice", "carol", "nobody", "bob"])
+    expect(result == {"alice": "removed", "carol": "removed", "nobody": "user_not_found", "bob": "removed"},
+           f"bulk remove {result}")
+    expect(await db.get_participants_from_convo(room) == [], "everyone removed")
+
+    await db.create_participants(room, carol.id)
+    await db.remove_participant(room, carol.id)
+    expect(not await db.is_participant(room, carol.id), "remove_participant")
+    await expect_http_error(404, db.add_participants_bulk(room + 1000, ["alice"]))
+
+
+async def check_direct_conversations(db: Storage) -> None:
+    alice, bob, carol = await _users(db, "alice", "bob", "carol")
+    expect(await db.retrieve_direct_convo(alice, bob) is None, "no direct conversation yet")
+    first = await db.create_direct_chat(alice, bob)
+    expect(await db.create_direct_chat(bob, alice) == first, "one direct conversation per pair")
+    expect(await db.retrieve_direct_convo(bob, alice) == first, "retrieve_direct_convo")
+    expect(await db.create_direct_chat(alice, carol) != first, "a new pair gets a new conversation")
+    members = await db.get_participants_from_convo(first)
+    expect(sorted(m["user_id"] for m in members) == sorted([alice.id, bob.id]), "both users are participants")
+    expect(await db.get_user_groups("alice") == [], "direct conversations are not groups")
+
+
+async def check_messages(db: Storage) -> None:
+    alice, bob = await _users(db, "alice", "bob")
+    room = await _group(db, "room", alice, bob)
+    expect(await db.get_newest_message_in_conversation(room) is None, "empty conversation")
+    expect(await db.get_messages_from(room) == [], "no history yet")
+
+    ids = await db.add_messages_to_history([_msg(room, f"m{i}", alice) for i in range(25)], alice)
+    expect(len(ids) == 25 and ids == sorted(ids) and len(set(ids)) == 25, "ids come back in order")
+    expect(await db.add_messages_to_history([{**_msg(room, "x", alice), "room_id": None}], alice) == [],
+           "messages without a room are skipped")
+    expect((await db.get_newest_message_in_conversation(room))["id"] == ids[-1], "newest message")
+    expect((await db.get_participant_by_user_and_convo(alice, room))["last_read_message_id"] == ids[-1],
+           "mark_read moves the sender's marker")
+    expect((await db.get_participant_by_user_and_convo(bob, room))["last_read_message_id"] is None,
+           "other markers stay")
+
+    latest = await db.get_messages_from(room)
+    expect([m["id"] for m in latest] == ids[-10:], "latest page")
+    older = await db.get_messages_from(room, latest[0]["content"])
+    expect([m["id"] for m in older] == ids[-20:-10], "page before the oldest message")
+    expect(await db.get_messages_from(room, "no such message") == [], "unknown oldest message")
+
+    chunks = [chunk async for chunk in db.iter_conversation_messages(room, after_id=ids[4], chunk_size=7)]
+    expect([len(c) for c in chunks] == [7, 7, 6], f"chunk sizes {[len(c) for c in chunks]}")
+    expect([row["id"] for c in chunks for row in c] == ids[5:], "export resumes after after_id")
+    expect(chunks[0][0]["sender_id"] == alice.id and "created_at" in chunks[0][0].keys(), "export row fields")
+
+    await db.add_message_to_history(_msg(room, "single", bob), bob)
+    expect((await db.get_participant_by_user_and_convo(bob, room))["last_read_message_id"] is None,
+           "add_message_to_history leaves the read marker alone")
+
+
+async def check_unknown_conversation(db: Storage) -> None:
+    alice, bob = await _users(db, "alice", "bob")
+    room = await _group(db, "room", alice, bob)
+    ids = await db.add_messages_to_history([_msg(room, "before", alice)], alice)
+    missing = room + 1000
+
+    for attempt in ([_msg(missing, "lost", alice)], [_msg(room, "kept?", alice), _msg(missing, "lost", alice)]):
+        try:
+            await db.add_messages_to_history(attempt, alice)
+        except ConversationNotFound as e:
+            expect(e.conversation_id == missing and e.status_code == 404, "ConversationNotFound names the conversation")
+        else:
+            raise ConformanceError("a message to an unknown conversation raises ConversationNotFound")
+    expect((await db.get_newest_message_in_conversation(room))["id"] == ids[-1],
+           "nothing of a batch with an unknown conversation is written")
+    expect((await db.get_participant_by_user_and_convo(alice, room))["last_read_message_id"] == ids[-1],
+           "read markers stay when the batch is refused")
+    await expect_http_error(404, db.add_participants_bulk(missing, ["bob"]))
+
+
+async def check_unread_and_sync(db: Storage) -> None:
+    alice, bob, carol = await _users(db, "alice", "bob", "carol")
+    room = await _group(db, "room", alice, bob)
+    direct = await db.create_direct_chat(bob, carol)
+    expect(await db.find_unread_messages(bob) == [], "nothing unread")
+
+    room_ids = await db.add_messages_to_history([_msg(room, f"r{i}", alice) for i in range(3)], alice)
+    direct_ids = await db.add_messages_to_history([_msg(direct, f"d{i}", carol) for i in range(2)], carol)
+    own_ids = await db.add_messages_to_history([_msg(room, "own", bob)], bob, mark_read=False)
+    expect(sorted(await db.find_unread_messages(bob)) == ["carol", "room"], "unread by display name")
+    expect(await db.find_unread_messages(carol) == [], "own messages are never unread")
+
+    missed = [m async for m in db.iter_missed_messages(bob.id, page_size=2)]
+    expect([m["id"] for m in missed] == sorted(room_ids + direct_ids + own_ids), "missed messages in id order")
+    expect({m["room_id"] for m in missed} == {room, direct}, "missed messages from every conversation")
+
+    missed = [m async for m in db.iter_missed_messages(bob.id, high_water={room: room_ids[-1]}, page_size=2)]
+    expect([m["id"] for m in missed if m["room_id"] == room] == own_ids, "high water mark per conversation")
+    missed = [m async for m in db.iter_missed_messages(bob.id, cursor=direct_ids[-1])]
+    expect(all(m["id"] > direct_ids[-1] for m in missed), "cursor wins over high water")
+    expect([m async for m in db.iter_missed_messages(10_000)] == [], "unknown user misses nothing")
+
+    participant = await db.get_participant_by_user_and_convo(bob, direct)
+    await db.update_last_message(participant["id"], direct_ids[-1])
+    expect(await db.find_unread_messages(bob) == ["room"], "update_last_message clears the direct chat")
+
+
+async def check_inbox(db: Storage) -> None:
+    alice, bob, carol = await _users(db, "alice", "bob", "carol")
+    expect(await db.get_inbox(alice.id) == [], "empty inbox")
+    room = await _group(db, "room", alice, bob)
+    quiet = await _group(db, "quiet", bob)
+    direct = await db.create_direct_chat(bob, carol)
+
+    await db.add_messages_to_history([_msg(room, f"r{i}", alice) for i in range(3)], alice)
+    long_text = "x" * 1000
+    direct_ids = await db.add_messages_to_history([_msg(direct, long_text, carol)], carol)
+    own_ids = await db.add_messages_to_history([_msg(room, "from bob", bob)], bob, mark_read=False)
+
+    inbox = await db.get_inbox(bob.id)
+    expect([e["conversation_id"] for e in inbox] == [room, direct, quiet], f"inbox order {inbox}")
+    by_id = {e["conversation_id"]: e for e in inbox}
+    expect(by_id[room]["display_name"] == "room" and by_id[room]["type"] == "group", "group entry")
+    expect(by_id[room]["last_message_id"] == own_ids[0] and by_id[room]["last_message"] == "from bob",
+           f"last message {by_id[room]}")
+    expect(by_id[room]["last_sender_id"] == bob.id and by_id[room]["unread_count"] == 3, "own messages are not unread")
+    expect(by_id[direct]["display_name"] == "carol" and by_id[direct]["type"] == "direct", "direct entry named after the other user")
+    expect(by_id[direct]["last_message_id"] == direct_ids[0] and 0 < len(by_id[direct]["last_message"]) < len(long_text),
+           "previews are cut short")
+    expect(by_id[quiet]["last_message_id"] is None and by_id[quiet]["unread_count"] == 0, "conversation without messages")
+
+    participant = await db.get_participant_by_user_and_convo(bob, direct)
+    await db.update_last_message(participant["id"], direct_ids[0])
+    expect({e["conversation_id"]: e for e in await db.get_inbox(bob.id)}[direct]["unread_count"] == 0,
+           "read marker clears the unread count")
+    expect([e["unread_count"] for e in await db.get_inbox(alice.id)] == [1], "alice sees bob's message as unread")
+
+
+CHECKS: List[Callable[[Storage], Awaitable[None]]] = [
+    check_users,
+    check_approval,
+    check_events,
+    check_login_and_sessions,
+    check_authenticate,
+    check_groups_and_participants,
+    check_direct_conversations,
+    check_messages,
+    check_unknown_conversation,
+    check_unread_and_sync,
+    check_inbox,
+]
+
+
+async def run_conformance(engine: str) -> List[Tuple[str, str | None]]:
+    """Run every check against a fresh ``engine``, returns ``(check, error or None)``."""
+    results = []
+    for check in CHECKS:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = open_storage(engine, str(Path(tmp) / "conformance.db"))
+            await db.init_db()
+            try:
+                await check(db)
+                results.append((check.__name__, None))
+            except Exception as e:
+                results.append((check.__name__, f"{type(e).__name__}: {e}"))
+            finally:
+                await db.event_handler.shutdown(timeout=1.0)
+    return results
+
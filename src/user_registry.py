@@ -0,0 +1,133 @@
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+from fastapi import WebSocket
+
+from wire import JSON_CODEC
+
+
+class UserRecord():
+    """
+    What the server keeps in memory for every registered user. Credentials stay
+    in the database, they are only read during login.
+    """
+    __slots__ = ("id", "username", "approved")
+
+    def __init__(self, id: int, username: str, approved: bool):
+        self.id = id
+        self.username = username
+        self.approved = bool(approved)
+
+    def __repr__(self):
+        return f"UserRecord(id={self.id}, username={self.username!r}, approved={self.approved})"
+
+
+class Connection():
+    """
+    Per-connection state, only exists while a user is online.
+    """
+    __slots__ = ("user", "ws", "codec", "connected_at", "last_seen")
+
+    def __init__(self, user: UserRecord, ws: WebSocket, codec=JSON_CODEC):
+        self.user = user
+        self.ws = ws
+        self.codec = codec
+        self.connected_at = time.monotonic()
+        # bumped on every inbound frame, read by the heartbeat sweep
+        self.last_seen = self.connected_at
+
+
+class UserRegistry():
+    """
+    Compact id/username index of all users plus the connections of the users
+    that are currently online.
+    """
+    def __init__(self):
+        self._by_name: Dict[str, UserRecord] = {}
+        self._by_id: Dict[int, UserRecord] = {}
+        # approved users in registration order, so /api/users never touches the rest
+        self._approved: Dict[str, UserRecord] = {}
+        self._online: Dict[str, Connection] = {}
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, username: str):
+        return username in self._by_name
+
+    # -------------------------------------------------
+    # Records
+    # -------------------------------------------------
+    def load(self, rows: Iterable[tuple]) -> None:
+        """Bulk insert ``(id, username, approved)`` rows."""
+        by_name, by_id, approved = self._by_name, self._by_id, self._approved
+        for user_id, username, is_approved in rows:
+            record = UserRecord(user_id, username, is_approved)
+            by_name[username] = record
+            by_id[user_id] = record
+            if record.approved:
+                approved[username] = record
+
+    def put(self, user_id: int, username: str, approved: bool) -> UserRecord:
+        record = self._by_name.get(username)
+        if record is None:
+            record = UserRecord(user_id, username, approved)
+            self._by_name[username] = record
+            self._by_id[user_id] = record
+        else:
+            record.id = user_id
+            self._by_id[user_id] = record
+        self.set_approved(record, approved)
+        return record
+
+    def set_approved(self, record: UserRecord, approved: bool) -> None:
+        record.approved = bool(approved)
+        if record.approved:
+            self._approved[record.username] = record
+        else:
+            self._approved.pop(record.username, None)
+
+    def get(self, username: str) -> Optional[UserRecord]:
+        return self._by_name.get(username)
+
+    def get_by_id(self, user_id: int) -> Optional[UserRecord]:
+        return self._by_id.get(user_id)
+
+    def records(self) -> Iterator[UserRecord]:
+        return iter(self._by_name.values())
+
+    def approved(self) -> Iterator[UserRecord]:
+        return iter(self._approved.values())
+
+    # -------------------------------------------------
+    # Connections
+    # -------------------------------------------------
+    def connect(self, record: UserRecord, ws: WebSocket, codec=JSON_CODEC) -> Connection:
+        conn = Connection(record, ws, codec)
+        self._online[record.username] = conn
+        return conn
+
+    def disconnect(self, username: str, ws: Optional[WebSocket] = None) -> Optional[Connection]:
+        """
+        Drop the connection of ``username``. When ``ws`` is given the entry is only
+        removed if it still belongs to that socket, so a stale handler can't kick
+        out a newer session of the same user.
+        """
+        conn = self._online.get(username)
+        if conn is None or (ws is not None and conn.ws is not ws):
+            return None
+        del self._online[username]
+        return conn
+
+    def connection(self, username: str) -> Optional[Connection]:
+        return self._online.get(username)
+
+    def is_online(self, username: str) -> bool:
+        return username in self._online
+
+    def online(self) -> Iterator[Connection]:
+        return iter(list(self._online.values()))
+
+    @property
+    def online_count(self) -> int:
+        return len(self._online)
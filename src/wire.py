@@ -0,0 +1,175 @@
+import json
+import zlib
+from typing import Any, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import TypeAdapter, ValidationError
+
+from frames import InvalidFrame, describe
+
+try:
+    import msgpack
+except ImportError:  # the msgpack subprotocol is only offered when the package is installed
+    msgpack = None
+
+
+SUBPROTOCOL_MSGPACK = "s3chat.msgpack"
+SUBPROTOCOL_JSON_DEFLATE = "s3chat.json.deflate"
+
+# envelope keys of the chat protocol and their short msgpack form
+SHORT_KEYS = {
+    "type": "t",
+    "data": "d",
+    "msg": "m",
+    "from": "f",
+    "room_id": "r",
+    "room_name": "n",
+    "chat_type": "c",
+    "session_id": "s",
+    "state": "st",
+    "messages": "ms",
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+# most a deflated client frame may inflate to, a few KB of crafted deflate can expand to gigabytes
+MAX_FRAME_BYTES = 1 << 20
+
+
+def _rename(obj: Any, keys: dict) -> Any:
+    # only the envelope and its "data" object are renamed, user content is left alone
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k in ("data", "d") and isinstance(v, dict):
+            v = {keys.get(ik, ik): iv for ik, iv in v.items()}
+        elif k in ("messages", "ms") and isinstance(v, list):
+            v = [_rename(item, keys) for item in v]
+        out[keys.get(k, k)] = v
+    return out
+
+
+class JsonCodec():
+    """
+    Plain JSON text frames, what every client speaks without asking for a subprotocol.
+    Given a ``schema``, ``decode`` parses and validates in one pass, no dict in between.
+    """
+    subprotocol: Optional[str] = None
+
+    def encode(self, obj: Any) -> str | bytes:
+        return json.dumps(obj)
+
+    def decode(self, message: dict, schema: Optional[TypeAdapter] = None) -> Any:
+        text = message.get("text")
+        if text is None:
+            text = message["bytes"]
+        return schema.validate_json(text) if schema is not None else json.loads(text)
+
+
+class DeflateJsonCodec(JsonCodec):
+    """
+    JSON for clients that want compression at the application level. Frames of
+    at least ``threshold`` bytes are sent as raw-deflate binary frames, smaller
+    ones stay text frames, where compressing would cost more than it saves.
+    Clients may send either kind as well.
+    """
+    subprotocol = SUBPROTOCOL_JSON_DEFLATE
+
+    def __init__(self, threshold: int = 1024, level: int = 6):
+        self._threshold = threshold
+        self._level = level
+
+    def encode(self, obj: Any) -> str | bytes:
+        text = json.dumps(obj)
+        if len(text) < self._threshold:
+            return text
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        return compressor.compress(text.encode()) + compressor.flush()
+
+    def decode(self, message: dict, schema: Optional[TypeAdapter] = None) -> Any:
+        if message.get("bytes") is not None:
+            text = inflate(message["bytes"])
+        else:
+            text = message["text"]
+        return schema.validate_json(text) if schema is not None else json.loads(text)
+
+
+def inflate(data: bytes, limit: int = MAX_FRAME_BYTES) -> bytes:
+    """Raw deflate, refused as soon as it would grow past ``limit`` or is cut short."""
+    decompressor = zlib.decompressobj(-15)
+    text = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise InvalidFrame(f"frame inflates to more than {limit} bytes")
+    if not decompressor.eof:
+        raise InvalidFrame("truncated deflate stream")
+    return text
+
+
+class MsgPackCodec():
+    """Binary MessagePack frames with the short envelope keys from SHORT_KEYS."""
+    subprotocol = SUBPROTOCOL_MSGPACK
+
+    def encode(self, obj: Any) -> str | bytes:
+        return msgpack.packb(_rename(obj, SHORT_KEYS))
+
+    def decode(self, message: dict, schema: Optional[TypeAdapter] = None) -> Any:
+        payload = message.get("bytes")
+        if payload is None:
+            raise ValueError("msgpack subprotocol expects binary frames")
+        obj = _rename(msgpack.unpackb(payload), LONG_KEYS)
+        return schema.validate_python(obj) if schema is not None else obj
+
+
+JSON_CODEC = JsonCodec()
+
+
+class WireProtocols():
+    """
+    Picks the codec of a websocket from the subprotocols the client offered.
+    Our preference order decides, not the client's; no offer means plain JSON.
+    """
+    def __init__(self, deflate_threshold: int = 1024):
+        self._codecs = {}
+        if msgpack is not None:
+            self._codecs[SUBPROTOCOL_MSGPACK] = MsgPackCodec()
+        self._codecs[SUBPROTOCOL_JSON_DEFLATE] = DeflateJsonCodec(deflate_threshold)
+
+    def negotiate(self, ws: WebSocket) -> JsonCodec | MsgPackCodec:
+        offered = ws.scope.get("subprotocols") or []
+        for name, codec in self._codecs.items():
+            if name in offered:
+                return codec
+        return JSON_CODEC
+
+    async def accept(self, ws: WebSocket):
+        codec = self.negotiate(ws)
+        await ws.accept(subprotocol=codec.subprotocol)
+        return codec
+
+
+async def receive_frame(ws: WebSocket, codec, schema: Optional[TypeAdapter] = None) -> Any:
+    """
+    The next frame, decoded. With a ``schema`` it comes back as the schema's
+    struct, and a frame that doesn't decode or validate raises InvalidFrame.
+    """
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if schema is None:
+        return codec.decode(message)
+    try:
+        return codec.decode(message, schema)
+    except InvalidFrame:
+        raise
+    except ValidationError as e:
+        raise InvalidFrame(describe(e))
+    except (ValueError, TypeError, KeyError, zlib.error) as e:
+        # not even the codec's format: bad deflate stream, bad msgpack, wrong frame kind
+        raise InvalidFrame(f"undecodable frame: {str(e) or type(e).__name__}")
+
+
+async def send_encoded(ws: WebSocket, frame: str | bytes) -> None:
+    if isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)